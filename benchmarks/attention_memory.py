@@ -0,0 +1,62 @@
+# Memory benchmark of the attention maps captured by translate() for long (200 token) expressions
+import argparse
+import copy
+import time
+
+import torch
+
+from train.models import VanillaWAP, EOS_INDEX
+from train.utils.global_params import BASE_CONFIG
+
+
+def run(model, x, mask, return_alphas):
+    """
+    :param model: the model to translate with
+    :param x: batch of images - (B, 1, H, W)
+    :param mask: image mask - (B, 1, H, W)
+    :param return_alphas: whether the attention maps are captured
+    :return: seconds taken, number of steps decoded and bytes held by the attention maps
+    """
+    start = time.perf_counter()
+    with torch.no_grad():
+        tokens, alphas = model.translate(x, mask=mask, return_alphas=return_alphas)
+    elapsed = time.perf_counter() - start
+    return elapsed, tokens.shape[-1], alphas.nbytes() if alphas is not None else 0
+
+
+def main(args):
+    config = copy.deepcopy(BASE_CONFIG)
+    config['DEVICE'] = 'cpu'
+    config['max_len'] = args.max_len
+    torch.manual_seed(0)
+    model = VanillaWAP(config).eval()
+
+    # Never emit <EOS> so that every expression is decoded for max_len steps
+    with torch.no_grad():
+        model.parser['W_o'].bias[EOS_INDEX] = -1e4
+
+    x = torch.rand(args.batch_size, 1, args.height, args.width)
+    mask = torch.ones_like(x)
+    feature_cells = (args.height // 16) * (args.width // 16)
+
+    # Dense float32 maps of every step, as held before the maps were stored compactly
+    legacy = args.max_len * args.batch_size * feature_cells * 4
+
+    print(f'{args.batch_size} x {args.max_len} tokens, {args.height}x{args.width} image, {feature_cells} feature cells')
+    print(f'{"mode":<16}{"time (s)":>10}{"steps":>8}{"attention bytes":>18}{"vs float32":>12}')
+    print(f'{"float32 (old)":<16}{"-":>10}{"-":>8}{legacy:>18}{1:>12.3f}')
+    modes = [('off', False, None), ('float16', True, None), (f'top-{args.topk}', True, args.topk)]
+    for name, return_alphas, topk in modes:
+        model.config['attention_topk'] = topk
+        elapsed, steps, nbytes = run(model, x, mask, return_alphas)
+        print(f'{name:<16}{elapsed:>10.3f}{steps:>8}{nbytes:>18}{nbytes / legacy:>12.3f}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Memory held by the attention maps of translate()')
+    parser.add_argument('--batch_size', type=int, default=8)
+    parser.add_argument('--height', type=int, default=256)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--max_len', type=int, default=200)
+    parser.add_argument('--topk', type=int, default=32)
+    main(parser.parse_args())
@@ -0,0 +1,104 @@
+# Compute/accuracy sweep of the encoder backbones registered in train/models.py. Run from the root of the repository:
+#   python -m benchmarks.backbones --threads 4
+#   python -m benchmarks.backbones --checkpoints vgg=checkpoints/model_best.pth dense=dense/model_best.pth \
+#       --val_csv data/CROHME/val/wap_dataset.csv --output backbones.json
+import argparse
+import json
+
+import torch
+from torch import nn
+
+from benchmarks.common import checkpoint_expression_rate, make_config, make_model, timeit
+from train.models import BACKBONES, EOS_INDEX
+
+
+def count_flops(module, *inputs):
+    """
+    :param module: module to run
+    :param inputs: inputs of the module
+    :return: number of floating point operations of the convolutions and linear layers, a multiply-add counting as 2
+    """
+    flops = []
+
+    def conv_hook(layer, _, output):
+        kernel = layer.kernel_size[0] * layer.kernel_size[1]
+        flops.append(2 * output.numel() * kernel * layer.in_channels // layer.groups)
+
+    def linear_hook(layer, _, output):
+        flops.append(2 * output.numel() * layer.in_features)
+
+    hooks = []
+    for layer in module.modules():
+        if isinstance(layer, nn.Conv2d):
+            hooks.append(layer.register_forward_hook(conv_hook))
+        elif isinstance(layer, nn.Linear):
+            hooks.append(layer.register_forward_hook(linear_hook))
+    with torch.no_grad():
+        module(*inputs)
+    for hook in hooks:
+        hook.remove()
+    return sum(flops)
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    checkpoints = dict(item.split('=', 1) for item in args.checkpoints)
+
+    report = []
+    print(f'{"backbone":<12}{"D":>6}{"encoder params":>16}{"total params":>14}{"encoder GFLOPs":>16}'
+          f'{"watch (ms)":>12}{"translate (ms)":>16}{"expr rate":>11}')
+    for name in args.backbones:
+        config = make_config(backbone=name, max_len=args.max_len)
+        model = make_model(config).eval()
+        if name in checkpoints:
+            model.load_state_dict(torch.load(checkpoints[name], map_location='cpu'))
+            # Keep the decoding length fixed so that the latency does not depend on the weights
+            with torch.no_grad():
+                model.parser['W_o'].bias[EOS_INDEX] = -1e4
+
+        x = (torch.rand(args.batch_size, 1, args.height, args.width) > 0.9).float()
+        mask = torch.ones_like(x)
+        with torch.no_grad():
+            watch = timeit(lambda: model.watch(x, mask), args.repeats)
+            translate = timeit(lambda: model.translate(x, mask=mask), args.repeats)
+
+        entry = {
+            'backbone': name,
+            'feature_dim': model.feature_dim,
+            'encoder_params': sum(p.numel() for p in model.watcher.parameters()),
+            'total_params': sum(p.numel() for p in model.parameters()),
+            'encoder_gflops': count_flops(model.watcher, x) / 1e9 / args.batch_size,
+            'watch_ms': watch['median_s'] * 1e3,
+            'translate_ms': translate['median_s'] * 1e3,
+            'expression_rate': None,
+        }
+        if name in checkpoints and args.val_csv:
+            entry['expression_rate'] = checkpoint_expression_rate(model, checkpoints[name], args.val_csv,
+                                                                  args.max_samples)
+        report.append(entry)
+
+        expr = '-' if entry['expression_rate'] is None else f'{entry["expression_rate"]:.3f}'
+        print(f'{name:<12}{entry["feature_dim"]:>6}{entry["encoder_params"]:>16}{entry["total_params"]:>14}'
+              f'{entry["encoder_gflops"]:>16.3f}{entry["watch_ms"]:>12.1f}{entry["translate_ms"]:>16.1f}{expr:>11}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'height': args.height, 'width': args.width, 'batch_size': args.batch_size,
+                       'max_len': args.max_len, 'threads': torch.get_num_threads(), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='FLOPs, parameters, CPU latency and expression rate per backbone')
+    parser.add_argument('--backbones', nargs='+', choices=BACKBONES.keys(), default=list(BACKBONES.keys()))
+    parser.add_argument('--checkpoints', nargs='*', default=[], help='backbone=path of the trained weights')
+    parser.add_argument('--val_csv', help='validation set the expression rate is computed on')
+    parser.add_argument('--max_samples', type=int, default=None, help='number of validation samples evaluated')
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--width', type=int, default=448)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--max_len', type=int, default=50, help='number of decoding steps timed')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    main(parser.parse_args())
@@ -0,0 +1,85 @@
+# Memory/time trade-off of the activation checkpointing of the watcher blocks and of the decoder steps. Run from the root
+# of the repository:
+#   python -m benchmarks.checkpointing --height 256 --width 1024 --seq_len 100 --batch_size 8
+import argparse
+import copy
+import multiprocessing
+import os
+import resource
+
+import torch
+
+from benchmarks.common import make_config, make_model, synthetic_batch, timeit
+from train.utils.losses import MaskedCrossEntropy
+
+SETTINGS = [
+    ('none', None, 0),
+    ('watcher blocks', 'block', 0),
+    ('watcher layers', 'layer', 0),
+    ('decoder/10', None, 10),
+    ('layers+decoder/10', 'layer', 10),
+    ('layers+decoder/25', 'layer', 25),
+]
+
+
+def measure(args, watcher, chunk):
+    """
+    Run in a fresh process, so that the peak resident set size only reflects this setting
+    :param args: arguments of the benchmark
+    :param watcher: granularity of the checkpointing of the watcher, 'block', 'layer' or None
+    :param chunk: number of decoder steps per checkpointed chunk, 0 disables it
+    :return: peak memory growth of a train step in bytes and the median step time in seconds
+    """
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    config = make_config(DEVICE=args.device)
+    config['train_params'] = dict(copy.deepcopy(config['train_params']), checkpoint_watcher=watcher,
+                                  checkpoint_decoder_chunk=chunk)
+    model = make_model(config).train().to(args.device)
+    x, mask, y = synthetic_batch(args.batch_size, args.height, args.width, args.seq_len, config)
+    label_mask = torch.ones_like(y, dtype=torch.float)
+    criterion = MaskedCrossEntropy()
+
+    def step():
+        model.zero_grad(set_to_none=True)
+        criterion(model(x, mask, y, target_mask=label_mask), y, label_mask).backward()
+
+    cuda = args.device.startswith('cuda')
+    if cuda:
+        torch.cuda.reset_peak_memory_stats()
+        before = torch.cuda.memory_allocated()
+    else:
+        before = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+    step()
+    if cuda:
+        peak = torch.cuda.max_memory_allocated() - before
+    else:
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024 - before
+    return peak, timeit(step, args.repeats, device=args.device)['median_s']
+
+
+def main(args):
+    print(f'batch {args.batch_size}, {args.height}x{args.width} images, {args.seq_len} tokens, {args.device}')
+    print(f'{"checkpointing":<22}{"peak memory (MB)":>18}{"vs none":>10}{"step (ms)":>12}{"vs none":>10}')
+    reference = None
+    # Large tensors are given back to the system as soon as they are freed, otherwise glibc keeps them resident and the
+    # peak resident set size reflects the allocator rather than the tensors alive at once
+    os.environ.setdefault('MALLOC_MMAP_THRESHOLD_', str(1 << 20))
+    context = multiprocessing.get_context('spawn')
+    for name, watcher, chunk in SETTINGS:
+        with context.Pool(1) as pool:
+            peak, t = pool.apply(measure, (args, watcher, chunk))
+        reference = reference or (peak, t)
+        print(f'{name:<22}{peak / 2 ** 20:>18.1f}{peak / reference[0]:>9.2f}x{t * 1e3:>12.1f}{t / reference[1]:>9.2f}x')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Peak memory and time of a train step for every checkpointing setting')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--width', type=int, default=512)
+    parser.add_argument('--seq_len', type=int, default=50)
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--repeats', type=int, default=3)
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    main(parser.parse_args())
@@ -0,0 +1,98 @@
+# Helpers shared by the benchmarks: synthetic inputs, model construction, timing and scoring
+import copy
+import statistics
+import time
+
+import pandas as pd
+import torch
+from torch.utils.data import DataLoader
+
+from train.models import VanillaWAP, EOS_INDEX
+from train.utils.datasets import ImageDataset, collate_fn, expression_rate
+from train.utils.global_params import BASE_CONFIG, PREPROCESS_CONFIG, VOCAB_LOC
+
+
+def make_config(**overrides):
+    """
+    :param overrides: BASE_CONFIG keys to override
+    :return: a copy of BASE_CONFIG running on the cpu unless a DEVICE is given
+    """
+    config = copy.deepcopy(BASE_CONFIG)
+    config['DEVICE'] = 'cpu'
+    config['train_params']['load'] = False
+    config.update(overrides)
+    return config
+
+
+def make_model(config, never_stop=True, seed=0):
+    """
+    :param config: model config
+    :param never_stop: forbid <EOS> so that translate() always runs for config['max_len'] steps
+    :param seed: seed of the weight initialization
+    :return: a VanillaWAP with random weights
+    """
+    torch.manual_seed(seed)
+    model = VanillaWAP(config)
+    if never_stop:
+        with torch.no_grad():
+            model.parser['W_o'].bias[EOS_INDEX] = -1e4
+    return model
+
+
+def synthetic_batch(batch_size, height, width, seq_len, config, seed=0):
+    """
+    :return: images, image masks and target tokens shaped like the output of collate_fn
+    """
+    generator = torch.Generator().manual_seed(seed)
+    x = (torch.rand(batch_size, 1, height, width, generator=generator) > 0.9).float()
+    mask = torch.ones_like(x)
+    y = torch.randint(2, config['vocab_size'], (batch_size, seq_len), generator=generator)
+    y[:, -1] = EOS_INDEX
+    device = config['DEVICE']
+    return x.to(device), mask.to(device), y.to(device)
+
+
+def timeit(fn, repeats=5, warmup=1, device='cpu'):
+    """
+    :param fn: function to time
+    :param repeats: number of timed calls
+    :param warmup: number of untimed calls made first
+    :param device: device fn runs on. CUDA work is synchronized before the clock is read
+    :return: dictionary with the median, min and max seconds per call
+    """
+    sync = str(device).startswith('cuda')
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        if sync:
+            torch.cuda.synchronize()
+        start = time.perf_counter()
+        fn()
+        if sync:
+            torch.cuda.synchronize()
+        times.append(time.perf_counter() - start)
+    return {'median_s': statistics.median(times), 'min_s': min(times), 'max_s': max(times)}
+
+
+def checkpoint_expression_rate(model, checkpoint, val_csv, max_samples=None, batch_size=16):
+    """
+    Score a model timed with the weights of checkpoint. These are loaded again, which undoes never_stop, and the model
+    decodes up to BASE_CONFIG['max_len'] tokens of images preprocessed like the training images (PREPROCESS_CONFIG),
+    so that the rate matches the one of translator/evaluate.py
+    :param model: VanillaWAP in eval mode
+    :param checkpoint: location of its weights
+    :param val_csv: tab separated file with the image_loc and label columns
+    :param max_samples: number of samples evaluated, None evaluates all of them
+    :param batch_size: number of images translated at once
+    :return: fraction of the expressions translated exactly
+    """
+    model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+    model.config['max_len'] = BASE_CONFIG['max_len']
+    data = pd.read_csv(val_csv, sep='\t')
+    if max_samples:
+        data = data[:max_samples]
+    dataset = ImageDataset(data['image_loc'], data['label'], VOCAB_LOC, device=model.config['DEVICE'],
+                           preprocess=PREPROCESS_CONFIG, stride=model.watch_stride())
+    loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+    return expression_rate(model, loader, dataset.index_to_word)
@@ -0,0 +1,86 @@
+# Speed/accuracy report of a student distilled with train_params['distill_teacher'] against its teacher. Run from the
+# root of the repository:
+#   python -m benchmarks.distillation --teacher checkpoints/model_best.pth \
+#       --student checkpoints/student/model_best.pth --val_csv data/CROHME/val/wap_dataset.csv --threads 1
+import argparse
+import json
+
+import torch
+
+from benchmarks.backbones import count_flops
+from benchmarks.common import checkpoint_expression_rate, make_config, make_model, timeit
+from train.models import EOS_INDEX
+from train.utils.global_params import BASE_CONFIG, STUDENT_CONFIG
+
+
+def measure(name, config, checkpoint, args):
+    """
+    :param name: name of the model in the report
+    :param config: config the model was trained with
+    :param checkpoint: location of its weights, None keeps random weights and skips the expression rate
+    :param args: arguments of the benchmark
+    :return: dictionary of the size, the latency and the expression rate of the model
+    """
+    overrides = {key: value for key, value in config.items() if key not in ('DEVICE', 'train_params')}
+    config = make_config(**dict(overrides, max_len=args.max_len))
+    model = make_model(config).eval()
+    if checkpoint:
+        model.load_state_dict(torch.load(checkpoint, map_location='cpu'))
+        # Keep the decoding length fixed so that the latency does not depend on the weights
+        with torch.no_grad():
+            model.parser['W_o'].bias[EOS_INDEX] = -1e4
+
+    x = (torch.rand(args.batch_size, 1, args.height, args.width) > 0.9).float()
+    mask = torch.ones_like(x)
+    with torch.no_grad():
+        watch = timeit(lambda: model.watch(x, mask), args.repeats)
+        translate = timeit(lambda: model.translate(x, mask=mask), args.repeats)
+
+    entry = {
+        'model': name,
+        'params': sum(p.numel() for p in model.parameters()),
+        'encoder_gflops': count_flops(model.watcher, x) / 1e9 / args.batch_size,
+        'watch_ms': watch['median_s'] * 1e3,
+        'translate_ms': translate['median_s'] * 1e3,
+        'expression_rate': None,
+    }
+    if checkpoint and args.val_csv:
+        entry['expression_rate'] = checkpoint_expression_rate(model, checkpoint, args.val_csv, args.max_samples)
+    return entry
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    report = [measure('teacher', BASE_CONFIG, args.teacher, args),
+              measure('student', STUDENT_CONFIG, args.student, args)]
+    teacher = report[0]
+
+    print(f'{"model":<10}{"params":>12}{"encoder GFLOPs":>16}{"watch (ms)":>12}{"translate (ms)":>16}{"speedup":>9}'
+          f'{"expr rate":>11}')
+    for entry in report:
+        entry['speedup'] = teacher['translate_ms'] / entry['translate_ms']
+        expr = '-' if entry['expression_rate'] is None else f'{entry["expression_rate"]:.3f}'
+        print(f'{entry["model"]:<10}{entry["params"]:>12}{entry["encoder_gflops"]:>16.3f}{entry["watch_ms"]:>12.1f}'
+              f'{entry["translate_ms"]:>16.1f}{entry["speedup"]:>8.2f}x{expr:>11}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'height': args.height, 'width': args.width, 'batch_size': args.batch_size,
+                       'max_len': args.max_len, 'threads': torch.get_num_threads(), 'results': report}, f, indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Size, CPU latency and expression rate of a student and its teacher')
+    parser.add_argument('--teacher', help='weights of the teacher, trained with BASE_CONFIG')
+    parser.add_argument('--student', help='weights of the student, trained with STUDENT_CONFIG')
+    parser.add_argument('--val_csv', help='validation set the expression rate is computed on')
+    parser.add_argument('--max_samples', type=int, default=None, help='number of validation samples evaluated')
+    parser.add_argument('--height', type=int, default=128)
+    parser.add_argument('--width', type=int, default=448)
+    parser.add_argument('--batch_size', type=int, default=1)
+    parser.add_argument('--max_len', type=int, default=50, help='number of decoding steps timed')
+    parser.add_argument('--repeats', type=int, default=5)
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    main(parser.parse_args())
@@ -0,0 +1,264 @@
+# Reproducible benchmark suite of the WAP model. Run from the root of the repository:
+#   python -m benchmarks.run --preset quick --output benchmarks/results.json
+#   python -m benchmarks.run --preset quick --baseline benchmarks/baseline.json
+import argparse
+import json
+import os
+import platform
+import sys
+import tempfile
+
+import numpy as np
+import torch
+import torchvision.transforms as transforms
+from PIL import Image
+from torch.utils.data import DataLoader
+
+from benchmarks.common import make_config, make_model, synthetic_batch, timeit
+from train.utils.datasets import ImageDataset, collate_fn, get_vocabulary
+from train.utils.global_params import VOCAB_LOC
+from train.utils.augmentation import BatchAugmenter
+from train.utils.losses import MaskedCrossEntropy
+
+PRESETS = {
+    'quick': {
+        'image_sizes': [(64, 128), (128, 256)],
+        'seq_lens': [10, 50],
+        'batch_sizes': [1, 4, 16],
+        'repeats': 3,
+        'dataset_size': 64,
+    },
+    'full': {
+        'image_sizes': [(128, 256), (256, 512), (512, 512)],
+        'seq_lens': [10, 50, 200],
+        'batch_sizes': [1, 4, 16, 64],
+        'repeats': 5,
+        'dataset_size': 512,
+    },
+}
+
+
+def result(name, params, value, unit, higher_is_better):
+    return {'name': name, 'params': params, 'value': value, 'unit': unit, 'higher_is_better': higher_is_better}
+
+
+def key(entry):
+    params = ','.join(f'{k}={v}' for k, v in sorted(entry['params'].items()))
+    return f"{entry['name']}[{params}]"
+
+
+def bench_watch(config, preset):
+    """
+    Encoder throughput in images per second for every image size
+    """
+    model = make_model(config).eval()
+    batch_size = 4
+    ret = []
+    for height, width in preset['image_sizes']:
+        x, mask, _ = synthetic_batch(batch_size, height, width, 1, config)
+        with torch.no_grad():
+            t = timeit(lambda: model.watch(x, mask), preset['repeats'], device=config['DEVICE'])
+        ret.append(result('watch_throughput', {'height': height, 'width': width, 'batch_size': batch_size},
+                          batch_size / t['median_s'], 'images/s', True))
+    return ret
+
+
+def bench_parse(config, preset):
+    """
+    Latency of a single decoder step for every batch size
+    """
+    model = make_model(config).eval()
+    height, width = preset['image_sizes'][0]
+    ret = []
+    for batch_size in preset['batch_sizes']:
+        x, mask, y = synthetic_batch(batch_size, height, width, 1, config)
+        with torch.no_grad():
+            features, feature_mask = model.watch(x, mask)
+            alpha_past = torch.zeros_like(feature_mask)
+            _, h_t, alpha_past, _ = model.parse(features, y, None, feature_mask, alpha_past)
+            t = timeit(lambda: model.parse(features, y, h_t, feature_mask, alpha_past), preset['repeats'] * 10,
+                       device=config['DEVICE'])
+        ret.append(result('parse_step_latency', {'height': height, 'width': width, 'batch_size': batch_size},
+                          t['median_s'] * 1e3, 'ms', False))
+    return ret
+
+
+def bench_translate(config, preset):
+    """
+    End to end latency and throughput of translate() for every batch size and expression length
+    """
+    height, width = preset['image_sizes'][0]
+    ret = []
+    for seq_len in preset['seq_lens']:
+        model = make_model(dict(config, max_len=seq_len)).eval()
+        for batch_size in preset['batch_sizes']:
+            x, mask, _ = synthetic_batch(batch_size, height, width, 1, config)
+            with torch.no_grad():
+                t = timeit(lambda: model.translate(x, mask=mask), preset['repeats'], device=config['DEVICE'])
+            params = {'height': height, 'width': width, 'batch_size': batch_size, 'seq_len': seq_len}
+            ret.append(result('translate_latency', params, t['median_s'] * 1e3, 'ms', False))
+            ret.append(result('translate_throughput', params, batch_size / t['median_s'], 'images/s', True))
+    return ret
+
+
+def bench_train_step(config, preset):
+    """
+    Time of VanillaWAP.forward plus backward for every image size and expression length
+    """
+    model = make_model(config).train()
+    criterion = MaskedCrossEntropy()
+    batch_size = 4
+    ret = []
+    for height, width in preset['image_sizes']:
+        for seq_len in preset['seq_lens']:
+            x, mask, y = synthetic_batch(batch_size, height, width, seq_len, config)
+
+            def step():
+                model.zero_grad(set_to_none=True)
+                label_mask = torch.ones_like(y, dtype=torch.float)
+                criterion(model(x, mask, y, target_mask=label_mask), y, label_mask).backward()
+
+            t = timeit(step, preset['repeats'], device=config['DEVICE'])
+            params = {'height': height, 'width': width, 'batch_size': batch_size, 'seq_len': seq_len}
+            ret.append(result('train_step_time', params, t['median_s'] * 1e3, 'ms', False))
+    return ret
+
+
+def bench_augment(config, preset):
+    """
+    Time of the batched augmentation for every image size, to compare with the train step time
+    """
+    augmenter = BatchAugmenter(seed=0)
+    batch_size = 4
+    ret = []
+    for height, width in preset['image_sizes']:
+        x, mask, _ = synthetic_batch(batch_size, height, width, 1, config)
+        t = timeit(lambda: augmenter(x, mask), preset['repeats'], device=config['DEVICE'])
+        ret.append(result('augment_time', {'height': height, 'width': width, 'batch_size': batch_size},
+                          t['median_s'] * 1e3, 'ms', False))
+    return ret
+
+
+def bench_dataset(config, preset):
+    """
+    ImageDataset plus collate_fn throughput in samples per second over synthetic images written to disk
+    """
+    vocab = get_vocabulary(VOCAB_LOC)[2:]
+    rng = np.random.default_rng(0)
+    batch_size = 16
+    ret = []
+    with tempfile.TemporaryDirectory() as tmp:
+        paths, labels = [], []
+        for i in range(preset['dataset_size']):
+            height, width = preset['image_sizes'][i % len(preset['image_sizes'])]
+            image = ((rng.random((height, width)) > 0.9) * 255).astype(np.uint8)
+            path = os.path.join(tmp, f'{i}.png')
+            Image.fromarray(image).save(path)
+            paths.append(path)
+            labels.append(' '.join(rng.choice(vocab, size=preset['seq_lens'][0])))
+
+        dataset = ImageDataset(paths, labels, VOCAB_LOC, device=config['DEVICE'],
+                               transform=transforms.Compose([transforms.ToTensor()]), preprocess=config, stride=16)
+        loader = DataLoader(dataset, batch_size=batch_size, shuffle=False, collate_fn=collate_fn)
+
+        def epoch():
+            for _ in loader:
+                pass
+
+        t = timeit(epoch, preset['repeats'], device=config['DEVICE'])
+        ret.append(result('dataset_throughput', {'batch_size': batch_size, 'num_samples': len(dataset)},
+                          len(dataset) / t['median_s'], 'samples/s', True))
+    return ret
+
+
+BENCHMARKS = {
+    'watch': bench_watch,
+    'parse': bench_parse,
+    'translate': bench_translate,
+    'train_step': bench_train_step,
+    'augment': bench_augment,
+    'dataset': bench_dataset,
+}
+
+
+def compare(results, baseline, tolerance):
+    """
+    :param results: entries of the current run
+    :param baseline: entries of the stored baseline
+    :param tolerance: relative slowdown tolerated before an entry counts as a regression
+    :return: list of the keys that regressed
+    """
+    baseline = {key(entry): entry for entry in baseline}
+    regressions = []
+    print(f'{"benchmark":<90}{"baseline":>12}{"current":>12}{"change":>9}')
+    for entry in results:
+        k = key(entry)
+        if k not in baseline:
+            continue
+        old, new = baseline[k]['value'], entry['value']
+        change = (new - old) / old if old else 0.0
+        regressed = change < -tolerance if entry['higher_is_better'] else change > tolerance
+        flag = '  REGRESSION' if regressed else ''
+        print(f'{k:<90}{old:>12.3f}{new:>12.3f}{change:>+9.1%}{flag}')
+        if regressed:
+            regressions.append(k)
+    return regressions
+
+
+def main(args):
+    preset = PRESETS[args.preset]
+    torch.manual_seed(0)
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    config = make_config(DEVICE=args.device)
+
+    results = []
+    for name in args.only or BENCHMARKS:
+        print(f'Running {name}...')
+        results += BENCHMARKS[name](config, preset)
+
+    report = {
+        'meta': {
+            'preset': args.preset,
+            'device': args.device,
+            'threads': torch.get_num_threads(),
+            'torch': torch.__version__,
+            'python': platform.python_version(),
+            'machine': platform.machine(),
+            'processor': platform.processor(),
+        },
+        'results': results,
+    }
+    for entry in results:
+        print(f'{key(entry):<90}{entry["value"]:>12.3f} {entry["unit"]}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline and os.path.exists(args.baseline) and not args.save_baseline:
+        with open(args.baseline, 'r') as f:
+            baseline = json.load(f)
+        if baseline['meta'] != report['meta']:
+            print('Warning: the baseline was recorded with a different setup', baseline['meta'])
+        regressions = compare(results, baseline['results'], args.tolerance)
+        if regressions:
+            print(f'{len(regressions)} benchmark(s) regressed by more than {args.tolerance:.0%}')
+            sys.exit(1)
+    elif args.baseline:
+        with open(args.baseline, 'w') as f:
+            json.dump(report, f, indent=2)
+        print(f'Baseline written to {args.baseline}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Benchmark suite of the WAP model')
+    parser.add_argument('--preset', choices=PRESETS.keys(), default='quick')
+    parser.add_argument('--only', nargs='+', choices=BENCHMARKS.keys(), help='subset of the benchmarks to run')
+    parser.add_argument('--device', default='cpu')
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    parser.add_argument('--output', help='JSON file to write the results to')
+    parser.add_argument('--baseline', help='JSON baseline to compare against. Written if it does not exist')
+    parser.add_argument('--save_baseline', action='store_true', help='overwrite the baseline with this run')
+    parser.add_argument('--tolerance', type=float, default=0.1, help='relative change counted as a regression')
+    main(parser.parse_args())
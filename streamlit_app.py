@@ -1,12 +1,10 @@
-import base64
 import streamlit as st
 from st_click_detector import click_detector
-from PIL import Image
-import numpy as np
 from translator import inference
-import matplotlib.pyplot as plt
 
 st.set_page_config(page_title='Img2LATeX', page_icon=':pencil2:')
+# Load the model and run a first translation in the background while the page renders
+inference.start_warm_up()
 
 
 # The following functions are copied from https://github.com/vivien000/st-click-detector/issues/4 to display local
@@ -20,7 +18,7 @@ def initialize_state():
     st.session_state['selected_image'] = None
     st.session_state['np_image'] = None
     st.session_state['label'] = None
-    st.session_state['alphas'] = None
+    st.session_state['overlays'] = None
     st.session_state['active_alpha'] = None
     st.session_state['type_input'] = 'From a Pre-Existing Set'
 
@@ -39,24 +37,15 @@ def clean_label(_label):
     return _label
 
 
-def base64img(path: str):
-    """
-    Convert an image to base64
-    :param path: The path to the image
-    """
-    with open(path, 'rb') as f:
-        data = base64.b64encode(f.read()).decode('utf-8')
-        return data
-
-
 def images_html(examples):
     """
-    Create the html for the images
+    Create the html for the images. The thumbnails are encoded once per server, not at every rerun
     :param examples: array of paths to the images
     :return: The html markup for the images insertion
     """
     contents = [
-        f"<a href='#' id='{i}'><img width='180' alt='{examples[i]}' src='data:image/png;base64,{base64img(path)}'></a>"
+        f"<a href='#' id='{i}'><img width='180' alt='{examples[i]}' "
+        f"src='data:image/png;base64,{inference.thumbnail(path)}'></a>"
         for i, path in enumerate(examples)]
     return f'{"&nbsp;" * 2}'.join(contents)
 
@@ -110,21 +99,13 @@ else:
 
 if st.session_state['selected_image'] is not None:
     st.write('### Selected Image:')
-    image = Image.open(st.session_state['selected_image'])
-    numpy_array = np.array(image) / 255.0
-    # Plot the numpy image to matplotlib figure in grayscale
-    fig, ax = plt.subplots()
-    ax.imshow(numpy_array)
-
-    if st.session_state['active_alpha'] is not None:
-        index = st.session_state['active_alpha']
-        expected_shape = list(numpy_array.shape)
-        attention = inference.pass_attention(st.session_state['alphas'][index], expected_shape)
+    # The image and its attention overlays are rendered ahead of time, showing one is only a lookup
+    if st.session_state['active_alpha'] is not None and st.session_state['overlays'] is not None:
+        shown = st.session_state['overlays'][st.session_state['active_alpha']]
         st.session_state['active_alpha'] = None
-        ax.imshow(attention, cmap='gray', alpha=0.4, extent=(0, expected_shape[1], expected_shape[0], 0))
-
-    ax.axis('off')
-    st.pyplot(fig)
+    else:
+        shown = inference.preview(st.session_state['selected_image'])
+    st.image(shown, use_column_width=True)
 
 # Define the translating options
 clicked = st.button('Translate Text')
@@ -133,7 +114,9 @@ if clicked and st.session_state['selected_image'] is not None:
     model = inference.load_model()
     label, alphas = inference.translate(model, st.session_state['selected_image'])
     st.session_state['label'] = label
-    st.session_state['alphas'] = alphas
+    # Render the attention map of every token right away, vectorized over the decoding steps
+    image = inference.load_image(st.session_state['selected_image'])
+    st.session_state['overlays'] = inference.attention_overlays(alphas, image, steps=len(label.split()))
 
 # Define the token display options
 attention_show = st.toggle('Show Attention Map', value=False)
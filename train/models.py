@@ -1,20 +1,330 @@
 # Define the model architectures here
+import collections
 import torch
 from torch import nn
+from torch.utils.checkpoint import checkpoint
 import os
 
+# models is imported as train.models by the translator and as a top-level module by train/train.py
+if __package__:
+    from .utils.profiling import NULL_STAGE
+else:
+    from utils.profiling import NULL_STAGE
+
 SOS_INDEX = 0
 EOS_INDEX = 1
 
+# Image pixels brighter than this are ink, images are white ink on black scaled to [0, 1]
+INK_LEVEL = 0.5
+
+# Context of the sparse attention: only the attended cells of the feature map, packed to the front of each row.
+# index (B, N) holds their raster positions in the feature map, valid (B, N) is False on the padding of the rows with
+# less than N cells, x (B, N, D) and pctx (B, N, A) are the context and its projection at these cells
+PackedContext = collections.namedtuple('PackedContext', ['index', 'valid', 'x', 'pctx', 'shape'])
+
+
+class AttentionMaps:
+    """
+    Compact store of the attention maps produced at every step of translate(). The maps are kept at feature
+    resolution either as float16 or, if topk is set, as the topk largest cells of each map. They are only upsampled to
+    the image resolution when asked for.
+    """
+    def __init__(self, feature_shape, topk=None):
+        """
+        :param feature_shape: (Height, Width) of the feature map the attention is computed over
+        :param topk: number of cells to keep per map. None keeps the dense map in float16
+        """
+        self.feature_shape = tuple(feature_shape)
+        num_cells = self.feature_shape[0] * self.feature_shape[1]
+        self.topk = min(topk, num_cells) if topk else None
+        self.index_dtype = torch.int16 if num_cells <= torch.iinfo(torch.int16).max else torch.int32
+        self.values = []
+        self.indices = []
+
+        # (top, bottom, left, right) of the image region the maps cover, if the image was cropped before translation
+        self.region = None
+        # (Height, Width) of the image before and after its padding to the encoder stride, if it was padded
+        self.image_shape = None
+        self.padded_shape = None
+
+    def __len__(self):
+        return len(self.values)
+
+    def append(self, alpha):
+        """
+        :param alpha: attention weights of one step - (B, Height, Width) or (Height, Width)
+        """
+        alpha = alpha.detach().reshape(-1, self.feature_shape[0] * self.feature_shape[1])
+        if self.topk is None:
+            self.values.append(alpha.half())
+            return
+        values, indices = torch.topk(alpha, self.topk, dim=-1)
+        self.values.append(values.half())
+        self.indices.append(indices.to(self.index_dtype))
+
+    def get(self, step, index=0):
+        """
+        :param step: decoding step of the map
+        :param index: batch item of the map
+        :return: the attention map at feature resolution - (Height, Width) float32
+        """
+        values = self.values[step][index].float()
+        if self.topk is not None:
+            dense = torch.zeros(self.feature_shape[0] * self.feature_shape[1], device=values.device)
+            values = dense.scatter_(0, self.indices[step][index].long(), values)
+        return values.reshape(self.feature_shape)
+
+    def get_all(self, index=0):
+        """
+        :param index: batch item of the maps
+        :return: the attention maps of every step at feature resolution - (L, Height, Width) float32
+        """
+        values = torch.stack([values[index] for values in self.values]).float()
+        if self.topk is not None:
+            dense = values.new_zeros((len(self.values), self.feature_shape[0] * self.feature_shape[1]))
+            indices = torch.stack([indices[index] for indices in self.indices]).long()
+            values = dense.scatter_(1, indices, values)
+        return values.reshape(-1, *self.feature_shape)
+
+    def upsample(self, step, size, index=0):
+        """
+        :param step: decoding step of the map
+        :param size: (Height, Width) to upsample the map to, usually the image size
+        :param index: batch item of the map
+        :return: numpy array of the given size
+        """
+        return self.fit(self.get(step, index).unsqueeze(0), size)[0]
+
+    def upsample_all(self, size, index=0, steps=None, scale=1.):
+        """
+        Upsample the maps of every step at once
+        :param size: (Height, Width) to upsample the maps to, usually the image size
+        :param index: batch item of the maps
+        :param steps: number of steps upsampled, None upsamples them all
+        :param scale: factor applied to size, e.g. to render the maps at the size the image is displayed at
+        :return: numpy array - (L, Height * scale, Width * scale)
+        """
+        return self.fit(self.get_all(index)[:steps], size, scale)
+
+    def fit(self, alpha, size, scale=1.):
+        """
+        :param alpha: attention maps at feature resolution - (N, Height, Width)
+        :param size: (Height, Width) of the image
+        :param scale: factor applied to the size of the image and to the region it was cropped from
+        :return: numpy array of the maps over the image - (N, Height * scale, Width * scale)
+        """
+        region = self.region if self.region is not None else (0, size[0], 0, size[1])
+        size = tuple(max(1, round(side * scale)) for side in size[:2])
+        alpha = alpha.unsqueeze(1)
+        top, bottom, left, right = (round(bound * scale) for bound in region)
+        target = (max(1, bottom - top), max(1, right - left))
+        if self.padded_shape is None:
+            alpha = nn.functional.interpolate(alpha, size=target)[:, 0].cpu()
+        else:
+            # The maps also cover the padding of the image: upsample past the target and cut the padding off
+            scaled = [round(t * p / i) for t, p, i in zip(target, self.padded_shape, self.image_shape)]
+            alpha = nn.functional.interpolate(alpha, size=scaled)[:, 0, :target[0], :target[1]].cpu()
+        if self.region is None:
+            return alpha.numpy()
+
+        # Paste the cropped region into the full image
+        ret = torch.zeros((alpha.shape[0], *size))
+        ret[:, top:top + target[0], left:left + target[1]] = alpha[:, :size[0] - top, :size[1] - left]
+        return ret.numpy()
+
+    def nbytes(self):
+        """
+        :return: number of bytes held by the stored maps
+        """
+        return sum(t.element_size() * t.nelement() for t in self.values + self.indices)
+
+
+# Encoder backbones, selected by config['backbone']. A backbone is built from the config and returns the watcher, a
+# sequence of config['num_blocks'] blocks that each halve the resolution, along with its number of output channels D
+BACKBONES = {}
+
+
+def register_backbone(name):
+    def wrap(build):
+        BACKBONES[name] = build
+        return build
+    return wrap
+
+
+@register_backbone('vgg')
+def vgg_backbone(config):
+    """
+    VGG-style stack of full 3x3 convolutions described by the num_layers, num_features_map, ... keys of the config
+    :return: the watcher and D
+    """
+    # Sequential model
+    watcher = nn.Sequential()
+
+    # Kernel Dimension of each layer
+    # layer_dims = [config['input_channels']] + config['num_features_map']
+    for i in range(config['num_blocks']):
+        curr_block = nn.Sequential()
+        for j in range(config['num_layers'][i]):
+            # Convolutional Layer
+            curr_layer = nn.Sequential()
+            if j == 0:
+                if i == 0:
+                    cin = config['input_channels']
+                else:
+                    cin = config['num_features_map'][i - 1][-1]
+            else:
+                cin = config['num_features_map'][i][-1]
+            cout = config['num_features_map'][i][j]
+
+            curr_layer.add_module(f'conv2d', nn.Conv2d(cin, cout,
+                                                       config['feature_kernel_size'][i][j],
+                                                       config['feature_kernel_stride'][i][j],
+                                                       config['feature_padding'][i][j]))
+
+            # Dropout Layer
+            if config['conv_dropout'][i][j] != 0:
+                curr_layer.add_module('conv_dropout2d', nn.Dropout2d(p=config['conv_dropout'][i][j]))
+
+            # Activation Function
+            curr_layer.add_module('relu{}', nn.ReLU())
+
+            # Max Pooling if required
+            if config['feature_pooling_kernel_size'][i][j]:
+                curr_layer.add_module('maxpool2d', nn.MaxPool2d(config['feature_pooling_kernel_size'][i][j],
+                                                                config['feature_pooling_stride'][i][j]))
+            # Batch Normalization if required
+            if config['batch_norm'][i][j]:
+                curr_layer.add_module('batchnorm2d', nn.BatchNorm2d(cout))
+
+            curr_block.add_module(f'layer{j + 1}', curr_layer)
+        watcher.add_module(f'block{i + 1}', curr_block)
+    return watcher, config['num_features_map'][-1][-1]
+
+
+@register_backbone('separable')
+def separable_backbone(config):
+    """
+    Same layout as vgg_backbone, with every convolution but the first replaced by a depthwise 3x3 convolution followed
+    by a pointwise 1x1 convolution, which cuts the FLOPs and the parameters of a layer by about 8x
+    :return: the watcher and D
+    """
+    watcher = nn.Sequential()
+    cin = config['input_channels']
+    for i in range(config['num_blocks']):
+        curr_block = nn.Sequential()
+        for j in range(config['num_layers'][i]):
+            cout = config['num_features_map'][i][j]
+            k, stride, padding = (config['feature_kernel_size'][i][j], config['feature_kernel_stride'][i][j],
+                                  config['feature_padding'][i][j])
+            curr_layer = nn.Sequential()
+            if i == 0 and j == 0:
+                curr_layer.add_module('conv2d', nn.Conv2d(cin, cout, k, stride, padding))
+            else:
+                curr_layer.add_module('depthwise', nn.Conv2d(cin, cin, k, stride, padding, groups=cin))
+                curr_layer.add_module('pointwise', nn.Conv2d(cin, cout, 1))
+            if config['conv_dropout'][i][j] != 0:
+                curr_layer.add_module('conv_dropout2d', nn.Dropout2d(p=config['conv_dropout'][i][j]))
+            curr_layer.add_module('relu', nn.ReLU())
+            if config['feature_pooling_kernel_size'][i][j]:
+                curr_layer.add_module('maxpool2d', nn.MaxPool2d(config['feature_pooling_kernel_size'][i][j],
+                                                                config['feature_pooling_stride'][i][j]))
+            if config['batch_norm'][i][j]:
+                curr_layer.add_module('batchnorm2d', nn.BatchNorm2d(cout))
+            curr_block.add_module(f'layer{j + 1}', curr_layer)
+            cin = cout
+        watcher.add_module(f'block{i + 1}', curr_block)
+    return watcher, cin
+
+
+class DenseLayer(nn.Module):
+    """
+    Bottleneck layer of a DenseNet: BN-ReLU-Conv1x1-BN-ReLU-Conv3x3, whose growth_rate output channels are
+    concatenated to its input
+    """
+    def __init__(self, cin, growth_rate, dropout=0.0):
+        super().__init__()
+        self.layer = nn.Sequential(
+            nn.BatchNorm2d(cin), nn.ReLU(), nn.Conv2d(cin, 4 * growth_rate, 1, bias=False),
+            nn.BatchNorm2d(4 * growth_rate), nn.ReLU(),
+            nn.Conv2d(4 * growth_rate, growth_rate, 3, padding=1, bias=False))
+        self.dropout = nn.Dropout2d(p=dropout) if dropout else nn.Identity()
+
+    def forward(self, x):
+        return torch.cat([x, self.dropout(self.layer(x))], dim=1)
+
+
+@register_backbone('dense')
+def dense_backbone(config):
+    """
+    DenseNet-style encoder as in DenseWAP: every block stacks config['dense_layers'][i] DenseLayers and ends with a
+    transition, a 1x1 convolution compressing the channels by config['dense_compression'] and a 2x2 average pooling.
+    The first block halves the resolution with a strided stem instead, so that no dense layer runs at full resolution
+    :return: the watcher and D
+    """
+    growth_rate = config.get('dense_growth_rate', 24)
+    compression = config.get('dense_compression', 0.5)
+    dropout = config.get('dense_dropout', 0.2)
+    num_layers = config.get('dense_layers', [4] * config['num_blocks'])
+    watcher = nn.Sequential()
+    cin = 2 * growth_rate
+    for i in range(config['num_blocks']):
+        curr_block = nn.Sequential()
+        if i == 0:
+            curr_block.add_module('stem', nn.Conv2d(config['input_channels'], cin, 3, stride=2, padding=1, bias=False))
+        for j in range(num_layers[i]):
+            curr_block.add_module(f'layer{j + 1}', DenseLayer(cin, growth_rate, dropout))
+            cin += growth_rate
+        cout = int(cin * compression)
+        transition = [nn.BatchNorm2d(cin), nn.ReLU(), nn.Conv2d(cin, cout, 1, bias=False)]
+        curr_block.add_module('transition', nn.Sequential(*transition, *([nn.AvgPool2d(2)] if i > 0 else [])))
+        watcher.add_module(f'block{i + 1}', curr_block)
+        cin = cout
+    return watcher, cin
+
+
+def checkpoint_module(module, x):
+    """
+    Checkpoint a module without reentrant autograd. Its forward is run again during backward, where the batch norm
+    layers it contains would update their running statistics a second time, so these are restored after every
+    recomputation
+    :param module: nn.Module taking a single tensor
+    :param x: input of the module
+    :return: output of the module
+    """
+    layers = [layer for layer in module.modules() if isinstance(layer, nn.BatchNorm2d)]
+    calls = []
+
+    def run(x):
+        calls.append(True)
+        if len(calls) == 1:
+            return module(x)
+        buffers = [buffer for layer in layers for buffer in layer.buffers()]
+        saved = [buffer.clone() for buffer in buffers]
+        try:
+            return module(x)
+        finally:
+            with torch.no_grad():
+                for buffer, value in zip(buffers, saved):
+                    buffer.copy_(value)
+
+    return checkpoint(run, x, use_reentrant=False)
+
+
 class VanillaWAP(nn.Module):
     def __init__(self, config):
         super().__init__()
         self.watcher = None
+        self.feature_dim = None
         self.embedder = None
         self.positional_encoder = None
         self.parser = None
         self.config = config
 
+        # Optional Profiler (see utils/profiling.py) timing the watch and parse stages
+        self.profiler = None
+        # Optional LatexGrammar (see utils/grammar.py) constraining the tokens translate() can emit
+        self.grammar = None
+
         self.generate_watcher()
         # self.generate_positional_encoder()
         self.generate_embedder()
@@ -24,10 +334,21 @@ class VanillaWAP(nn.Module):
         if config['train_params']['load']:
             self.load()
 
-    def forward(self, x, mask, target, gen_viz=False):
-        # CNN Feature Extraction
+    def forward(self, x, mask, target, gen_viz=False, encoded=False, target_mask=None, sampling_prob=0.0,
+                return_alphas=False):
+        # CNN Feature Extraction. If encoded is True, x and mask are cached watch() outputs (see utils/feature_cache.py)
+        # If target_mask is given, only the logits of its non-pad positions are computed and returned packed - (N, V)
+        # If sampling_prob is positive, every step is fed the previous prediction instead of the ground truth with that
+        # probability (scheduled sampling), using the decode loop of translate()
+        # If return_alphas is True, the attention weights of every step are returned as well, packed like the logits
+        # (N, Height, Width) or (B, L, Height, Width)
         max_len = target.shape[1]
-        x, feature_mask = self.watch(x, mask)
+        image = None if encoded else x
+        if encoded:
+            feature_mask = mask
+        else:
+            with self.stage('watch'):
+                x, feature_mask = self.watch(x, mask)
 
         # # Positional Encoding
         # # x = x + self.positional_encoder
@@ -36,111 +357,183 @@ class VanillaWAP(nn.Module):
         # feature_mask = torch.reshape(feature_mask, (feature_mask.shape[0], feature_mask.shape[1], -1))
         # feature_mask = feature_mask.permute(0, 2, 1)
 
-        # RNN Decoder
-
-        y = SOS_INDEX * torch.ones((x.shape[0], 1)).long().to(self.config['DEVICE'])
-        logit = torch.zeros((x.shape[0], max_len, self.config['vocab_size'])).to(self.config['DEVICE'])
+        if sampling_prob > 0:
+            alphas = [] if return_alphas else None
+            logit, _ = self.decode(x, feature_mask, max_len, target=target, sampling_prob=sampling_prob, alphas=alphas,
+                                   image=image)
+            batch_size = target.shape[0]
+            alphas = torch.stack([alpha.view(batch_size, *alpha.shape[-2:]) for alpha in alphas], dim=1) \
+                if return_alphas else None
+            return self.pack_outputs(logit, alphas, target_mask)
+
+        # RNN Decoder. Under teacher forcing the inputs of every step are known in advance, so the embedding, its
+        # projections and the output layer are computed for the whole sequence at once, and only the recurrent core
+        # runs step by step
+        sos = torch.full((target.shape[0], 1), SOS_INDEX, dtype=torch.long, device=target.device)
+        y = torch.cat([sos, target[:, :max_len - 1]], dim=1)  # (B, L)
+        state_below = self.embedder(y)  # (B, L, E)
+        state_below_ = self.parser['W'](state_below)  # (B, L, 2H)
+        state_belowx = self.parser['Wx'](state_below)  # (B, L, H)
+        logit_ey = self.parser['W_yo'](state_below)  # (B, L, E)
+
+        attention_mask, pctx = self.attention_context(x, feature_mask, image)
+        h_t = self.init_hidden(x, feature_mask)
         alpha_past = torch.zeros_like(feature_mask).to(self.config['DEVICE'])
 
-        # logit[:, 0, 2] = 0
-        # While all y are not index = EOS_INDEX and max length is not reached
-        h_t = None
-        for i in range(max_len):
-
-            if i > 0:
-                if i >= target.shape[1]:
-                    break
-                y = target[:, i - 1].unsqueeze(1)
-
-            # Embedding
-            logit_t, h_t, alpha_past, alpha = self.parse(x, y, h_t, feature_mask, alpha_past)
-            logit[:, i, :] = logit_t.squeeze()
-            # y = torch.argmax(logit_t.squeeze(), dim=1)
-
-            # if all y are index = EOS_INDEX, break
-            # if torch.all(y == EOS_INDEX):
-            #     break
-
-        return logit
+        def run_steps(start, end, h_t, alpha_past):
+            hs, cs, alphas = [], [], []
+            for i in range(start, end):
+                with self.stage('parse'):
+                    h_t, c_t, alpha_past, alpha = self.recurrent_step(x, state_below_[:, i], state_belowx[:, i], h_t,
+                                                                      attention_mask, alpha_past, pctx)
+                hs.append(h_t)
+                cs.append(c_t)
+                if return_alphas:
+                    # attend() squeezes the batch dimension of a single image
+                    alphas.append(alpha.view(h_t.shape[0], *alpha.shape[-2:]))
+            alphas = torch.stack(alphas, dim=1) if return_alphas else None
+            return torch.stack(hs, dim=1), torch.stack(cs, dim=1), alphas, h_t, alpha_past
+
+        # With activation checkpointing, the steps run in chunks whose activations are recomputed during backward
+        # instead of being kept, so that the memory of the decoder does not grow with max_len
+        chunk = self.config['train_params'].get('checkpoint_decoder_chunk', 0) if self.checkpointing() else 0
+        hs, cs, alphas = [], [], []
+        for start in range(0, max_len, chunk or max_len):
+            end = min(start + (chunk or max_len), max_len)
+            if chunk:
+                h_chunk, c_chunk, alpha_chunk, h_t, alpha_past = checkpoint(run_steps, start, end, h_t, alpha_past,
+                                                                            use_reentrant=False)
+            else:
+                h_chunk, c_chunk, alpha_chunk, h_t, alpha_past = run_steps(start, end, h_t, alpha_past)
+            hs.append(h_chunk)
+            cs.append(c_chunk)
+            alphas.append(alpha_chunk)
+
+        cs, hs = torch.cat(cs, dim=1), torch.cat(hs, dim=1)
+        alphas = torch.cat(alphas, dim=1) if return_alphas else None
+        if target_mask is not None:
+            packed = target_mask.bool()
+            logit = self.output_layer(cs[packed], hs[packed], logit_ey[packed])  # (N, V)
+            return (logit, alphas[packed]) if return_alphas else logit
+        logit = self.output_layer(cs, hs, logit_ey)  # (B, L, V)
+        return (logit, alphas) if return_alphas else logit
+
+    @staticmethod
+    def pack_outputs(logit, alphas, target_mask):
+        """
+        :return: the logits and, if alphas is not None, the attention weights of the non-pad positions of target_mask
+        """
+        if target_mask is not None:
+            packed = target_mask.bool()
+            logit = logit[packed]
+            alphas = alphas[packed] if alphas is not None else None
+        return (logit, alphas) if alphas is not None else logit
 
-    def translate(self, x, beam_width=10, mask=None):
+    def translate(self, x, beam_width=10, mask=None, return_alphas=None, encoded=False, grammar=None, cancel=None):
         """
         Translate the input image to the corresponding latex
-        :return:
+        :param return_alphas: whether to capture the attention maps of every step. Defaults to config['store_attention']
+        :param encoded: whether x and mask are already the outputs of watch()
+        :param grammar: LatexGrammar the output has to follow, defaults to self.grammar. None leaves it unconstrained
+        :param cancel: optional threading.Event, the decoding stops early once it is set
+        :return: the predicted tokens and an AttentionMaps store, or None if the attention is not captured
         """
         # CNN Feature Extraction
         max_len = self.config['max_len']
-        x, feature_mask = self.watch(x, mask)
+        image = None if encoded else x
+        if encoded:
+            feature_mask = mask
+        else:
+            with self.stage('watch'):
+                x, feature_mask = self.encode(x, mask)
 
         # RNN Decoder
+        if return_alphas is None:
+            return_alphas = self.config.get('store_attention', False)
+        ret_alphas = AttentionMaps(x.shape[-2:], self.config.get('attention_topk')) if return_alphas else None
+        grammar = grammar if grammar is not None else self.grammar
+        _, ret = self.decode(x, feature_mask, max_len, alphas=ret_alphas, image=image, grammar=grammar, cancel=cancel)
+
+        if self.profiler is not None:
+            # Rows count their tokens up to and including their first <EOS>, the rest is padding of the batch
+            eos = (ret == EOS_INDEX).long()
+            self.profiler.add_tokens((eos.cumsum(dim=-1) - eos == 0).sum())
+        # A single image keeps its 1-D token sequence
+        return (ret.squeeze(0) if x.shape[0] == 1 else ret), ret_alphas
+
+    def decode(self, x, feature_mask, max_len, target=None, sampling_prob=0.0, alphas=None, image=None, grammar=None,
+               cancel=None):
+        """
+        Step by step decoding of a batch, shared by translate() and the scheduled sampling mode of forward(). Every step
+        is fed the prediction of the previous one. Given a target, it is fed the ground truth token instead with
+        probability 1 - sampling_prob, and the loop runs for max_len steps rather than stopping at EOS
+        :param x: feature map - (B, D, Height, Width)
+        :param feature_mask: mask of the feature map - (B, 1, Height, Width)
+        :param max_len: maximum number of steps
+        :param target: ground truth tokens - (B, L), or None to decode freely
+        :param sampling_prob: probability of feeding the prediction rather than the ground truth when target is given
+        :param alphas: optional AttentionMaps, or list, the attention weights of every step are appended to
+        :param image: the images x was computed from, see attention_context
+        :param grammar: LatexGrammar masking the tokens that would break the latex structure when decoding freely
+        :param cancel: optional threading.Event checked after every step, the decoding stops early once it is set
+        :return: the logits (B, L, V) and the predicted tokens (B, L)
+        """
+        batch_size = x.shape[0]
+        y = torch.full((batch_size,), SOS_INDEX, dtype=torch.long, device=x.device)
+        alpha_past = torch.zeros_like(feature_mask)
+        attention_mask, pctx = self.attention_context(x, feature_mask, image)
+        h_t = self.init_hidden(x, feature_mask)
+        state = grammar.start(batch_size, x.device) if grammar is not None and target is None else None
+        logits, tokens = [], []
+        for i in range(max_len):
+            with self.stage('parse'):
+                logit_t, h_t, alpha_past, alpha = self.parse(x, y, h_t, attention_mask, alpha_past, pctx=pctx)
+            logit_t = logit_t.reshape(batch_size, -1)  # (B, V)
+            if state is not None:
+                # Only the tokens that keep the latex well formed, and can still reach EOS within max_len
+                logit_t = grammar.constrain(logit_t, state, max_len - i)
+            prediction = torch.argmax(logit_t, dim=-1)  # (B)
+            if state is not None:
+                state = grammar.advance(state, prediction)
+            logits.append(logit_t)
+            tokens.append(prediction)
+            if alphas is not None:
+                alphas.append(alpha)
+
+            if cancel is not None and cancel.is_set():
+                break
+            if target is None:
+                # Stop once every sequence has produced EOS
+                if torch.all(prediction == EOS_INDEX):
+                    break
+                y = prediction
+            else:
+                sampled = torch.rand(batch_size, device=x.device) < sampling_prob
+                y = torch.where(sampled, prediction, target[:, i])
 
-        y = SOS_INDEX * torch.ones((x.shape[0], 1)).long().to(self.config['DEVICE'])
-        ret = []
-        ret_alphas = []
-        alpha_past = torch.zeros_like(feature_mask).to(self.config['DEVICE'])
+        return torch.stack(logits, dim=1), torch.stack(tokens, dim=1)
 
-        # logit[:, 0, 2] = 0
-        # While all y are not index = EOS_INDEX and max length is not reached
-        h_t = None
-        for i in range(max_len):
+    def checkpointing(self):
+        """
+        :return: whether activation checkpointing can apply, i.e. the model is training with gradients enabled
+        """
+        return self.training and torch.is_grad_enabled()
 
-            # Embedding
-            logit_t, h_t, alpha_past, alpha = self.parse(x, y, h_t, feature_mask, alpha_past)
-            y = torch.argmax(logit_t.squeeze(), dim=-1)
-            ret.append(y)
-            ret_alphas.append(alpha)
+    def stage(self, name):
+        """
+        :param name: name of the stage being timed
+        :return: the profiler's timing context, or a shared null context when no profiler is attached
+        """
+        if self.profiler is None:
+            return NULL_STAGE
+        return self.profiler.stage(name)
 
-            # if all y are index = EOS_INDEX, break
-            if torch.all(y == EOS_INDEX):
-                break
-        return torch.stack(ret, dim=-1), ret_alphas
     def generate_watcher(self):
         """
-        Generate the model based on the config
+        Generate the encoder selected by config['backbone'] (see BACKBONES)
         :return: None
         """
-        # Sequential model
-        self.watcher = nn.Sequential()
-
-        # Kernel Dimension of each layer
-        # layer_dims = [self.config['input_channels']] + self.config['num_features_map']
-        for i in range(self.config['num_blocks']):
-            curr_block = nn.Sequential()
-            for j in range(self.config['num_layers'][i]):
-                # Convolutional Layer
-                curr_layer = nn.Sequential()
-                if j == 0:
-                    if i == 0:
-                        cin = self.config['input_channels']
-                    else:
-                        cin = self.config['num_features_map'][i - 1][-1]
-                else:
-                    cin = self.config['num_features_map'][i][-1]
-                cout = self.config['num_features_map'][i][j]
-
-                curr_layer.add_module(f'conv2d', nn.Conv2d(cin, cout,
-                                                           self.config['feature_kernel_size'][i][j],
-                                                           self.config['feature_kernel_stride'][i][j],
-                                                           self.config['feature_padding'][i][j]))
-
-                # Dropout Layer
-                if self.config['conv_dropout'][i][j] != 0:
-                    curr_layer.add_module('conv_dropout2d', nn.Dropout2d(p=self.config['conv_dropout'][i][j]))
-
-                # Activation Function
-                curr_layer.add_module('relu{}', nn.ReLU())
-
-                # Max Pooling if required
-                if self.config['feature_pooling_kernel_size'][i][j]:
-                    curr_layer.add_module('maxpool2d', nn.MaxPool2d(self.config['feature_pooling_kernel_size'][i][j],
-                                                                    self.config['feature_pooling_stride'][i][j]))
-                # Batch Normalization if required
-                if self.config['batch_norm'][i][j]:
-                    curr_layer.add_module('batchnorm2d', nn.BatchNorm2d(cout))
-
-                curr_block.add_module(f'layer{j + 1}', curr_layer)
-            self.watcher.add_module(f'block{i + 1}', curr_block)
-
+        self.watcher, self.feature_dim = BACKBONES[self.config.get('backbone', 'vgg')](self.config)
         self.watcher.to(self.config['DEVICE'])
 
     def generate_embedder(self):
@@ -157,7 +550,7 @@ class VanillaWAP(nn.Module):
         :return:
         """
 
-        D = self.config['num_features_map'][-1][-1]
+        D = self.feature_dim
 
         self.parser = nn.ModuleDict({
 
@@ -204,18 +597,18 @@ class VanillaWAP(nn.Module):
 
         self.parser.to(self.config['DEVICE'])
 
-    def parse(self, x, y, h_t_1=None, feature_mask=None, alpha_past=None, alpha=None):
+    def parse(self, x, y, h_t_1=None, feature_mask=None, alpha_past=None, alpha=None, pctx=None):
         """
         x is of shape (batch_size, num_features_map[-1], 1, output_dim[0]*output_dim[1]) - (B, D, 1, L)
         y is of shape (batch_size, vocab) - (B, V)
         h_t_1 is of shape (batch_size, hidden_dim) - (B, H)
         o_t_1 is of shape (batch_size, hidden_dim) - (B, H)
+        pctx is the optional output of project_context(x), computed once per image instead of once per step
         """
 
         # Compute the initial hidden
         if h_t_1 is None:
-            ctx_mean = torch.einsum('...hw, ...hw -> ...', feature_mask, x) / torch.einsum('...hw -> ...', feature_mask)
-            h_t_1 = torch.tanh(self.parser['W_2h'](ctx_mean))  # (B, H)
+            h_t_1 = self.init_hidden(x, feature_mask)
 
         # Compute the attention weights and context vector
         state_below = self.embedder(y).squeeze()  # (B, E)
@@ -224,6 +617,89 @@ class VanillaWAP(nn.Module):
         state_below_ = self.parser['W'](state_below)  # (B, 2H)
         state_belowx = self.parser['Wx'](state_below)  # (B, H)
 
+        ht, ct, alpha_past, alpha_t = self.recurrent_step(x, state_below_, state_belowx, h_t_1, feature_mask,
+                                                          alpha_past, pctx)
+
+        # Compute the output
+        o_t = self.output_layer(ct, ht, self.parser['W_yo'](state_below))  # (B, V)
+
+        return o_t, ht, alpha_past, alpha_t
+
+    def init_hidden(self, x, feature_mask):
+        """
+        :return: the initial hidden state computed from the mean of the context - (B, H)
+        """
+        ctx_mean = torch.einsum('...hw, ...hw -> ...', feature_mask, x) / torch.einsum('...hw -> ...', feature_mask)
+        return torch.tanh(self.parser['W_2h'](ctx_mean))  # (B, H)
+
+    def project_context(self, x):
+        """
+        :return: the context projected to the attention dimension - (B, A, Height, Width)
+        """
+        return self.parser['Wc_att'](x)
+
+    def attention_context(self, x, feature_mask, image=None):
+        """
+        Everything the attention needs from the feature map, computed once per image rather than once per step. With
+        config['attention_ink_only'] the attention is restricted to the cells near ink, and with
+        config['attention_mode'] == 'sparse' it is only computed over the attended cells (see pack_context)
+        :param x: feature map - (B, D, Height, Width)
+        :param feature_mask: mask of the feature map - (B, 1, Height, Width)
+        :param image: the images x was computed from - (B, 1, H, W). None, e.g. for cached features, attends to the
+        whole mask
+        :return: the mask of the attended cells (B, 1, Height, Width), and the projected context: (B, A, Height, Width)
+        in dense mode or a PackedContext in sparse mode
+        """
+        attention_mask = feature_mask
+        if self.config.get('attention_ink_only') and image is not None:
+            attention_mask = self.ink_cells(image, feature_mask, self.config.get('ink_dilation', 1))
+        if self.config.get('attention_mode', 'dense') == 'sparse':
+            return attention_mask, self.pack_context(x, attention_mask)
+        return attention_mask, self.project_context(x)
+
+    def ink_cells(self, image, feature_mask, dilation=1):
+        """
+        :param image: images with bright ink - (B, 1, H, W)
+        :param feature_mask: mask of the feature map - (B, 1, Height, Width)
+        :param dilation: number of cells kept around the cells holding ink
+        :return: feature_mask restricted to the cells within dilation of ink, or feature_mask itself for an image
+        without ink - (B, 1, Height, Width)
+        """
+        stride = self.watch_stride()
+        ink = nn.functional.max_pool2d((image > INK_LEVEL).float(), stride, ceil_mode=True)
+        if dilation:
+            ink = nn.functional.max_pool2d(ink, 2 * dilation + 1, stride=1, padding=dilation)
+        ink = ink[:, :, :feature_mask.shape[2], :feature_mask.shape[3]] * feature_mask
+        has_ink = ink.flatten(1).any(dim=1).view(-1, 1, 1, 1)
+        return torch.where(has_ink, ink, feature_mask)
+
+    def pack_context(self, x, attention_mask):
+        """
+        Gather the attended cells of the feature map into a (B, N, D) layout, N being the largest number of attended
+        cells of an image, and project them to the attention dimension
+        :param x: feature map - (B, D, Height, Width)
+        :param attention_mask: mask of the attended cells - (B, 1, Height, Width)
+        :return: PackedContext
+        """
+        flat = attention_mask.flatten(1) != 0  # (B, Height * Width)
+        counts = flat.sum(dim=1)
+        num_cells = int(counts.max())
+        # Attended cells first, in raster order
+        index = torch.argsort((~flat).to(torch.uint8), dim=1, stable=True)[:, :num_cells]  # (B, N)
+        valid = torch.arange(num_cells, device=x.device).unsqueeze(0) < counts.unsqueeze(1)  # (B, N)
+        packed = torch.gather(x.flatten(2), 2, index.unsqueeze(1).expand(-1, x.shape[1], -1)).transpose(1, 2)
+        # Wc_att is a 1x1 convolution, i.e. a linear layer over the cells
+        weight = self.parser['Wc_att'].weight.flatten(1)  # (A, D)
+        pctx = nn.functional.linear(packed, weight, self.parser['Wc_att'].bias)  # (B, N, A)
+        return PackedContext(index, valid, packed, pctx, tuple(x.shape[-2:]))
+
+    def recurrent_step(self, x, state_below_, state_belowx, h_t_1, feature_mask, alpha_past, pctx=None):
+        """
+        The part of a decoder step that depends on the recurrence: the first GRU, the coverage attention and the second
+        GRU. The input projections of the embedding, state_below_ = W(E y) and state_belowx = Wx(E y), are computed by
+        the caller so that they can be batched over a whole target sequence.
+        :return: the hidden state ht (B, H), the context ct (B, D), the attention history and the attention weights
+        """
         # Compute the preactivation and split it into r and u of size (B, H)
         preact = torch.sigmoid(self.parser['U'](h_t_1) + state_below_)   # (B, 2H)
         r, u = preact[..., :self.config['hidden_dim']], preact[..., self.config['hidden_dim']:]   # (B, H)
@@ -234,9 +710,28 @@ class VanillaWAP(nn.Module):
         h1 = u * h_t_1 + (1. - u) * h_tilde  # (B, H)
 
         # Compute the Needed Context
+        if isinstance(pctx, PackedContext):
+            ct, alpha_past, alpha_t = self.attend_packed(h1, pctx, alpha_past)
+        else:
+            ct, alpha_past, alpha_t = self.attend(x, h1, feature_mask, alpha_past, pctx)
+
+        # Layer two Computation
+        preactivation2 = torch.sigmoid(self.parser['U_nl'](h1) + self.parser['Wc'](ct))   # (B, 2*H)
+        r2, u2 = preactivation2[..., :self.config['hidden_dim']], preactivation2[..., self.config['hidden_dim']:]   # (B, H)
+
+        h_tilde = torch.tanh(r2 * self.parser['Ux_nl'](h1) + self.parser['Wcx'](ct))  # (B, H)
+
+        ht = u2 * h1 + (1. - u2) * h_tilde  # (B, H)
+
+        return ht, ct, alpha_past, alpha_t
 
+    def attend(self, x, h1, feature_mask, alpha_past, pctx=None):
+        """
+        Coverage attention over every cell of the feature map
+        :return: the context ct (B, D), the attention history and the attention weights (B, Height, Width)
+        """
         # Project the Context and the state to the attention dimension
-        pctx_ = self.parser['Wc_att'](x)  # (B, A, Height, Width)
+        pctx_ = self.project_context(x) if pctx is None else pctx  # (B, A, Height, Width)
         pstate_ = self.parser['W_comb_att'](h1).unsqueeze(-1).unsqueeze(-1)  # (B, A, 1, 1)
 
         # Compute the coverage
@@ -262,25 +757,55 @@ class VanillaWAP(nn.Module):
         # compute attention
         pctx__ = torch.tanh(pctx_ + pstate_ + cover_vector)
         pctx__ = torch.transpose(torch.transpose(pctx__, -2, -1), -3, -1)  # (B, Height, Width, A)
-        alpha = torch.exp(self.parser['U_att'](pctx__).squeeze() + torch.where(feature_mask == 0, -torch.inf, 0).squeeze()) # (B, Height, Width)
-        alpha_t = alpha / torch.einsum('...hw -> ...', alpha).unsqueeze(-1).unsqueeze(-1)  # (B, Height, Width)
+        energy = self.parser['U_att'](pctx__).squeeze() + torch.where(feature_mask == 0, -torch.inf, 0).squeeze()
+        # Softmax over the cells, which subtracts the largest energy before the exp so that it cannot overflow
+        alpha_t = torch.softmax(energy.flatten(-2), dim=-1).view(energy.shape)  # (B, Height, Width)
         alpha_past = alpha_past + alpha_t.unsqueeze(-3)  # (B, 1, Height, Width)
 
         # Compute Context
         ct = torch.einsum('...hw, ...dhw -> ...d', alpha_t, x)  # (B, D) or (Beam_width, B, D)
+        return ct, alpha_past, alpha_t
 
-        # Layer two Computation
-        preactivation2 = torch.sigmoid(self.parser['U_nl'](h1) + self.parser['Wc'](ct))   # (B, 2*H)
-        r2, u2 = preactivation2[..., :self.config['hidden_dim']], preactivation2[..., self.config['hidden_dim']:]   # (B, H)
+    def attend_packed(self, h1, packed, alpha_past):
+        """
+        Coverage attention over the attended cells of a PackedContext only. The coverage convolution is evaluated at
+        these cells from the patches of the dense attention history, and the weights are scattered back into it.
+        :return: the context ct (B, D), the attention history and the attention weights (B, Height, Width)
+        """
+        batch_size, num_cells = packed.index.shape
+        pstate_ = self.parser['W_comb_att'](h1).reshape(batch_size, 1, -1)  # (B, 1, A)
 
-        h_tilde = torch.tanh(r2 * self.parser['Ux_nl'](h1) + self.parser['Wcx'](ct))  # (B, H)
+        # Compute the coverage at the attended cells
+        conv_q = self.parser['conv_q']
+        kernel = conv_q.kernel_size
+        patches = nn.functional.unfold(alpha_past, kernel, padding=(kernel[0] // 2, kernel[1] // 2))  # (B, K, HW)
+        patches = torch.gather(patches, 2, packed.index.unsqueeze(1).expand(-1, patches.shape[1], -1))  # (B, K, N)
+        cover_F = torch.einsum('bkn, qk -> bnq', patches, conv_q.weight.flatten(1)) + conv_q.bias  # (B, N, Q)
+        cover_vector = self.parser['conv_uf'](cover_F)  # (B, N, A)
 
-        ht = u2 * h1 + (1. - u2) * h_tilde  # (B, H)
+        # Softmax over the attended cells, stable as the largest energy is subtracted before the exp
+        energy = self.parser['U_att'](torch.tanh(packed.pctx + pstate_ + cover_vector)).squeeze(-1)  # (B, N)
+        alpha = torch.softmax(energy.masked_fill(~packed.valid, -torch.inf), dim=-1)  # (B, N)
 
-        # Compute the output
+        # Compute Context
+        ct = torch.einsum('bn, bnd -> bd', alpha, packed.x)  # (B, D)
+
+        # Scatter the weights back to the feature map, the padding cells carry a zero weight
+        alpha_t = alpha.new_zeros((batch_size, packed.shape[0] * packed.shape[1]))
+        alpha_t = alpha_t.scatter(1, packed.index, alpha).view(batch_size, *packed.shape)  # (B, Height, Width)
+        alpha_past = alpha_past + alpha_t.unsqueeze(1)  # (B, 1, Height, Width)
+        return ct, alpha_past, alpha_t
+
+    def output_layer(self, ct, ht, logit_ey):
+        """
+        Deep output layer with maxout. Works on a single step (B, ...) as well as on a whole sequence (B, L, ...)
+        :param ct: context - (B, D)
+        :param ht: hidden state - (B, H)
+        :param logit_ey: W_yo projection of the embedded previous token - (B, E)
+        :return: the logits - (B, V)
+        """
         logit_ctx = self.parser['W_c'](ct)  # (B, E)
         logit_ht = self.parser['W_h'](ht)  # (B, E)
-        logit_ey = self.parser['W_yo'](state_below)  # (B, E)
 
         logit = logit_ctx + logit_ht + logit_ey  # (B, E)
 
@@ -289,9 +814,7 @@ class VanillaWAP(nn.Module):
         shape = tuple(shape[:-1] + [shape[-1] // 2, 2])
         logit = torch.max(logit.reshape(shape), dim=-1)[0]
 
-        o_t = self.parser['W_o'](logit)  # (B, V)
-
-        return o_t, ht, alpha_past, alpha_t
+        return self.parser['W_o'](logit)  # (B, V)
 
     def visualize(self, images, mask, labels):
         """
@@ -316,15 +839,146 @@ class VanillaWAP(nn.Module):
             upsampler = nn.Upsample(size=image.shape, mode='bilinear', align_corners=True)
 
     def watch(self, x, mask=None):
+        # Images are padded to a multiple of the stride, usually already by utils/preprocessing.pad_to_stride, so that
+        # the mask of the feature map is the image mask subsampled by the stride
+        stride = self.watch_stride()
+        padding = (0, (-x.shape[3]) % stride, 0, (-x.shape[2]) % stride)
+        if any(padding):
+            x = nn.functional.pad(x, padding)
+            mask = nn.functional.pad(mask, padding) if mask is not None else None
+
+        # With activation checkpointing, only the input of every block ('block') or of every layer ('layer') is kept and
+        # the rest is recomputed in backward
+        granularity = self.config['train_params'].get('checkpoint_watcher')
+        if not (self.checkpointing() and any(p.requires_grad for p in self.watcher.parameters())):
+            granularity = None
         for i in range(self.config['num_blocks']):
-            x = self.watcher[i](x)
-
-            if mask is not None:
-                mask = mask[:, :, ::2, ::2]
-            if mask.shape[2] != x.shape[2] or mask.shape[3] != x.shape[3]:
-                mask = mask[:, :, :x.shape[2], :x.shape[3]]
+            if granularity == 'layer':
+                for layer in self.watcher[i]:
+                    x = checkpoint_module(layer, x)
+            elif granularity:
+                x = checkpoint_module(self.watcher[i], x)
+            else:
+                x = self.watcher[i](x)
+
+        if mask is not None:
+            mask = mask[:, :, ::stride, ::stride]
         return x, mask
 
+    def encode(self, x, mask):
+        """
+        Encoder used at inference. Depending on config['encoder_mode'], the image is either watched at once ('full') or,
+        when it is larger than a tile, in overlapping tiles stitched at feature level ('tiled')
+        :return: the feature map and its mask
+        """
+        tile_size = self.config.get('tile_size', 512)
+        if self.config.get('encoder_mode', 'full') == 'tiled' and max(x.shape[-2:]) > tile_size:
+            return self.watch_tiled(x, mask, tile_size, self.config.get('tile_overlap', 128),
+                                    self.config.get('tile_batch', 8))
+        return self.watch(x, mask)
+
+    def watch_tiled(self, x, mask, tile_size=512, overlap=128, tile_batch=8):
+        """
+        Watch a large image in overlapping square tiles so that the peak memory only depends on tile_size and
+        tile_batch. Every tile gives up half of the overlap on each inner side, so the stitched features only come from
+        cells whose receptive field lies well inside a tile.
+        :param x: images - (B, C, H, W)
+        :param mask: image masks - (B, 1, H, W)
+        :param tile_size: side of a tile in pixels, rounded down to a multiple of the encoder stride
+        :param overlap: overlap of neighbouring tiles in pixels, rounded down to a multiple of twice the stride
+        :param tile_batch: number of tiles encoded at once
+        :return: the feature map and its mask - (B, D, H / stride, W / stride) and (B, 1, H / stride, W / stride)
+        """
+        stride = self.watch_stride()
+        tile_size = max(stride, tile_size - tile_size % stride)
+        overlap = min(overlap - overlap % (2 * stride), tile_size - 2 * stride)
+        margin = overlap // 2
+
+        # Pad the image to a multiple of the stride, the padding is masked out
+        height, width = x.shape[-2:]
+        pad_h, pad_w = (-height) % stride, (-width) % stride
+        x = nn.functional.pad(x, (0, pad_w, 0, pad_h))
+        mask = nn.functional.pad(mask, (0, pad_w, 0, pad_h))
+        height, width = height + pad_h, width + pad_w
+
+        def starts(size):
+            # Tile origins along one dimension, the last tile is aligned with the end of the image
+            if size <= tile_size:
+                return [0]
+            ret = list(range(0, size - tile_size, tile_size - overlap))
+            return ret + [size - tile_size]
+
+        tiles = []
+        for top in starts(height):
+            for left in starts(width):
+                tiles.append((top, min(top + tile_size, height), left, min(left + tile_size, width)))
+
+        features = None
+        for i in range(0, len(tiles), tile_batch):
+            group = tiles[i:i + tile_batch]
+            # Tiles of a group share their size unless the image is smaller than a tile along one dimension
+            crops = [x[:, :, t:b, l:r] for t, b, l, r in group]
+            crop_masks = [mask[:, :, t:b, l:r] for t, b, l, r in group]
+            tile_features, _ = self.watch(torch.cat(crops, dim=0), torch.cat(crop_masks, dim=0))
+            tile_features = tile_features.split(x.shape[0], dim=0)
+            if features is None:
+                features = x.new_zeros((x.shape[0], tile_features[0].shape[1], height // stride, width // stride))
+
+            for (top, bottom, left, right), tile in zip(group, tile_features):
+                # Keep the core of the tile, and its border on the sides of the image
+                t0 = 0 if top == 0 else margin // stride
+                t1 = tile.shape[2] if bottom == height else (bottom - top - margin) // stride
+                l0 = 0 if left == 0 else margin // stride
+                l1 = tile.shape[3] if right == width else (right - left - margin) // stride
+                features[:, :, top // stride + t0:top // stride + t1, left // stride + l0:left // stride + l1] = \
+                    tile[:, :, t0:t1, l0:l1]
+
+        return features, mask[:, :, ::stride, ::stride]
+
+    def watch_stride(self):
+        """
+        :return: total downsampling factor of the watcher
+        """
+        stride = 1
+        for module in self.watcher.modules():
+            if isinstance(module, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+                stride *= module.stride if isinstance(module.stride, int) else module.stride[0]
+        return stride
+
+    def receptive_field(self):
+        """
+        :return: (before, after) such that the cell c of the feature map only depends on the input pixels
+        [c * stride - before, c * stride + after] along each dimension. Paths that branch (dense blocks) are counted as
+        if their layers were chained, which can only widen the field
+        """
+        before, after, jump = 0, 0, 1
+        for module in self.watcher.modules():
+            if not isinstance(module, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+                continue
+            k, s, p, dil = [v if isinstance(v, int) else v[0] for v in
+                            (module.kernel_size, module.stride, module.padding, getattr(module, 'dilation', 1))]
+            before += p * jump
+            after += (dil * (k - 1) - p) * jump
+            jump *= s
+        return before, after
+
+    def feature_size(self, height, width):
+        """
+        :param height: height of an image
+        :param width: width of an image
+        :return: (height, width) of the feature map watch() produces for the image on its own
+        """
+        stride = self.watch_stride()
+        size = [height + (-height) % stride, width + (-width) % stride]
+        for module in self.watcher.modules():
+            if not isinstance(module, (nn.Conv2d, nn.MaxPool2d, nn.AvgPool2d)):
+                continue
+            for d in range(2):
+                k, s, p, dil = [v if isinstance(v, int) else v[d] for v in
+                                (module.kernel_size, module.stride, module.padding, getattr(module, 'dilation', 1))]
+                size[d] = (size[d] + 2 * p - dil * (k - 1) - 1) // s + 1
+        return tuple(size)
+
     def predict(self, x):
         pass
 
@@ -346,6 +1000,21 @@ class VanillaWAP(nn.Module):
             torch.save(self.state_dict(), os.path.join(save_loc, 'model_{}.pth'.format(iteration)))
             return
 
+    @classmethod
+    def from_checkpoint(cls, path, config, device=None):
+        """
+        :param path: location of a state dict saved by save()
+        :param config: config the checkpoint was trained with
+        :param device: device to load the model on, defaults to config['DEVICE']
+        :return: the model in eval mode
+        """
+        device = device or config['DEVICE']
+        config = dict(config, DEVICE=device)
+        config['train_params'] = dict(config['train_params'], load=False)
+        model = cls(config)
+        model.load_state_dict(torch.load(path, map_location=device))
+        return model.eval().to(device)
+
     def load(self):
         # load the model
         path = os.path.join(self.config['root_loc'], self.config['train_params']['save_loc'])
@@ -0,0 +1,406 @@
+# Hyperparameter sweep over the keys of BASE_CONFIG. Run from the root of the repository:
+#   python -m train.sweep --space configs/sweep.yaml --index data/CROHME/train/index.npz --trials 24 --threads 2
+# The images of the index (see utils/manifest.py) are preprocessed once into a memory-mapped store that every trial
+# reads, so the trials share one copy of the dataset in the page cache. Trials run in a pool of processes limited to
+# --threads intra-op threads each, and a trial whose validation expression rate falls below the median of the trials
+# that reached the same epoch is stopped. Every finished trial is appended to <output_dir>/results.csv.
+import argparse
+import copy
+import csv
+import hashlib
+import json
+import os
+import time
+from multiprocessing import Pool, get_context
+
+import numpy as np
+import torch
+import yaml
+from PIL import Image
+from torch.utils.data import DataLoader, Dataset
+
+from train.models import VanillaWAP
+from train.utils.datasets import EOS_INDEX, collate_fn, expression_rate
+from train.utils.global_params import BASE_CONFIG, PREPROCESS_CONFIG
+from train.utils.losses import MaskedCrossEntropy
+from train.utils.manifest import BucketBatchSampler, ManifestIndex, build_index
+from train.utils.preprocessing import pad_to_stride, prepare_image, to_tensor
+
+IMAGES_FILE = 'images.u8'
+STORE_FILE = 'images.npz'
+RESULTS_FILE = 'results.csv'
+
+# Keys holding one entry per layer of every block, and the pooling keys that only pool on the last layer of a block
+LAYER_KEYS = ('num_features_map', 'feature_kernel_size', 'feature_kernel_stride', 'feature_padding', 'conv_dropout',
+              'batch_norm')
+POOLING_KEYS = ('feature_pooling_kernel_size', 'feature_pooling_stride')
+
+
+# SEARCH SPACE
+def load_space(path):
+    """
+    :param path: YAML file mapping the swept keys to their choices, see configs/sweep.yaml
+    :return: the search space as a dict
+    """
+    with open(path) as f:
+        space = yaml.safe_load(f)
+    space = space.get('space', space)
+    for name, choices in space.items():
+        groups = choices if isinstance(choices, list) and all(isinstance(c, dict) for c in choices) else None
+        if groups is not None and not known(name):
+            # A group of keys set together
+            for group in groups:
+                for key in group:
+                    check_key(key)
+        elif isinstance(choices, dict):
+            check_key(name)
+            if len(choices) != 1 or next(iter(choices)) not in ('uniform', 'log_uniform', 'int'):
+                raise ValueError(f'{name}: a distribution is one of uniform, log_uniform or int: [low, high]')
+        elif isinstance(choices, list):
+            check_key(name)
+        else:
+            raise ValueError(f'{name}: expected a list of choices or a distribution, got {choices!r}')
+    return space
+
+
+def known(key):
+    if key.startswith('train_params.'):
+        return key.split('.', 1)[1] in BASE_CONFIG['train_params']
+    return key in BASE_CONFIG
+
+
+def check_key(key):
+    if not known(key):
+        raise ValueError(f'{key} is not a key of BASE_CONFIG, train_params keys are written train_params.<key>')
+
+
+def sample_params(space, rng):
+    """
+    :param space: search space of load_space
+    :param rng: numpy Generator
+    :return: dict of the value drawn for every entry of the space
+    """
+    params = {}
+    for name, choices in space.items():
+        if isinstance(choices, list):
+            params[name] = choices[rng.integers(len(choices))]
+            continue
+        (kind, (low, high)), = choices.items()
+        if kind == 'uniform':
+            params[name] = float(rng.uniform(low, high))
+        elif kind == 'log_uniform':
+            params[name] = float(np.exp(rng.uniform(np.log(low), np.log(high))))
+        else:
+            params[name] = int(rng.integers(low, high + 1))
+    return params
+
+
+def grid_params(space):
+    """
+    :return: every combination of the choices of a space made of lists only
+    """
+    params = [{}]
+    for name, choices in space.items():
+        if not isinstance(choices, list):
+            raise ValueError(f'{name}: a grid needs a list of choices, not a distribution')
+        params = [dict(p, **{name: choice}) for p in params for choice in choices]
+    return params
+
+
+def trial_config(params):
+    """
+    :param params: values drawn for the entries of the space
+    :return: a copy of BASE_CONFIG with the values applied, running on the cpu
+    """
+    config = copy.deepcopy(BASE_CONFIG)
+    config['DEVICE'] = 'cpu'
+    config['train_params']['load'] = False
+    for name, value in params.items():
+        for key, v in (value.items() if isinstance(value, dict) and not known(name) else [(name, value)]):
+            if key.startswith('train_params.'):
+                config['train_params'][key.split('.', 1)[1]] = v
+            else:
+                config[key] = v
+    return fit_layers(config)
+
+
+def fit_layers(config):
+    """
+    Bring the per-layer keys to the depth of every block, so that sweeping num_layers, or a width per block such as
+    num_features_map: [32, 64, 64, 128], does not require spelling out every layer. A value given per block is
+    repeated over its layers, and a list of the wrong length is cut or extended with its last entry. Blocks only pool
+    after their last layer
+    :return: config, modified in place
+    """
+    for b, depth in enumerate(config['num_layers']):
+        for key in LAYER_KEYS + POOLING_KEYS:
+            values = config[key][b]
+            if isinstance(values, list) and len(values) == depth:
+                continue
+            if key in POOLING_KEYS:
+                pooling = values[-1] if isinstance(values, list) else values
+                config[key][b] = [None] * (depth - 1) + [tuple(pooling) if pooling is not None else None]
+            else:
+                values = values if isinstance(values, list) else [values]
+                config[key][b] = (values + values[-1:] * depth)[:depth]
+    return config
+
+
+# SHARED DATASET
+def prepare_file(path):
+    # Run by the processes of the pool. Samples left out of the sweep, and images that cannot be read, are stored empty
+    if path is None:
+        return np.zeros((0, 0), dtype=np.uint8)
+    try:
+        return prepare_image(np.array(Image.open(path).convert('L')), PREPROCESS_CONFIG)[0]
+    except OSError:
+        return np.zeros((0, 0), dtype=np.uint8)
+
+
+def store_signature(index):
+    """
+    :return: sha1 hex digest of the paths and the image hashes of index and of the preprocessing, a store built from
+    another index, or with another preprocessing, has another signature
+    """
+    h = hashlib.sha1(json.dumps(PREPROCESS_CONFIG, sort_keys=True).encode())
+    h.update('\n'.join(index.paths).encode())
+    h.update(index.hashes.tobytes())
+    return h.hexdigest()
+
+
+def build_store(index, loc, workers=4):
+    """
+    Preprocess the images of an index once into one flat uint8 file next to an npz of their offsets and shapes. The
+    samples ManifestIndex.valid() rejects get an empty entry. An existing store is reused if it was built from the
+    same index
+    :param index: ManifestIndex
+    :param loc: directory of the store
+    :param workers: number of processes preprocessing the images
+    """
+    signature = store_signature(index)
+    if os.path.exists(os.path.join(loc, STORE_FILE)):
+        store = np.load(os.path.join(loc, STORE_FILE))
+        if 'signature' in store and str(store['signature']) == signature:
+            return
+        print(f'{loc} was built from another index or preprocessing, rebuilding it')
+    os.makedirs(loc, exist_ok=True)
+    paths = [path if valid else None for path, valid in zip(index.image_paths, index.valid())]
+    shapes, offsets, offset = [], [], 0
+    with Pool(workers) as pool, open(os.path.join(loc, IMAGES_FILE), 'wb') as f:
+        for image in pool.imap(prepare_file, paths, chunksize=32):
+            image.tofile(f)
+            shapes.append(image.shape)
+            offsets.append(offset)
+            offset += image.size
+    np.savez(os.path.join(loc, STORE_FILE), shapes=np.array(shapes, dtype=np.int64).reshape(-1, 2),
+             offsets=np.array(offsets, dtype=np.int64), signature=signature)
+
+
+class ImageStore:
+    """
+    Read-only memory map of the images written by build_store. The processes of the sweep map the same file, so the
+    operating system keeps a single copy of the preprocessed dataset whatever the number of trials.
+    """
+    def __init__(self, loc):
+        store = np.load(os.path.join(loc, STORE_FILE))
+        self.shapes, self.offsets = store['shapes'], store['offsets']
+        self.images = np.memmap(os.path.join(loc, IMAGES_FILE), dtype=np.uint8, mode='r')
+
+    def __len__(self):
+        return len(self.shapes)
+
+    def __getitem__(self, i):
+        height, width = self.shapes[i]
+        return self.images[self.offsets[i]:self.offsets[i] + height * width].reshape(height, width)
+
+
+class StoreDataset(Dataset):
+    """
+    Samples of an index read from an ImageStore, in the format of ImageDataset
+    """
+    def __init__(self, store, index, indices, stride):
+        self.store = store
+        self.index = index
+        self.indices = indices
+        self.stride = stride
+
+    def __getitem__(self, k):
+        i = self.indices[k]
+        image, mask = pad_to_stride(self.store[i], self.stride)
+        tokens = torch.tensor([int(t) for t in self.index.token_ids(i)] + [EOS_INDEX])
+        return to_tensor(image), to_tensor(mask, scale=1), tokens, torch.tensor(len(tokens)), torch.ones_like(tokens)
+
+    def __len__(self):
+        return len(self.indices)
+
+
+# TRIALS
+SWEEP = {}
+
+
+def init_worker(settings, board):
+    # Run once per process of the pool
+    torch.set_num_threads(settings['threads'])
+    SWEEP.update(settings, board=board, index=ManifestIndex(settings['index']), store=ImageStore(settings['store']))
+
+
+def should_stop(board, trial, epoch, rate):
+    """
+    Median stopping rule: stop a trial whose expression rate after epoch is below the median of the other trials at
+    the same epoch, once it has run SWEEP['grace_epochs'] epochs and SWEEP['min_peers'] trials got that far
+    """
+    if epoch + 1 < SWEEP['grace_epochs']:
+        return False
+    peers = [rates[epoch] for t, rates in board.items() if t != trial and len(rates) > epoch]
+    return len(peers) >= SWEEP['min_peers'] and rate < np.median(peers)
+
+
+def run_trial(task):
+    """
+    Train and validate one configuration, run by the processes of the pool
+    :param task: (trial id, params)
+    :return: the row of the trial in the results table
+    """
+    trial, params = task
+    start = time.perf_counter()
+    row = {'trial': trial, 'status': 'completed', 'epochs': 0, 'expression_rate': None, 'best_epoch': None,
+           'train_loss': None, 'parameters': None, 'minutes': None}
+    try:
+        config = trial_config(params)
+        train_params = config['train_params']
+        torch.manual_seed(SWEEP['seed'])
+        model = VanillaWAP(config)
+        row['parameters'] = sum(p.numel() for p in model.parameters())
+        index, store, stride = SWEEP['index'], SWEEP['store'], model.watch_stride()
+        index_to_word = {i: word for i, word in enumerate(index.vocabulary)}
+
+        batch_size = train_params['batch_size']
+        train = StoreDataset(store, index, SWEEP['train'], stride)
+        sampler = BucketBatchSampler(store.shapes[SWEEP['train']], batch_size, seed=SWEEP['seed'])
+        loader_train = DataLoader(train, batch_sampler=sampler, collate_fn=collate_fn)
+        # Validation batches of similar sizes, in the same order for every trial
+        val = sorted(SWEEP['val'], key=lambda i: tuple(store.shapes[i]))
+        loader_val = DataLoader(StoreDataset(store, index, val, stride), batch_size=batch_size, collate_fn=collate_fn)
+
+        optimizer = torch.optim.AdamW(model.parameters(), lr=train_params['lr'],
+                                      weight_decay=train_params['weight_decay'])
+        criterion = MaskedCrossEntropy(label_smoothing=train_params['label_smoothing'],
+                                       normalization=train_params['loss_normalization'])
+        board, best = SWEEP['board'], -1.
+        board[trial] = []
+        for epoch in range(SWEEP['epochs']):
+            model.train()
+            losses = []
+            for x, x_mask, y, _, label_mask in loader_train:
+                logit = model(x, mask=x_mask, target=y, target_mask=label_mask)
+                loss = criterion(logit, y, label_mask)
+                loss.backward()
+                torch.nn.utils.clip_grad_norm_(model.parameters(), train_params['clip_grad_norm'])
+                optimizer.step()
+                optimizer.zero_grad()
+                losses.append(loss.item())
+
+            model.eval()
+            rate = expression_rate(model, loader_val, index_to_word)
+            board[trial] = board[trial] + [rate]
+            row.update(epochs=epoch + 1, train_loss=float(np.mean(losses)))
+            if rate > best:
+                best = rate
+                row.update(expression_rate=rate, best_epoch=epoch + 1)
+                torch.save(model.state_dict(), os.path.join(SWEEP['output_dir'], f'trial_{trial:03d}.pth'))
+            print(f'trial {trial:>3} epoch {epoch + 1:>3}: loss {row["train_loss"]:.3f}, expression rate {rate:.3f}',
+                  flush=True)
+            if should_stop(board, trial, epoch, rate):
+                row['status'] = 'stopped'
+                break
+    except Exception as e:
+        row['status'] = f'failed: {type(e).__name__}: {e}'
+    row['minutes'] = (time.perf_counter() - start) / 60
+    return row
+
+
+def main(args):
+    os.makedirs(args.output_dir, exist_ok=True)
+    space = load_space(args.space)
+    if not os.path.exists(args.index):
+        if not args.manifest:
+            raise ValueError(f'{args.index} does not exist, pass --manifest to build it')
+        build_index(args.manifest, args.index, args.image_dir, workers=args.workers)
+    index = ManifestIndex(args.index)
+
+    # The split of train.py, optionally subsampled to bound the cost of a trial
+    valid = index.valid()
+    train, val = [[int(i) for i in split if valid[i]]
+                  for split in index.split([0.8, 0.2], BASE_CONFIG['train_params']['random_seed'])]
+    rng = np.random.default_rng(args.seed)
+    if args.max_train:
+        train = sorted(rng.permutation(train)[:args.max_train].tolist())
+    if args.max_val:
+        val = sorted(rng.permutation(val)[:args.max_val].tolist())
+
+    store = os.path.join(args.output_dir, 'images')
+    build_store(index, store, args.workers)
+
+    if args.grid:
+        params = grid_params(space)
+    else:
+        params = [sample_params(space, rng) for _ in range(args.trials)]
+    results = os.path.join(args.output_dir, RESULTS_FILE)
+    done = set()
+    if os.path.exists(results):
+        with open(results) as f:
+            done = {int(row['trial']) for row in csv.DictReader(f)}
+    tasks = [(trial, p) for trial, p in enumerate(params) if trial not in done]
+    print(f'{len(tasks)} trials to run, {len(done)} already in {results}')
+
+    # Fresh processes with their thread count set before torch starts its thread pools
+    os.environ['OMP_NUM_THREADS'] = str(args.threads)
+    os.environ['MKL_NUM_THREADS'] = str(args.threads)
+    context = get_context('spawn')
+    workers = args.parallel or max(1, (os.cpu_count() or 1) // args.threads)
+    settings = {'threads': args.threads, 'index': args.index, 'store': store, 'train': train, 'val': val,
+                'epochs': args.epochs, 'seed': args.seed, 'grace_epochs': args.grace_epochs,
+                'min_peers': args.min_peers, 'output_dir': args.output_dir}
+    columns = ['trial', 'status', 'epochs', 'expression_rate', 'best_epoch', 'train_loss', 'parameters', 'minutes'] \
+        + list(space)
+    with context.Manager() as manager:
+        board = manager.dict()
+        with context.Pool(workers, initializer=init_worker, initargs=(settings, board), maxtasksperchild=1) as pool, \
+                open(results, 'a', newline='') as f:
+            writer = csv.DictWriter(f, fieldnames=columns)
+            if not done:
+                writer.writeheader()
+            for row in pool.imap_unordered(run_trial, tasks):
+                row.update({name: json.dumps(params[row['trial']][name]) for name in space})
+                writer.writerow(row)
+                f.flush()
+                print(f'trial {row["trial"]} {row["status"]}: expression rate {row["expression_rate"]}', flush=True)
+
+    with open(results) as f:
+        rows = sorted(csv.DictReader(f), key=lambda row: -float(row['expression_rate'] or -1))
+    print(f'{"trial":>6}{"status":>11}{"epochs":>8}{"expr rate":>11}  params')
+    for row in rows[:args.top]:
+        print(f'{row["trial"]:>6}{row["status"][:10]:>11}{row["epochs"]:>8}{row["expression_rate"] or "-":>11}  '
+              + ', '.join(f'{name}={row[name]}' for name in space))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Parallel hyperparameter sweep over the keys of BASE_CONFIG')
+    parser.add_argument('--space', default='configs/sweep.yaml', help='YAML search space')
+    parser.add_argument('--index', default='data/CROHME/train/index.npz', help='manifest index, see utils/manifest.py')
+    parser.add_argument('--manifest', help='manifest the index is built from when it does not exist')
+    parser.add_argument('--image_dir', default=None, help='directory the images of the manifest are looked up in')
+    parser.add_argument('--output_dir', default='sweeps/default')
+    parser.add_argument('--trials', type=int, default=16, help='number of random trials')
+    parser.add_argument('--grid', action='store_true', help='run every combination of the choices instead')
+    parser.add_argument('--epochs', type=int, default=BASE_CONFIG['train_params']['epochs'])
+    parser.add_argument('--threads', type=int, default=2, help='intra-op threads of a trial')
+    parser.add_argument('--parallel', type=int, default=0, help='trials run at once, 0 fills the cores')
+    parser.add_argument('--workers', type=int, default=4, help='processes building the index and the store')
+    parser.add_argument('--max_train', type=int, default=0, help='training samples of a trial, 0 uses the split')
+    parser.add_argument('--max_val', type=int, default=500, help='validation samples of a trial, 0 uses the split')
+    parser.add_argument('--grace_epochs', type=int, default=2, help='epochs a trial runs before it can be stopped')
+    parser.add_argument('--min_peers', type=int, default=3, help='trials needed at an epoch to stop another one')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--top', type=int, default=10, help='number of trials printed')
+    main(parser.parse_args())
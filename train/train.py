@@ -1,7 +1,16 @@
 from utils.datasets import ImageDataset, collate_fn, convert_to_string
-from utils.global_params import BASE_CONFIG, TR_IMAGE_SIZE, BATCH_SIZE, CROHME_TRAIN, VOCAB_LOC
-from torch.utils.data import DataLoader, random_split
+from utils.global_params import BASE_CONFIG, STUDENT_CONFIG, TR_IMAGE_SIZE, BATCH_SIZE, CROHME_TRAIN, VOCAB_LOC, \
+    PREPROCESS_CONFIG
+from utils.profiling import Profiler
+from utils.feature_cache import build_feature_cache, CachedFeatureDataset
+from utils.losses import DistillationLoss, MaskedCrossEntropy
+from utils.distillation import TeacherDataset, build_teacher_cache, distillation_collate_fn
+from utils.augmentation import BatchAugmenter
+from utils.manifest import BucketBatchSampler, ManifestIndex
+from torch.utils.data import DataLoader, Subset, random_split
 from torcheval.metrics import WordErrorRate
+import math
+import os
 import torch
 from models import VanillaWAP
 import torchvision.transforms as transforms
@@ -16,35 +25,107 @@ EOS_INDEX = 1
 
 # Define Dataset
 # train_data_csv = pd.read_csv(CROHME_TRAIN + '/train.csv')  # Location of the generated dataset
-train_data_csv = pd.read_csv(CROHME_TRAIN + '/wap_dataset.csv', sep='\t')  # Location
-
 # train_data_csv = pd.read_csv(CROHME_TRAIN + '/train_caption.txt', sep="\t", names=['image_loc', 'label'])
 # train_data_csv['image_loc'] = train_data_csv.apply(lambda row: f'{CROHME_TRAIN}/off_image_train/{row[
 # "image_loc"]}_0.bmp', axis=1) train_data_csv.to_csv(CROHME_TRAIN + '/wap_dataset.csv', sep='\t')
 
-# Define transforms
-transform = transforms.Compose([transforms.ToTensor()])
-dataset = ImageDataset(train_data_csv['image_loc'], train_data_csv['label'], VOCAB_LOC, device=BASE_CONFIG['DEVICE'],
-                       transform=transform)
+# Model. Distillation trains the smaller STUDENT_CONFIG against a teacher checkpoint trained with BASE_CONFIG
+train_params = BASE_CONFIG['train_params']
+distill = train_params['distill_teacher'] is not None
+model = VanillaWAP(STUDENT_CONFIG if distill else BASE_CONFIG)
 
-# Model
-model = VanillaWAP(BASE_CONFIG)
+# Define transforms. The images go through the preprocessing of inference (PREPROCESS_CONFIG) and are padded to the
+# encoder stride
+transform = transforms.Compose([transforms.ToTensor()])
+# A manifest index (utils/manifest.py) already holds the paths, the tokens and the sizes of the samples, so neither the
+# dataset, the split nor the batches need to open an image
+index = ManifestIndex(train_params['manifest_index']) if train_params['manifest_index'] else None
+if index is not None:
+    dataset = ImageDataset.from_index(index, VOCAB_LOC, device=BASE_CONFIG['DEVICE'], transform=transform,
+                                      preprocess=PREPROCESS_CONFIG, stride=model.watch_stride())
+else:
+    train_data_csv = pd.read_csv(CROHME_TRAIN + '/wap_dataset.csv', sep='\t')  # Location
+    dataset = ImageDataset(train_data_csv['image_loc'], train_data_csv['label'], VOCAB_LOC,
+                           device=BASE_CONFIG['DEVICE'], transform=transform, preprocess=PREPROCESS_CONFIG,
+                           stride=model.watch_stride())
+
+# Parser-only fine-tuning: freeze the watcher, and optionally read its features from a cache instead of recomputing them
+encoded = train_params['feature_cache'] is not None
+freeze_watcher = train_params['freeze_watcher'] or encoded
+if freeze_watcher:
+    model.watcher.requires_grad_(False)
+if encoded:
+    feature_cache, image_hashes = build_feature_cache(model, dataset, train_params['feature_cache'])
+    source = CachedFeatureDataset(dataset, feature_cache, image_hashes)
+else:
+    source = dataset
 
 # Training Constructs
-train_params = BASE_CONFIG['train_params']
-optimizer = torch.optim.AdamW(model.parameters(), lr=train_params['lr'], weight_decay=train_params['weight_decay'])
+trainable = [p for p in model.parameters() if p.requires_grad]
+optimizer = torch.optim.AdamW(trainable, lr=train_params['lr'], weight_decay=train_params['weight_decay'])
 scheduler = torch.optim.lr_scheduler.StepLR(optimizer,
                                             step_size=train_params['lr_decay_step'],
                                             gamma=train_params['lr_decay'])
 
+# Instrumentation, a no-op unless train_params['profile'] is set
+profiler = Profiler(enabled=train_params['profile'], device=BASE_CONFIG['DEVICE'],
+                    trace_dir=train_params['profile_loc'] if train_params['profile_trace'] else None)
+model.profiler = profiler
+
+# Batched augmentation of the training images. The cached features of a frozen watcher cannot be augmented, nor can
+# the images the teacher outputs were cached for
+augmenter = None
+if train_params['augment'] and not encoded and not distill:
+    augmenter = BatchAugmenter(train_params['augment_params'], seed=train_params['random_seed'])
+
+# Loss on the non-pad positions only
+criterion = MaskedCrossEntropy(label_smoothing=train_params['label_smoothing'],
+                               normalization=train_params['loss_normalization'])
+if distill:
+    criterion = DistillationLoss(temperature=train_params['distill_temperature'],
+                                 soft_weight=train_params['distill_soft_weight'],
+                                 attention_weight=train_params['distill_attention_weight'],
+                                 label_smoothing=train_params['label_smoothing'],
+                                 normalization=train_params['loss_normalization'])
+
 # Evaluation Constructs
 wer = WordErrorRate(device=BASE_CONFIG['DEVICE'])
 
 # Define dataloader
 generator = torch.Generator().manual_seed(train_params['random_seed'])
-train, val = random_split(dataset, [0.8, 0.2], generator=generator)
-dataloader_train = DataLoader(train, batch_size=BATCH_SIZE, shuffle=True, collate_fn=collate_fn)
-dataloader_val = DataLoader(val, batch_size=BATCH_SIZE, shuffle=True, collate_fn=collate_fn)
+if index is not None:
+    # The split random_split draws, with every duplicate moved to the split of the image it copies and the samples
+    # that cannot be loaded left out
+    valid = index.valid()
+    train, val = [Subset(source, [int(i) for i in split if valid[i]])
+                  for split in index.split([0.8, 0.2], train_params['random_seed'])]
+else:
+    train, val = random_split(source, [0.8, 0.2], generator=generator)
+timed_collate_fn = profiler.wrap('collate', collate_fn)
+train_collate_fn = timed_collate_fn
+
+# Distillation: the teacher runs once over the training samples, its logits and attention maps are read back from a
+# memory-mapped cache at every epoch
+if distill:
+    if encoded:
+        raise ValueError('the watcher of the student is trained, its features cannot be read from a cache')
+    teacher = VanillaWAP.from_checkpoint(train_params['distill_teacher'], BASE_CONFIG)
+    if teacher.watch_stride() != model.watch_stride():
+        raise ValueError('the student must have the encoder stride of the teacher to learn its attention maps')
+    teacher_cache, sample_keys = build_teacher_cache(teacher, dataset, train_params['distill_cache'],
+                                                     indices=train.indices)
+    del teacher
+    train = Subset(TeacherDataset(dataset, teacher_cache, sample_keys), train.indices)
+    train_collate_fn = profiler.wrap('collate', distillation_collate_fn)
+    os.makedirs(os.path.join(STUDENT_CONFIG['root_loc'], STUDENT_CONFIG['train_params']['save_loc']), exist_ok=True)
+if index is not None:
+    # Batches of images of similar size, planned from the sizes of the index
+    sampler = BucketBatchSampler(index.input_sizes(PREPROCESS_CONFIG)[train.indices], BATCH_SIZE,
+                                 seed=train_params['random_seed'])
+    dataloader_train = DataLoader(train, batch_sampler=sampler, collate_fn=train_collate_fn)
+else:
+    dataloader_train = DataLoader(train, batch_size=BATCH_SIZE, shuffle=True, collate_fn=train_collate_fn)
+dataloader_val = DataLoader(val, batch_size=BATCH_SIZE, shuffle=True, collate_fn=timed_collate_fn)
 
 
 # Define Expression Rate
@@ -59,6 +140,28 @@ def compute_expr_rate(pred, gt):
     return correct / len(pred)
 
 
+# Define Scheduled Sampling
+def sampling_probability(step):
+    """
+    Probability of feeding the model its own prediction instead of the ground truth at a given training step. It rises
+    from 0 to train_params['sampling_max_prob'] over about train_params['sampling_steps'] steps
+    :param step: number of training steps done so far
+    :return: the probability, 0 when train_params['sampling_schedule'] is None (pure teacher forcing)
+    """
+    schedule, max_prob, steps = (train_params['sampling_schedule'], train_params['sampling_max_prob'],
+                                 train_params['sampling_steps'])
+    if schedule is None:
+        return 0.0
+    elif schedule == 'linear':
+        return max_prob * min(1.0, step / steps)
+    elif schedule == 'exponential':
+        return max_prob * (1 - 0.01 ** (step / steps))
+    elif schedule == 'inverse_sigmoid':
+        return max_prob / (1 + math.exp(-10 * (step / steps - 0.5)))
+    else:
+        raise ValueError('sampling_schedule must be either None, linear, exponential or inverse_sigmoid')
+
+
 # Define AverageMeter
 class AverageMeter:
 
@@ -101,12 +204,6 @@ class AverageMeter:
             raise ValueError('best_type must be either min or max')
 
 
-def compute_loss(logit, gt, seq_len, mask):
-    logp = torch.nn.functional.log_softmax(logit, dim=-1)
-    div = torch.gather(logp, dim=-1, index=gt.unsqueeze(-1)).squeeze(-1)
-    return -torch.mean(torch.sum(div * label_mask, dim=-1))
-
-
 # Setup Training Loop
 train_loss, val_loss = AverageMeter(), AverageMeter()
 val_wer = AverageMeter(best=True, best_type='max')
@@ -114,26 +211,47 @@ val_expr = AverageMeter(best=True, best_type='max')
 losses, word_er, expr_r = [], [], []
 
 j = 0
+profiler.start()
 for i in range(train_params['epochs']):
     print("Epoch: ", i)
     model.train()
-    for x, x_mask, y, l, label_mask in tqdm(dataloader_train):
+    if freeze_watcher:
+        model.watcher.eval()
+    batches = profiler.iterate('data_loading', dataloader_train)
+    for batch in tqdm(batches, total=len(dataloader_train)):
+        x, x_mask, y, l, label_mask = batch[:5]
+        if augmenter is not None:
+            with profiler.stage('augment'):
+                x = augmenter(x, x_mask)
+
         # Get Maximum length of a sequence in the batch, and use it to trim the output of the model
         # y.shape is (B, MAX_LEN) and x.shape is (B, L ,V) which is to be trimmed
-        logit = model(x, mask=x_mask, target=y)
+        logit = model(x, mask=x_mask, target=y, encoded=encoded, target_mask=label_mask,
+                      sampling_prob=sampling_probability(j), return_alphas=distill)
 
         # Compute Loss
-        loss = compute_loss(logit, y, l, label_mask)
+        with profiler.stage('loss'):
+            if distill:
+                logit, alpha = logit
+                teacher_logit, teacher_alpha = batch[5:]
+                loss = criterion(logit, alpha, y, label_mask, teacher_logit.to(logit.device),
+                                 teacher_alpha.to(alpha.device))
+            else:
+                loss = criterion(logit, y, label_mask)
 
         # Backpropagation with clipped gradients
-        loss.backward()
-        torch.nn.utils.clip_grad_norm_(model.parameters(), train_params['clip_grad_norm'])
-        optimizer.step()
+        with profiler.stage('backward'):
+            loss.backward()
+        with profiler.stage('optimizer'):
+            torch.nn.utils.clip_grad_norm_(model.parameters(), train_params['clip_grad_norm'])
+            optimizer.step()
 
-        optimizer.zero_grad()
+            optimizer.zero_grad()
 
         # Update loss
         train_loss.update(loss.item())
+        profiler.add_tokens(l.sum().item())
+        profiler.step()
         j += 1
         if j < 0:
             break
@@ -143,9 +261,10 @@ for i in range(train_params['epochs']):
     print(f'Computing Validation WER Now...')
     with torch.no_grad():
         model.eval()
-        for x, x_mask, y, l, label_mask in tqdm(dataloader_val):
+        batches = profiler.iterate('val_data_loading', dataloader_val)
+        for x, x_mask, y, l, label_mask in tqdm(batches, total=len(dataloader_val)):
             # Set model to eval mode
-            y_pred, _ = model.translate(x, mask=x_mask)
+            y_pred, _ = model.translate(x, mask=x_mask, encoded=encoded)
 
             # Computer WER
             y_pred = [convert_to_string(y_pred[i, :], dataset.index_to_word) for i in range(y_pred.shape[0])]
@@ -178,6 +297,11 @@ for i in range(train_params['epochs']):
     # Save model
     model.save(iteration=i)
 
+# Export the instrumentation summary
+profiler.stop()
+profiler.export(os.path.join(train_params['profile_loc'], 'train_profile.json'))
+profiler.export(os.path.join(train_params['profile_loc'], 'train_profile.csv'))
+
 x = [i for i in range(len(losses))]
 plt.plot(x, losses, label='Training Loss')
 plt.title('Training Loss')
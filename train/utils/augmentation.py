@@ -0,0 +1,129 @@
+import math
+
+import torch
+from torch import nn
+
+# Default strength of every augmentation, see BatchAugmenter
+AUGMENTATION_PARAMS = {
+    'prob': 0.5,
+    'rotation': 5.0,
+    'scale': (0.9, 1.1),
+    'shear': 5.0,
+    'translate': 0.02,
+    'elastic_alpha': 0.01,
+    'elastic_grid': 32,
+    'stroke_prob': 0.3,
+    # Neighbourhood of the stroke width change: 'cross' (the 4 neighbours) or 'square' (3x3). A 3x3 erosion removes
+    # about 70% of the ink of CROHME strokes, which are about 3 pixels wide, the cross about 55%
+    'stroke_kernel': 'cross',
+    'noise_std': 0.05,
+}
+
+
+class BatchAugmenter:
+    """
+    Augmentation of a whole collated batch with tensor operations, so that it runs on the device of the batch instead
+    of per sample in the data loader. Every sample draws its own parameters from a seeded generator:
+    - a random affine transform (rotation, scale, shear, translation) and an elastic distortion, combined into a single
+      sampling grid and applied with one grid_sample
+    - a stroke width change, thickening or thinning the ink by one pixel with a max pooling over params['stroke_kernel']
+    - gaussian noise
+    Every augmentation is applied to a sample with probability params['prob'], except the stroke width change which has
+    its own probability. The image masks are left as they are and the padding stays black.
+    """
+    def __init__(self, params=None, seed=0):
+        """
+        :param params: strength of the augmentations, missing keys are taken from AUGMENTATION_PARAMS
+        :param seed: seed of the generator the parameters are drawn from
+        """
+        self.params = dict(AUGMENTATION_PARAMS, **(params or {}))
+        self.seed = seed
+        # The per-sample parameters are drawn on the cpu, the dense noise on the device of the batch
+        self.generator = torch.Generator().manual_seed(seed)
+        self.device_generator = None
+
+    def uniform(self, batch_size, low, high):
+        return low + (high - low) * torch.rand(batch_size, generator=self.generator)
+
+    def apply(self, batch_size):
+        return torch.rand(batch_size, generator=self.generator) < self.params['prob']
+
+    def affine(self, batch_size):
+        """
+        :return: per-sample affine matrices in the normalized coordinates of affine_grid - (B, 2, 3)
+        """
+        p = self.params
+        angle = self.uniform(batch_size, -p['rotation'], p['rotation']) * math.pi / 180
+        shear = self.uniform(batch_size, -p['shear'], p['shear']) * math.pi / 180
+        scale = self.uniform(batch_size, p['scale'][0], p['scale'][1])
+        shift = self.uniform(2 * batch_size, -p['translate'], p['translate']).view(batch_size, 2) * 2
+
+        cos, sin, tan = torch.cos(angle), torch.sin(angle), torch.tan(shear)
+        theta = torch.zeros(batch_size, 2, 3)
+        theta[:, 0, 0] = cos / scale
+        theta[:, 0, 1] = (-sin + cos * tan) / scale
+        theta[:, 1, 0] = sin / scale
+        theta[:, 1, 1] = (cos + sin * tan) / scale
+        theta[:, :, 2] = shift
+
+        # Samples that are not augmented keep the identity
+        identity = torch.tensor([[1., 0., 0.], [0., 1., 0.]])
+        return torch.where(self.apply(batch_size).view(-1, 1, 1), theta, identity)
+
+    def elastic(self, batch_size, height, width, device):
+        """
+        :return: smooth random displacements in normalized coordinates - (B, height, width, 2). The displacements are
+        drawn on a coarse grid and upsampled bilinearly, which is cheaper than blurring a dense random field
+        """
+        cell = self.params['elastic_grid']
+        coarse = (max(2, height // cell + 1), max(2, width // cell + 1))
+        field = torch.randn(batch_size, 2, *coarse, generator=self.generator) * self.params['elastic_alpha']
+        field = field * self.apply(batch_size).view(-1, 1, 1, 1)
+        field = nn.functional.interpolate(field.to(device), size=(height, width), mode='bilinear', align_corners=True)
+        return field.permute(0, 2, 3, 1)
+
+    def dilate(self, x):
+        """
+        :return: the maximum of x over the neighbourhood of params['stroke_kernel'] - (B, 1, H, W)
+        """
+        if self.params['stroke_kernel'] == 'square':
+            return nn.functional.max_pool2d(x, 3, stride=1, padding=1)
+        if self.params['stroke_kernel'] != 'cross':
+            raise ValueError(f'unknown stroke kernel {self.params["stroke_kernel"]}, expected cross or square')
+        return torch.maximum(nn.functional.max_pool2d(x, (1, 3), stride=1, padding=(0, 1)),
+                             nn.functional.max_pool2d(x, (3, 1), stride=1, padding=(1, 0)))
+
+    def noise(self, shape, device):
+        """
+        :return: standard gaussian noise drawn on device - shape
+        """
+        if self.device_generator is None or self.device_generator.device != torch.device(device):
+            self.device_generator = torch.Generator(device=device).manual_seed(self.seed + 1)
+        return torch.randn(shape, generator=self.device_generator, device=device)
+
+    def __call__(self, x, mask):
+        """
+        :param x: batch of images with bright ink in [0, 1] - (B, 1, H, W)
+        :param mask: image masks - (B, 1, H, W)
+        :return: the augmented images - (B, 1, H, W)
+        """
+        batch_size, _, height, width = x.shape
+        device = x.device
+
+        # Affine transform and elastic distortion in a single resampling
+        theta = self.affine(batch_size).to(device)
+        grid = nn.functional.affine_grid(theta, list(x.shape), align_corners=False)  # (B, H, W, 2)
+        grid = grid + self.elastic(batch_size, height, width, device)
+        x = nn.functional.grid_sample(x, grid, mode='bilinear', padding_mode='zeros', align_corners=False)
+
+        # Stroke width: thicken (dilation) or thin (erosion) the ink of some samples
+        change = torch.rand(batch_size, generator=self.generator) < self.params['stroke_prob']
+        if change.any():
+            thicken = (torch.rand(batch_size, generator=self.generator) < 0.5).to(device).view(-1, 1, 1, 1)
+            dilated, eroded = self.dilate(x), -self.dilate(-x)
+            x = torch.where(change.to(device).view(-1, 1, 1, 1), torch.where(thicken, dilated, eroded), x)
+
+        # Gaussian noise
+        std = self.uniform(batch_size, 0, self.params['noise_std']) * self.apply(batch_size)
+        x = x + self.noise(x.shape, device) * std.to(device).view(-1, 1, 1, 1)
+        return x.clamp_(0, 1) * mask
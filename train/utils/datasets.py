@@ -1,8 +1,11 @@
+import numpy as np
 import torch
 from torch.utils.data import Dataset
 from torch.nn.utils.rnn import pad_sequence
 from PIL import Image
 
+from .preprocessing import pad_to_stride, prepare_image, to_tensor
+
 SOS_INDEX = 0
 EOS_INDEX = 1
 
@@ -25,11 +28,32 @@ def convert_to_string(tensor, index_to_word):
     return string.strip()
 
 
-def collate_fn(batch):
-    # Separate inputs and labels
-    images, image_mask, labels, seq_len, labels_mask = zip(*batch)
-
-    # Pad sequences
+def expression_rate(model, loader, index_to_word):
+    """
+    Decode the samples of a loader of collate_fn batches. A translation is correct when its tokens are those of the
+    label, i.e. when its edit distance to the label is 0 in translator/evaluate.py
+    :param model: VanillaWAP or Ensemble in eval mode
+    :param loader: DataLoader of labelled images, preprocessed like the training images
+    :param index_to_word: dict
+    :return: fraction of the samples translated exactly
+    """
+    correct, total = 0, 0
+    with torch.no_grad():
+        for x, x_mask, y, _, _ in loader:
+            tokens, _ = model.translate(x, mask=x_mask)
+            tokens = tokens.reshape(x.shape[0], -1)
+            for i in range(x.shape[0]):
+                correct += convert_to_string(tokens[i], index_to_word) == convert_to_string(y[i], index_to_word)
+                total += 1
+    return correct / max(total, 1)
+
+
+def pad_images(images, image_mask):
+    """
+    :param images: list of (C, H, W) images of different sizes
+    :param image_mask: list of the matching (1, H, W) masks
+    :return: the images and masks zero padded to the largest height and width - (B, C, H, W) and (B, 1, H, W)
+    """
     max_h = max([image.shape[1] for image in images])
     max_w = max([image.shape[2] for image in images])
 
@@ -41,9 +65,17 @@ def collate_fn(batch):
         images[i] = torch.nn.functional.pad(images[i], padding, "constant", 0)
         image_mask[i] = torch.nn.functional.pad(image_mask[i], padding, "constant", 0)
 
-    images = torch.stack(images)
-    image_mask = torch.stack(image_mask)
+    return torch.stack(images), torch.stack(image_mask)
+
+
+def collate_fn(batch):
+    # Separate inputs and labels
+    images, image_mask, labels, seq_len, labels_mask = zip(*batch)
 
+    # Pad image and image_mask
+    images, image_mask = pad_images(images, image_mask)
+
+    # Pad sequences
     labels = pad_sequence(labels, batch_first=True, padding_value=0)
     labels_mask = pad_sequence(labels_mask, batch_first=True, padding_value=0)
     seq_lens = torch.tensor(seq_len)
@@ -66,10 +98,20 @@ def get_vocabulary(csv_loc):
 
 
 class ImageDataset(Dataset):
-    def __init__(self, image_paths, labels, vocab_loc, device, transform=None):
+    def __init__(self, image_paths, labels, vocab_loc, device, transform=None, preprocess=None, stride=None,
+                 tokens=None):
+        """
+        :param transform: transform of the PIL image, it must keep the size of the image when stride is set
+        :param preprocess: config whose preprocessing (see utils/preprocessing.prepare_image) is applied to the images
+        :param stride: stride of the encoder the images are padded to, None leaves them as they are
+        :param tokens: token ids of every label without EOS, e.g. from a ManifestIndex. None tokenizes the labels
+        """
         self.image_paths = image_paths
         self.labels = labels
+        self.tokens = tokens
         self.transform = transform
+        self.preprocess = preprocess
+        self.stride = stride
         self.device = device
 
         self.vocab = get_vocabulary(vocab_loc)
@@ -78,26 +120,69 @@ class ImageDataset(Dataset):
 
         # assert self.vocab[0] == '<SOS>' and self.vocab[0] == '<EOS>', 'The third and fourth element of the vocab must be <SOS> and <EOS> respectively'
 
+    @classmethod
+    def from_index(cls, index, vocab_loc, device, indices=None, **kwargs):
+        """
+        Dataset of the samples of a utils/manifest.ManifestIndex, with the labels tokenized by the index
+        :param index: ManifestIndex
+        :param indices: indices of the samples of the index to keep, None keeps them all
+        :param kwargs: transform, preprocess and stride, see __init__
+        """
+        indices = range(len(index)) if indices is None else indices
+        paths = index.image_paths
+        dataset = cls([paths[i] for i in indices], [str(index.labels[i]) for i in indices], vocab_loc, device,
+                      tokens=[index.token_ids(i) for i in indices], **kwargs)
+        if dataset.vocab != index.vocabulary:
+            raise ValueError(f'{index.loc} was tokenized with another vocabulary than {vocab_loc}, build it again')
+        return dataset
+
     def __getitem__(self, index):
-        # Load Image in grayscale, and transform it
-        image = Image.open(self.image_paths[index]).convert('L')
-        if self.transform is not None:
-            image = self.transform(image)
+        image, image_mask = self.get_image(index)
+        tensor_sentence, seq_len, anno_mask = self.get_label(index)
 
-        # Tokenize the label
-        sentence = self.labels[index]
-        if type(sentence) != str:
-            sentence = str(sentence)
+        return image, image_mask, tensor_sentence, seq_len, anno_mask
 
-        tokenized_sentences = self.tokenize(sentence)
+    def get_image(self, index):
+        """
+        :param index: index of the sample
+        :return: the transformed image and its mask
+        """
+        # Load Image in grayscale, preprocess it as at inference and pad it to the stride of the encoder
+        image = np.array(Image.open(self.image_paths[index]).convert('L'))
+        if self.preprocess is not None:
+            image, _ = prepare_image(image, self.preprocess)
+        image_mask = None
+        if self.stride:
+            image, image_mask = pad_to_stride(image, self.stride)
+
+        # Transform it
+        if self.transform is not None:
+            image = self.transform(Image.fromarray(image))
+        else:
+            image = to_tensor(image)
 
         image = image.to(self.device)
-        image_mask = torch.ones_like(image).to(self.device)
+        image_mask = torch.ones_like(image) if image_mask is None else to_tensor(image_mask, scale=1)
+        return image, image_mask.to(self.device)
+
+    def get_label(self, index):
+        """
+        :param index: index of the sample
+        :return: the tokenized label, its length and its mask
+        """
+        # Tokenize the label, unless the index of the dataset already did
+        if self.tokens is not None:
+            tokenized_sentences = [int(i) for i in self.tokens[index]] + [self.word_to_index['<EOS>']]
+        else:
+            sentence = self.labels[index]
+            if type(sentence) != str:
+                sentence = str(sentence)
+            tokenized_sentences = self.tokenize(sentence)
+
         tensor_sentence = torch.tensor(tokenized_sentences).to(self.device)
         anno_mask = torch.ones_like(tensor_sentence).to(self.device)
         seq_len = torch.tensor(len(tensor_sentence)).to(self.device)
-
-        return image, image_mask, tensor_sentence, seq_len, anno_mask
+        return tensor_sentence, seq_len, anno_mask
 
     def __len__(self):
         return len(self.image_paths)
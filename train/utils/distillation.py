@@ -0,0 +1,225 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .datasets import collate_fn
+from .feature_cache import hash_tensor
+
+LOGITS_FILE = 'logits.f16'
+ALPHAS_FILE = 'alphas.f16'
+INDEX_FILE = 'index.npz'
+
+
+def hash_model(model):
+    """
+    :param model: VanillaWAP whose weights are hashed
+    :return: sha1 hex digest of the weights and buffers of the whole model
+    """
+    h = hashlib.sha1()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+def hash_sample(image, label):
+    """
+    :param image: transformed image of a sample
+    :param label: token ids of its label
+    :return: sha1 hex digest of both, the teacher outputs depend on the image and on the tokens it is forced with
+    """
+    return hashlib.sha1((hash_tensor(image) + hash_tensor(label)).encode()).hexdigest()
+
+
+class TeacherCache:
+    """
+    Memory-mapped float16 cache of the outputs of a teacher under teacher forcing: the logits (L, V) and the attention
+    maps (L, Height, Width) of the L tokens of every label. Entries are keyed by the hash of the image and of the label
+    (see hash_sample), so that a sample changed in place is run again, and live in a
+    directory named after the hash of the teacher weights, like FeatureCache, so the teacher runs once for all the
+    epochs of a distillation and for every student distilled from it.
+    """
+    def __init__(self, cache_dir, teacher_hash):
+        """
+        :param cache_dir: root directory of the caches
+        :param teacher_hash: hash of the teacher weights, see hash_model
+        """
+        self.loc = os.path.join(cache_dir, teacher_hash)
+        self.keys, self.paths, self.lengths, self.logit_offsets, self.alpha_offsets, self.alpha_shapes = \
+            [], [], [], [], [], []
+        self.key_to_entry = {}
+        self.vocab_size = None
+        self.logits, self.alphas = None, None
+        if os.path.exists(os.path.join(self.loc, INDEX_FILE)):
+            self.load()
+
+    def load(self):
+        """
+        Load the index and memory-map the outputs
+        """
+        index = np.load(os.path.join(self.loc, INDEX_FILE))
+        if 'keys' not in index:
+            # Index of a cache keyed by path, rebuilt from scratch
+            return
+        self.keys = list(index['keys'])
+        self.paths = list(index['paths'])
+        self.lengths = list(index['lengths'])
+        self.logit_offsets = list(index['logit_offsets'])
+        self.alpha_offsets = list(index['alpha_offsets'])
+        self.alpha_shapes = [tuple(shape) for shape in index['alpha_shapes']]
+        self.vocab_size = int(index['vocab_size'])
+        self.key_to_entry = {key: i for i, key in enumerate(self.keys)}
+        self.map()
+
+    def map(self):
+        self.logits = np.memmap(os.path.join(self.loc, LOGITS_FILE), dtype=np.float16, mode='r')
+        self.alphas = np.memmap(os.path.join(self.loc, ALPHAS_FILE), dtype=np.float16, mode='r')
+
+    def save(self):
+        """
+        Write the index next to the outputs
+        """
+        np.savez(os.path.join(self.loc, INDEX_FILE),
+                 keys=np.array(self.keys), paths=np.array(self.paths), lengths=np.array(self.lengths, dtype=np.int64),
+                 logit_offsets=np.array(self.logit_offsets, dtype=np.int64),
+                 alpha_offsets=np.array(self.alpha_offsets, dtype=np.int64),
+                 alpha_shapes=np.array(self.alpha_shapes, dtype=np.int32).reshape(-1, 2),
+                 vocab_size=self.vocab_size)
+        self.map()
+
+    def __contains__(self, key):
+        return key in self.key_to_entry
+
+    def sizes(self):
+        """
+        :return: number of values of the indexed logits and attention maps, the lengths of the files they occupy
+        """
+        if not self.keys:
+            return 0, 0
+        return (self.logit_offsets[-1] + self.lengths[-1] * self.vocab_size,
+                self.alpha_offsets[-1] + self.lengths[-1] * int(np.prod(self.alpha_shapes[-1])))
+
+    def get(self, key):
+        """
+        :param key: hash of the sample the outputs were computed from, see hash_sample
+        :return: the logits (L, V) and the attention maps (L, Height, Width) of the teacher as float16 tensors
+        """
+        entry = self.key_to_entry[key]
+        length, (height, width) = self.lengths[entry], self.alpha_shapes[entry]
+        start = self.logit_offsets[entry]
+        logits = np.array(self.logits[start:start + length * self.vocab_size]).reshape(length, self.vocab_size)
+        start = self.alpha_offsets[entry]
+        alphas = np.array(self.alphas[start:start + length * height * width]).reshape(length, height, width)
+        return torch.from_numpy(logits), torch.from_numpy(alphas)
+
+
+def build_teacher_cache(teacher, dataset, cache_dir, indices=None, batch_size=16):
+    """
+    Run the teacher once over the samples of dataset with teacher forcing and store its logits and attention maps.
+    Every sample is hashed, so samples already in the cache are not run again while relabelled ones are.
+    :param teacher: VanillaWAP the student is distilled from
+    :param dataset: ImageDataset of the training samples
+    :param cache_dir: root directory of the caches
+    :param indices: indices of the samples to cache, None caches the whole dataset
+    :param batch_size: number of samples run at once
+    :return: the TeacherCache and a dictionary of the key of every sample of indices, see hash_sample
+    """
+    cache = TeacherCache(cache_dir, hash_model(teacher))
+    os.makedirs(cache.loc, exist_ok=True)
+    indices = list(range(len(dataset)) if indices is None else indices)
+    cache.vocab_size = teacher.config['vocab_size']
+    logit_offset, alpha_offset = cache.sizes()
+    keys, batch, batch_keys = {}, [], []
+    added = 0
+    was_training = teacher.training
+    teacher.eval()
+    with open(os.path.join(cache.loc, LOGITS_FILE), 'ab') as f_logits, \
+            open(os.path.join(cache.loc, ALPHAS_FILE), 'ab') as f_alphas, torch.no_grad():
+        # An interrupted build leaves outputs its index never recorded, they are dropped so that the new entries start
+        # where the offsets of the index expect them
+        f_logits.truncate(logit_offset * np.dtype(np.float16).itemsize)
+        f_alphas.truncate(alpha_offset * np.dtype(np.float16).itemsize)
+        for n, i in enumerate(indices):
+            item = dataset[i]
+            keys[i] = hash_sample(item[0], item[2])
+            if keys[i] not in cache and keys[i] not in batch_keys:
+                batch.append(item)
+                batch_keys.append((keys[i], str(dataset.image_paths[i])))
+            if not batch or (len(batch) < batch_size and n < len(indices) - 1):
+                continue
+
+            x, x_mask, y, seq_len, label_mask = collate_fn(batch)
+            logits, alphas = teacher(x, x_mask, y, target_mask=label_mask, return_alphas=True)  # (N, V), (N, H, W)
+
+            # The outputs are packed in the order of the samples, split them back
+            logits = logits.cpu().numpy().astype(np.float16)
+            alphas = alphas.cpu().numpy().astype(np.float16)
+            position = 0
+            for j, (key, path) in enumerate(batch_keys):
+                length = int(seq_len[j])
+                h, w = teacher.feature_size(batch[j][0].shape[-2], batch[j][0].shape[-1])
+                logits[position:position + length].tofile(f_logits)
+                alpha = np.ascontiguousarray(alphas[position:position + length, :h, :w])
+                alpha.tofile(f_alphas)
+                position += length
+
+                cache.key_to_entry[key] = len(cache.keys)
+                cache.keys.append(key)
+                cache.paths.append(path)
+                cache.lengths.append(length)
+                cache.logit_offsets.append(logit_offset)
+                cache.alpha_offsets.append(alpha_offset)
+                cache.alpha_shapes.append((h, w))
+                logit_offset += length * cache.vocab_size
+                alpha_offset += alpha.size
+            added += len(batch)
+            batch, batch_keys = [], []
+    teacher.train(was_training)
+    if added:
+        print(f'Cached the teacher outputs of {added} samples in {cache.loc}')
+    cache.save()
+    return cache, keys
+
+
+class TeacherDataset(Dataset):
+    """
+    Wraps an ImageDataset so that its items carry the cached teacher outputs of the sample as well:
+    (image, image_mask, label, seq_len, label_mask, teacher_logits, teacher_alphas), see distillation_collate_fn
+    """
+    def __init__(self, dataset, cache, keys):
+        """
+        :param dataset: the ImageDataset the cache was built from
+        :param cache: TeacherCache returned by build_teacher_cache
+        :param keys: key of every cached sample by index, returned by build_teacher_cache
+        """
+        self.dataset = dataset
+        self.cache = cache
+        self.keys = keys
+
+    def __getattr__(self, name):
+        # Expose the vocabulary of the wrapped dataset
+        if name in ('dataset', 'cache', 'keys'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, index):
+        logits, alphas = self.cache.get(self.keys[index])
+        return (*self.dataset[index], logits, alphas)
+
+    def __len__(self):
+        return len(self.dataset)
+
+
+def distillation_collate_fn(batch):
+    """
+    :return: the outputs of collate_fn, the teacher logits packed like the output of VanillaWAP.forward() with a
+    target_mask - (N, V), and the teacher attention maps zero padded to the largest map of the batch - (N, H, W)
+    """
+    logits, alphas = [item[5] for item in batch], [item[6] for item in batch]
+    height, width = max(alpha.shape[1] for alpha in alphas), max(alpha.shape[2] for alpha in alphas)
+    alphas = [torch.nn.functional.pad(alpha, (0, width - alpha.shape[2], 0, height - alpha.shape[1]))
+              for alpha in alphas]
+    return (*collate_fn([item[:5] for item in batch]), torch.cat(logits), torch.cat(alphas))
@@ -0,0 +1,183 @@
+import hashlib
+import os
+
+import numpy as np
+import torch
+from torch.utils.data import Dataset
+
+from .datasets import collate_fn
+
+FEATURES_FILE = 'features.f16'
+INDEX_FILE = 'index.npz'
+
+
+def hash_tensor(tensor):
+    """
+    :param tensor: tensor to hash, e.g. a transformed image
+    :return: sha1 hex digest of the shape and the content of the tensor
+    """
+    array = tensor.detach().cpu().contiguous().numpy()
+    h = hashlib.sha1(str(array.shape).encode())
+    h.update(array.tobytes())
+    return h.hexdigest()
+
+
+def hash_encoder(model):
+    """
+    :param model: VanillaWAP whose watcher is hashed
+    :return: sha1 hex digest of the watcher weights and buffers (e.g. batch norm statistics)
+    """
+    h = hashlib.sha1()
+    for name, tensor in model.watcher.state_dict().items():
+        h.update(name.encode())
+        h.update(tensor.detach().cpu().contiguous().numpy().tobytes())
+    return h.hexdigest()
+
+
+class FeatureCache:
+    """
+    Memory-mapped float16 cache of the feature maps computed by VanillaWAP.watch(). Entries are keyed by the hash of
+    the transformed image and live in a directory named after the hash of the encoder weights, so a cache built with
+    other weights is never picked up by mistake.
+    """
+    def __init__(self, cache_dir, encoder_hash):
+        """
+        :param cache_dir: root directory of the caches
+        :param encoder_hash: hash of the encoder weights, see hash_encoder
+        """
+        self.loc = os.path.join(cache_dir, encoder_hash)
+        self.encoder_hash = encoder_hash
+        self.hashes, self.paths, self.offsets, self.shapes = [], [], [], []
+        self.hash_to_entry = {}
+        self.features = None
+        if os.path.exists(os.path.join(self.loc, INDEX_FILE)):
+            self.load()
+
+    def load(self):
+        """
+        Load the index and memory-map the features
+        """
+        index = np.load(os.path.join(self.loc, INDEX_FILE))
+        self.hashes = list(index['hashes'])
+        self.paths = list(index['paths'])
+        self.offsets = list(index['offsets'])
+        self.shapes = [tuple(shape) for shape in index['shapes']]
+        self.hash_to_entry = {h: i for i, h in enumerate(self.hashes)}
+        self.features = np.memmap(os.path.join(self.loc, FEATURES_FILE), dtype=np.float16, mode='r')
+
+    def save(self):
+        """
+        Write the index next to the features file
+        """
+        np.savez(os.path.join(self.loc, INDEX_FILE),
+                 hashes=np.array(self.hashes), paths=np.array(self.paths),
+                 offsets=np.array(self.offsets, dtype=np.int64),
+                 shapes=np.array(self.shapes, dtype=np.int32).reshape(-1, 3))
+        self.features = np.memmap(os.path.join(self.loc, FEATURES_FILE), dtype=np.float16, mode='r')
+
+    def __contains__(self, image_hash):
+        return image_hash in self.hash_to_entry
+
+    def size(self):
+        """
+        :return: number of values of the indexed entries, the length of the features file they occupy
+        """
+        return self.offsets[-1] + int(np.prod(self.shapes[-1])) if self.offsets else 0
+
+    def get(self, image_hash):
+        """
+        :param image_hash: hash of the transformed image the features were computed from, see hash_tensor
+        :return: the feature map (D, H, W) as a float32 tensor and its mask (1, H, W)
+        """
+        entry = self.hash_to_entry[image_hash]
+        shape = self.shapes[entry]
+        size = shape[0] * shape[1] * shape[2]
+        features = np.array(self.features[self.offsets[entry]:self.offsets[entry] + size], dtype=np.float32)
+        features = torch.from_numpy(features.reshape(shape))
+        return features, torch.ones((1, shape[1], shape[2]))
+
+
+def build_feature_cache(model, dataset, cache_dir, batch_size=16):
+    """
+    Run VanillaWAP.watch() once over the images of dataset and store the feature maps. Every image is hashed, so an
+    image already in the cache, or identical to one that is, is not encoded again, while an image changed in place is.
+    :param model: VanillaWAP providing the encoder
+    :param dataset: ImageDataset whose images are encoded
+    :param cache_dir: root directory of the caches
+    :param batch_size: number of images encoded at once
+    :return: the FeatureCache and the hash of every image of dataset, the keys of their features
+    """
+    cache = FeatureCache(cache_dir, hash_encoder(model))
+    os.makedirs(cache.loc, exist_ok=True)
+    offset = cache.size()
+    hashes, batch, paths, batch_hashes = [], [], [], []
+    added = 0
+    was_training = model.training
+    model.eval()
+    with open(os.path.join(cache.loc, FEATURES_FILE), 'ab') as f, torch.no_grad():
+        # An interrupted build leaves features its index never recorded, they are dropped so that the new entries
+        # start where the offsets of the index expect them
+        f.truncate(offset * np.dtype(np.float16).itemsize)
+        for i in range(len(dataset)):
+            image, image_mask = dataset.get_image(i)
+            image_hash = hash_tensor(image)
+            hashes.append(image_hash)
+            if image_hash not in cache and image_hash not in batch_hashes:
+                batch.append((image, image_mask, torch.zeros(1), torch.zeros(1), torch.zeros(1)))
+                paths.append(str(dataset.image_paths[i]))
+                batch_hashes.append(image_hash)
+            if not batch or (len(batch) < batch_size and i < len(dataset) - 1):
+                continue
+
+            images, image_masks, _, _, _ = collate_fn(batch)
+            features, feature_masks = model.watch(images, image_masks)
+            for j in range(len(batch)):
+                # Trim the padding the collate function introduced
+                h, w = model.feature_size(batch[j][0].shape[-2], batch[j][0].shape[-1])
+                item = features[j, :, :h, :w].cpu().numpy().astype(np.float16)
+                item.tofile(f)
+
+                cache.hash_to_entry[batch_hashes[j]] = len(cache.hashes)
+                cache.hashes.append(batch_hashes[j])
+                cache.paths.append(paths[j])
+                cache.offsets.append(offset)
+                cache.shapes.append(item.shape)
+                offset += item.size
+            added += len(batch)
+            batch, paths, batch_hashes = [], [], []
+    model.train(was_training)
+    if added:
+        print(f'Cached the encoder features of {added} images in {cache.loc}')
+    cache.save()
+    return cache, hashes
+
+
+class CachedFeatureDataset(Dataset):
+    """
+    Wraps an ImageDataset so that it yields the cached encoder features instead of the images. Items keep the layout
+    of ImageDataset, (features, feature_mask, label, seq_len, label_mask), so collate_fn pads them the same way.
+    """
+    def __init__(self, dataset, cache, hashes):
+        """
+        :param dataset: the ImageDataset the cache was built from
+        :param cache: FeatureCache returned by build_feature_cache
+        :param hashes: hash of every image of dataset, returned by build_feature_cache
+        """
+        self.dataset = dataset
+        self.cache = cache
+        self.hashes = hashes
+
+    def __getattr__(self, name):
+        # Expose the vocabulary of the wrapped dataset
+        if name in ('dataset', 'cache', 'hashes'):
+            raise AttributeError(name)
+        return getattr(self.dataset, name)
+
+    def __getitem__(self, index):
+        features, feature_mask = self.cache.get(self.hashes[index])
+        tensor_sentence, seq_len, anno_mask = self.dataset.get_label(index)
+        device = self.dataset.device
+        return features.to(device), feature_mask.to(device), tensor_sentence, seq_len, anno_mask
+
+    def __len__(self):
+        return len(self.dataset)
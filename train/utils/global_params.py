@@ -40,6 +40,11 @@ BASE_CONFIG = {
                                [None, None, None, (2, 2)], [None, None, None, (2, 2)]],
     'conv_dropout': [[0] * 4, [0] * 4, [0] * 4, [0.2] * 4],
     'batch_norm': [[True] * 4, [True] * 4, [True] * 4, [True] * 4],
+    'backbone': 'vgg',
+    'dense_growth_rate': 24,
+    'dense_layers': [4, 4, 4, 4],
+    'dense_compression': 0.5,
+    'dense_dropout': 0.2,
     'DEVICE': 'cuda' if torch.cuda.is_available() else 'cpu',
     'hidden_dim': 256,
     'attention_dim': 128,
@@ -52,6 +57,18 @@ BASE_CONFIG = {
     'dropout': 0.2,
     'max_len': 200,
     'beam_width': 5,
+    'store_attention': False,
+    'attention_topk': None,
+    'attention_mode': 'dense',
+    'attention_ink_only': False,
+    'ink_dilation': 1,
+    'encoder_mode': 'full',
+    'tile_size': 512,
+    'tile_overlap': 128,
+    'tile_batch': 8,
+    'max_pixels': None,
+    'crop_to_ink': False,
+    'constrained_decoding': False,
     'train_params': {
         'random_seed': 42,
         'lr': 0.0002,
@@ -59,6 +76,21 @@ BASE_CONFIG = {
         'lr_decay': 0.5,
         'weight_decay': 0.0001,
         'clip_grad_norm': 100,
+        'label_smoothing': 0.0,
+        'loss_normalization': 'sequence',
+        'sampling_schedule': None,
+        'sampling_max_prob': 0.25,
+        'sampling_steps': 10000,
+        'augment': False,
+        'augment_params': None,
+        'checkpoint_watcher': None,
+        'checkpoint_decoder_chunk': 0,
+        'distill_teacher': None,
+        'distill_cache': 'teacher_cache',
+        'distill_temperature': 2.0,
+        'distill_soft_weight': 0.5,
+        'distill_attention_weight': 0.1,
+        'manifest_index': None,
         'lr_decay_step': 10,
         'print_every': 100,
         'save_every': 10,
@@ -71,10 +103,46 @@ BASE_CONFIG = {
         'load_iter': 20,
         'load_best_epoch': 0,
         'batch_size': BATCH_SIZE,
+        'freeze_watcher': False,
+        'feature_cache': None,
+        'profile': False,
+        'profile_trace': False,
+        'profile_loc': 'profiles',
     }
 }
 
 BASE_CONFIG['output_dim'] = BASE_CONFIG['input_dim']
+
+# Preprocessing of the images (see utils/preprocessing.prepare_image), shared by training and inference so that the
+# model is trained on images prepared the way it is served them: cropped to the ink and bounded in pixel count
+PREPROCESS_CONFIG = {'crop_to_ink': True, 'max_pixels': 1024 * 1024}
+
+# Inference CONFIG. Uploads can be full page scans: crop them to the ink, bound their pixel count and encode large ones
+# in tiles so that the memory and the latency do not depend on the upload size. The sparse attention gives the same
+# results as the dense one while skipping the padding of batched images
+INFERENCE_CONFIG = dict(BASE_CONFIG, **PREPROCESS_CONFIG, encoder_mode='tiled', attention_mode='sparse',
+                        constrained_decoding=True)
+
+# Student CONFIG distilled from a teacher trained with BASE_CONFIG (train_params['distill_teacher']). Two narrower
+# layers per block instead of four keep the stride of the encoder, so the student attends over the same cells as the
+# teacher and can be trained on its attention maps
+STUDENT_CONFIG = dict(
+    BASE_CONFIG,
+    num_layers=[2, 2, 2, 2],
+    num_features_map=[[16, 16], [32, 32], [48, 48], [96, 96]],
+    feature_kernel_size=[[3, 3]] * 4,
+    feature_kernel_stride=[[1, 1]] * 4,
+    feature_padding=[[1, 1]] * 4,
+    feature_pooling_kernel_size=[[None, (2, 2)]] * 4,
+    feature_pooling_stride=[[None, (2, 2)]] * 4,
+    conv_dropout=[[0, 0], [0, 0], [0, 0], [0.2, 0.2]],
+    batch_norm=[[True, True]] * 4,
+    hidden_dim=128,
+    attention_dim=64,
+    coverage_dim=64,
+    embedding_dim=128,
+    train_params=dict(BASE_CONFIG['train_params'], save_loc='checkpoints/student'),
+)
 # for i in range(BASE_CONFIG['num_layers']):
 #     dim, p, s, k = (BASE_CONFIG['output_dim'], BASE_CONFIG['feature_padding'][i],
 #                     BASE_CONFIG['feature_kernel_stride'][i], BASE_CONFIG['feature_kernel_size'][i])
@@ -0,0 +1,170 @@
+import torch
+
+# Modes of the automaton: what the next token has to be
+FREE = 0  # anything, e.g. after an atom or a closed group
+OPERAND = 1  # the operand of _ or ^: an atom or a group
+FRAC = 2  # the numerator of \frac: a group
+SQRT = 3  # the argument of \sqrt: a group, or the [ of its optional index
+DENOMINATOR = 4  # the denominator of \frac: a group
+RADICAND = 5  # the argument of \sqrt after its index: a group
+
+# Kinds of the open groups
+GROUP = 0
+NUMERATOR = 1
+SQRT_INDEX = 2  # closed by ], which leaves the radicand to come
+BRACKET = 3  # a literal [ closed by ]
+
+# Tokens the automaton tells apart, every other one being an atom
+STRUCTURE = {'{', '}', '[', ']', '_', '^', '\\frac', '\\sqrt', '<EOS>', '<SOS>'}
+
+
+class LatexGrammar:
+    """
+    Structure automaton of the latex token sequences produced by visit_node (see data_utils.py): macros are single
+    tokens, groups are delimited by { and }, and _ and ^ take an atom or a group. Brackets are balanced like groups,
+    the [ right after \sqrt opening its index rather than a literal bracket. The automaton keeps the kinds of the
+    open groups on a stack bounded by max_depth, so it has a finite number of states. These are enumerated once and
+    compiled into:
+    - masks (S, V): the tokens allowed in every state
+    - transitions (S, V): the state reached by every allowed token
+    - finish_steps (S): the least number of tokens needed to reach <EOS> from every state
+    so that constraining a batch of decoders is a few gathers per step.
+    """
+    def __init__(self, vocabulary, max_depth=6, max_brackets=2):
+        """
+        :param vocabulary: list of the tokens, index i being the token of the logit i (see get_vocabulary)
+        :param max_depth: maximum nesting of the groups and brackets, the training captions nesting at most 5 deep
+        :param max_brackets: maximum number of brackets open at once, each one multiplying the number of states
+        """
+        self.vocabulary = vocabulary
+        self.max_depth = max_depth
+        self.max_brackets = max_brackets
+
+        # Enumerate the states reachable from the start state, a state being (stack, mode) or 'end' after <EOS>. The
+        # tokens which are not in STRUCTURE are atoms and all lead to the same state
+        atom = next(word for word in vocabulary if word not in STRUCTURE)
+        words = [word if word in STRUCTURE else atom for word in vocabulary]
+        start = ((), FREE)
+        self.states = [start, 'end']
+        self.state_to_index = {start: 0, 'end': 1}
+        rows = []
+        i = 0
+        while i < len(self.states):
+            state = self.states[i]
+            targets = {}
+            for word in set(words):
+                target = self.step(state, word)
+                if target is not None and target not in self.state_to_index:
+                    self.state_to_index[target] = len(self.states)
+                    self.states.append(target)
+                targets[word] = -1 if target is None else self.state_to_index[target]
+            rows.append([targets[word] for word in words])
+            i += 1
+
+        self.transitions = torch.tensor(rows, dtype=torch.long)
+        num_states = len(self.states)
+        self.masks = self.transitions >= 0
+
+        # Least number of tokens to <EOS>, by relaxing the transitions backwards until nothing changes
+        self.finish_steps = torch.full((num_states,), 10 ** 6, dtype=torch.long)
+        self.finish_steps[self.state_to_index['end']] = 0
+        while True:
+            steps = torch.where(self.masks, self.finish_steps[self.transitions.clamp(min=0)] + 1, 10 ** 6)
+            steps = torch.minimum(steps.min(dim=1).values, self.finish_steps)
+            if torch.equal(steps, self.finish_steps):
+                break
+            self.finish_steps = steps
+        self.finish_steps[self.state_to_index['end']] = 0
+
+    def step(self, state, word):
+        """
+        :param state: (stack, mode) or 'end'
+        :param word: next token
+        :return: the state reached with word, or None if word is not allowed in state
+        """
+        if word == '<SOS>':
+            return None
+        if state == 'end':
+            return 'end' if word == '<EOS>' else None
+        stack, mode = state
+
+        if word == '{':
+            if len(stack) == self.max_depth:
+                return None
+            return stack + (NUMERATOR if mode == FRAC else GROUP,), FREE
+        if mode in (FRAC, DENOMINATOR, RADICAND):
+            return None
+        if word == '[':
+            # A bracket right inside the index of a radical would close it
+            if len(stack) == self.max_depth or mode == OPERAND or (stack and stack[-1] == SQRT_INDEX) or \
+                    sum(kind in (SQRT_INDEX, BRACKET) for kind in stack) == self.max_brackets:
+                return None
+            return stack + (SQRT_INDEX if mode == SQRT else BRACKET,), FREE
+        if mode == SQRT:
+            return None
+
+        if word == '}':
+            if not stack or stack[-1] not in (GROUP, NUMERATOR) or mode == OPERAND:
+                return None
+            return stack[:-1], DENOMINATOR if stack[-1] == NUMERATOR else FREE
+        if word == ']':
+            if not stack or stack[-1] not in (SQRT_INDEX, BRACKET) or mode == OPERAND:
+                return None
+            return stack[:-1], RADICAND if stack[-1] == SQRT_INDEX else FREE
+        if word == '<EOS>':
+            return 'end' if not stack and mode == FREE else None
+        if word in ('_', '^'):
+            return (stack, OPERAND) if mode == FREE else None
+        if word in ('\\frac', '\\sqrt'):
+            # Their arguments open a group
+            if len(stack) == self.max_depth:
+                return None
+            return stack, FRAC if word == '\\frac' else SQRT
+        return stack, FREE
+
+    def to(self, device):
+        self.transitions = self.transitions.to(device)
+        self.masks = self.masks.to(device)
+        self.finish_steps = self.finish_steps.to(device)
+        return self
+
+    def start(self, batch_size, device='cpu'):
+        """
+        :return: the start state of every sequence of a batch - (B). The tables follow the device of the batch
+        """
+        if self.masks.device != torch.device(device):
+            self.to(device)
+        return torch.zeros(batch_size, dtype=torch.long, device=device)
+
+    def constrain(self, logit, state, remaining):
+        """
+        :param logit: logits of a step - (B, V)
+        :param state: states of the sequences - (B)
+        :param remaining: number of steps left including this one, tokens that could not reach <EOS> in time are masked
+        :return: logit with the disallowed tokens set to -inf
+        """
+        transitions = self.transitions[state]  # (B, V)
+        allowed = self.masks[state] & (self.finish_steps[transitions.clamp(min=0)] < remaining)
+        return logit.masked_fill(~allowed, -torch.inf)
+
+    def advance(self, state, token):
+        """
+        :param state: states of the sequences - (B)
+        :param token: tokens emitted by the sequences - (B)
+        :return: the next states - (B)
+        """
+        return self.transitions[state, token]
+
+    def is_valid(self, tokens):
+        """
+        :param tokens: token indices of one sequence, up to and including <EOS>
+        :return: whether the sequence is accepted by the automaton
+        """
+        state = self.states[0]
+        for token in tokens:
+            state = self.step(state, self.vocabulary[int(token)])
+            if state is None:
+                return False
+            if state == 'end':
+                return True
+        return False
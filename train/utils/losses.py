@@ -0,0 +1,81 @@
+import torch
+from torch import nn
+
+
+class MaskedCrossEntropy(nn.Module):
+    """
+    Cross entropy computed only on the non-pad positions of the targets. The logits of those positions are packed into
+    a (N, V) tensor before the loss, so no log-probability copy of the padded (B, L, V) logits is ever made.
+    """
+    def __init__(self, label_smoothing=0.0, normalization='sequence'):
+        """
+        :param label_smoothing: amount of probability mass spread uniformly over the vocabulary, 0 disables it
+        :param normalization: 'sequence' sums the loss over the tokens of a sequence and averages over the batch,
+        'token' averages over all the non-pad tokens of the batch
+        """
+        super().__init__()
+        if normalization not in ('sequence', 'token'):
+            raise ValueError('normalization must be either sequence or token')
+        self.label_smoothing = label_smoothing
+        self.normalization = normalization
+
+    def forward(self, logit, target, label_mask):
+        """
+        :param logit: logits of every position (B, L, V), or of the non-pad positions only (N, V)
+        :param target: target tokens - (B, L)
+        :param label_mask: 1 on the non-pad positions of target - (B, L)
+        :return: the loss
+        """
+        mask = label_mask.bool()
+        if logit.dim() == 3:
+            logit = logit[mask]  # (N, V)
+        loss = nn.functional.cross_entropy(logit, target[mask], reduction='sum', label_smoothing=self.label_smoothing)
+        if self.normalization == 'token':
+            return loss / mask.sum().clamp(min=1)
+        return loss / target.shape[0]
+
+
+class DistillationLoss(nn.Module):
+    """
+    Loss of a student trained against a teacher (see utils/distillation.py), on the non-pad positions only:
+    - the cross entropy with the ground truth, weighted by 1 - soft_weight
+    - the KL divergence between the teacher and student distributions softened by temperature, weighted by soft_weight
+      and scaled by temperature ** 2 so that its gradients keep their magnitude when the temperature changes
+    - the KL divergence between the teacher and student attention maps, weighted by attention_weight
+    All three are normalized like MaskedCrossEntropy.
+    """
+    def __init__(self, temperature=2.0, soft_weight=0.5, attention_weight=0.1, label_smoothing=0.0,
+                 normalization='sequence'):
+        super().__init__()
+        self.hard = MaskedCrossEntropy(label_smoothing, normalization)
+        self.temperature = temperature
+        self.soft_weight = soft_weight
+        self.attention_weight = attention_weight
+        self.normalization = normalization
+
+    def forward(self, logit, alpha, target, label_mask, teacher_logit, teacher_alpha):
+        """
+        :param logit: student logits of the non-pad positions - (N, V)
+        :param alpha: student attention weights of the non-pad positions - (N, Height, Width)
+        :param target: target tokens - (B, L)
+        :param label_mask: 1 on the non-pad positions of target - (B, L)
+        :param teacher_logit: teacher logits of the same positions - (N, V)
+        :param teacher_alpha: teacher attention weights of the same positions, over the same or fewer cells
+        :return: the loss
+        """
+        norm = label_mask.sum().clamp(min=1) if self.normalization == 'token' else target.shape[0]
+        hard = self.hard(logit, target, label_mask)
+
+        t = self.temperature
+        soft = nn.functional.kl_div(nn.functional.log_softmax(logit / t, dim=-1),
+                                    nn.functional.log_softmax(teacher_logit.float() / t, dim=-1),
+                                    reduction='sum', log_target=True) * t ** 2 / norm
+
+        # The teacher maps were trimmed to the feature map of their own image, pad them to the one of the batch
+        teacher_alpha = teacher_alpha.float()
+        padding = (0, alpha.shape[-1] - teacher_alpha.shape[-1], 0, alpha.shape[-2] - teacher_alpha.shape[-2])
+        teacher_alpha = nn.functional.pad(teacher_alpha, padding)
+        attention = (teacher_alpha * (torch.log(teacher_alpha.clamp(min=1e-8)) - torch.log(alpha.clamp(min=1e-8))))
+        attention = attention.sum() / norm
+
+        return (1 - self.soft_weight) * hard + self.soft_weight * soft + self.attention_weight * attention
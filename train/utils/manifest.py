@@ -0,0 +1,261 @@
+# Index of a labelled dataset, built once so that loading, sampling and splitting never open an image. Run from the
+# root of the repository:
+#   python -m train.utils.manifest --manifest data/CROHME/train/wap_dataset.csv \
+#       --image_dir data/CROHME/train/off_image_train --output data/CROHME/train/index.npz --workers 8
+# The images of the manifest are scanned by a process pool. The index stores, for every sample, its path relative to
+# the index, the sha1 of the file, its size, the bounding box of its ink and its token ids, and links every image to
+# the first sample with the same content.
+# The index is an npz, like the feature and teacher caches: the columns are numpy arrays of different lengths (the
+# tokens of all the labels in one flat array) that np.load reads back as is, so no table library is involved.
+import argparse
+import hashlib
+import io
+import os
+import time
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+from torch.utils.data import Sampler, random_split
+
+from .datasets import get_vocabulary
+from .global_params import VOCAB_LOC
+from .preprocessing import ink_bbox, invert_if_light
+
+
+def resolve(path, image_dir=None):
+    """
+    :param path: path of an image as written in a manifest, possibly on another machine
+    :param image_dir: directory the image is looked up in by file name when path does not exist
+    :return: the path of the image on this machine
+    """
+    if image_dir is None or os.path.exists(path):
+        return path
+    return os.path.join(image_dir, os.path.basename(path))
+
+
+def scan_image(path):
+    """
+    Run by the processes of the pool
+    :param path: path of an image
+    :return: (sha1 hex digest, height, width, (top, bottom, left, right) of the ink). The size is 0 x 0 if the image
+    cannot be read, and the ink bounds are -1 if it has no ink
+    """
+    try:
+        with open(path, 'rb') as f:
+            data = f.read()
+        image = invert_if_light(np.array(Image.open(io.BytesIO(data)).convert('L')))
+    except OSError:
+        return '', 0, 0, (-1, -1, -1, -1)
+    bbox = ink_bbox(image)
+    return hashlib.sha1(data).hexdigest(), image.shape[0], image.shape[1], bbox if bbox is not None else (-1,) * 4
+
+
+def build_index(manifest, output, image_dir=None, vocab_loc=VOCAB_LOC, workers=4):
+    """
+    :param manifest: tab separated file with the image_loc and label columns, like wap_dataset.csv
+    :param output: location of the npz index. The paths it stores are relative to its directory
+    :param image_dir: directory the images are looked up in by file name, for manifests written on another machine
+    :param vocab_loc: vocabulary the labels are tokenized with
+    :param workers: number of processes scanning the images
+    :return: the ManifestIndex
+    """
+    data = pd.read_csv(manifest, sep='\t')
+    paths = [resolve(path, image_dir) for path in data['image_loc']]
+    labels = [str(label) for label in data['label']]
+    with Pool(workers) as pool:
+        scans = pool.map(scan_image, paths, chunksize=max(1, len(paths) // (16 * workers)))
+    hashes, heights, widths, bboxes = zip(*scans) if scans else ((), (), (), ())
+
+    # Token ids in one flat array, sample i owns tokens[offsets[i]:offsets[i + 1]], EOS excluded. Words missing from
+    # the vocabulary are -1
+    vocabulary = get_vocabulary(vocab_loc)
+    word_to_index = {word: i for i, word in enumerate(vocabulary)}
+    tokens = [[word_to_index.get(word, -1) for word in label.split()] for label in labels]
+    offsets = np.cumsum([0] + [len(t) for t in tokens])
+
+    # Every image points to the first sample with the same content, itself if it is the first
+    first = {}
+    duplicate_of = np.array([first.setdefault(h, i) if h else i for i, h in enumerate(hashes)], dtype=np.int64)
+
+    root = os.path.dirname(os.path.abspath(output))
+    os.makedirs(root, exist_ok=True)
+    np.savez(output,
+             paths=np.array([os.path.relpath(os.path.abspath(path), root) for path in paths]),
+             labels=np.array(labels), hashes=np.array(hashes, dtype='S40'),
+             heights=np.array(heights, dtype=np.int32), widths=np.array(widths, dtype=np.int32),
+             bboxes=np.array(bboxes, dtype=np.int32).reshape(-1, 4),
+             tokens=np.array([i for t in tokens for i in t], dtype=np.int16), offsets=offsets.astype(np.int64),
+             duplicate_of=duplicate_of, vocabulary=np.array(vocabulary))
+    return ManifestIndex(output)
+
+
+class ManifestIndex:
+    """
+    Read side of build_index. Everything is loaded from the npz at once, so that building a dataset, planning a split or
+    bucketing the batches takes milliseconds whatever the size of the corpus.
+    """
+    def __init__(self, loc):
+        """
+        :param loc: location of the npz written by build_index
+        """
+        self.loc = loc
+        self.root = os.path.dirname(os.path.abspath(loc))
+        index = np.load(loc)
+        self.paths = index['paths']
+        self.labels = index['labels']
+        self.hashes = index['hashes']
+        self.heights, self.widths = index['heights'], index['widths']
+        self.bboxes = index['bboxes']
+        self.tokens, self.offsets = index['tokens'], index['offsets']
+        self.duplicate_of = index['duplicate_of']
+        self.vocabulary = list(index['vocabulary'])
+
+    def __len__(self):
+        return len(self.paths)
+
+    @property
+    def image_paths(self):
+        return [os.path.normpath(os.path.join(self.root, path)) for path in self.paths]
+
+    @property
+    def lengths(self):
+        """
+        :return: number of tokens of every label, EOS excluded
+        """
+        return np.diff(self.offsets)
+
+    def token_ids(self, i):
+        """
+        :return: token ids of the label of sample i, EOS excluded
+        """
+        return self.tokens[self.offsets[i]:self.offsets[i + 1]]
+
+    def valid(self):
+        """
+        :return: mask of the samples whose image could be read and whose label only has words of the vocabulary
+        """
+        owners = np.repeat(np.arange(len(self)), self.lengths)
+        unknown = np.bincount(owners[self.tokens < 0], minlength=len(self))
+        return (self.heights > 0) & (unknown == 0)
+
+    def duplicates(self):
+        """
+        :return: mask of the samples whose image is a copy of an earlier sample
+        """
+        return self.duplicate_of != np.arange(len(self))
+
+    def conflicts(self):
+        """
+        :return: indices of the duplicates labelled differently from the image they copy
+        """
+        duplicates = np.flatnonzero(self.duplicates())
+        return duplicates[self.labels[duplicates] != self.labels[self.duplicate_of[duplicates]]]
+
+    def input_sizes(self, config, margin=8):
+        """
+        :param config: config whose preprocessing (see utils/preprocessing.prepare_image) is applied to the images
+        :param margin: margin of utils/preprocessing.crop_to_ink
+        :return: (height, width) of every image after the preprocessing - (N, 2)
+        """
+        sizes = np.stack([self.heights, self.widths], axis=1).astype(np.float64)
+        if config.get('crop_to_ink'):
+            inked = self.bboxes[:, 0] >= 0
+            top, left = np.maximum(0, self.bboxes[:, 0] - margin), np.maximum(0, self.bboxes[:, 2] - margin)
+            bottom = np.minimum(self.heights, self.bboxes[:, 1] + margin)
+            right = np.minimum(self.widths, self.bboxes[:, 3] + margin)
+            sizes = np.where(inked[:, None], np.stack([bottom - top, right - left], axis=1), sizes)
+        if config.get('max_pixels'):
+            scale = np.sqrt(np.minimum(1., config['max_pixels'] / np.maximum(sizes.prod(axis=1), 1)))
+            sizes = np.where(scale[:, None] < 1, np.maximum(1, np.floor(sizes * scale[:, None])), sizes)
+        return sizes.astype(np.int64)
+
+    def split(self, fractions, seed, keep_duplicates_together=True):
+        """
+        Split of the samples drawn like random_split(range(len(index)), fractions) in train.py, so that a run with an
+        index splits the data as a run without one
+        :param fractions: fraction of the samples of every split
+        :param seed: seed of the generator of the split
+        :param keep_duplicates_together: move every duplicate to the split of the image it copies, so that no image of
+        the validation split was seen in training
+        :return: sorted indices of every split
+        """
+        subsets = random_split(range(len(self)), fractions, generator=torch.Generator().manual_seed(seed))
+        assignment = np.empty(len(self), dtype=np.int64)
+        for k, subset in enumerate(subsets):
+            assignment[subset.indices] = k
+        if keep_duplicates_together:
+            assignment = assignment[self.duplicate_of]
+        return [np.flatnonzero(assignment == k) for k in range(len(subsets))]
+
+    def summary(self):
+        """
+        :return: dictionary of the statistics of the index
+        """
+        lengths = self.lengths
+        return {'samples': len(self), 'unreadable': int((self.heights == 0).sum()),
+                'invalid': int((~self.valid()).sum()), 'duplicates': int(self.duplicates().sum()),
+                'conflicting_duplicates': len(self.conflicts()), 'no_ink': int((self.bboxes[:, 0] < 0).sum()),
+                'median_size': [int(np.median(self.heights)), int(np.median(self.widths))] if len(self) else None,
+                'max_tokens': int(lengths.max()) if len(self) else 0}
+
+
+class BucketBatchSampler(Sampler):
+    """
+    Batches of samples of similar size, so that little of a batch is padding. Every epoch, the samples are shuffled,
+    cut into pools of pool_batches batches, sorted by area within a pool, and the batches are shuffled again.
+    """
+    def __init__(self, sizes, batch_size, pool_batches=50, seed=0, drop_last=False):
+        """
+        :param sizes: (height, width) of every sample once preprocessed, see ManifestIndex.input_sizes - (N, 2)
+        :param batch_size: number of samples of a batch
+        :param pool_batches: number of batches sorted together, 1 keeps the batches random
+        :param seed: seed of the shuffling, the epoch is added to it
+        :param drop_last: drop the last incomplete batch
+        """
+        self.areas = np.asarray(sizes).prod(axis=1)
+        self.batch_size = batch_size
+        self.pool_batches = pool_batches
+        self.seed = seed
+        self.drop_last = drop_last
+        self.epoch = 0
+
+    def __iter__(self):
+        rng = np.random.default_rng(self.seed + self.epoch)
+        self.epoch += 1
+        order = rng.permutation(len(self.areas))
+        pool = self.batch_size * self.pool_batches
+        batches = []
+        for start in range(0, len(order), pool):
+            chunk = order[start:start + pool]
+            chunk = chunk[np.argsort(self.areas[chunk], kind='stable')]
+            batches += [chunk[i:i + self.batch_size] for i in range(0, len(chunk), self.batch_size)]
+        if self.drop_last:
+            batches = [batch for batch in batches if len(batch) == self.batch_size]
+        for i in rng.permutation(len(batches)):
+            yield batches[i].tolist()
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.areas) // self.batch_size
+        return -(-len(self.areas) // self.batch_size)
+
+
+def main(args):
+    start = time.perf_counter()
+    index = build_index(args.manifest, args.output, args.image_dir, args.vocab, args.workers)
+    print(f'Indexed {len(index)} samples in {time.perf_counter() - start:.1f}s to {args.output}')
+    for key, value in index.summary().items():
+        print(f'{key:>24}: {value}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Index the images and labels of a manifest')
+    parser.add_argument('--manifest', required=True, help='tab separated file with the image_loc and label columns')
+    parser.add_argument('--output', required=True, help='npz index to write')
+    parser.add_argument('--image_dir', default=None, help='directory the images are looked up in by file name')
+    parser.add_argument('--vocab', default=VOCAB_LOC)
+    parser.add_argument('--workers', type=int, default=4)
+    main(parser.parse_args())
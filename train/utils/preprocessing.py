@@ -0,0 +1,124 @@
+import numpy as np
+import torch
+from PIL import Image
+
+# Pixels brighter than this are ink. Images are white ink on a black background
+INK_THRESHOLD = 127
+
+
+# binarize, is_light, invert_if_light, pad_to_stride and to_tensor work on a single uint8 image (H, W) or on a batch
+# of images of the same size (N, H, W). ink_bbox, crop_to_ink, resize_to_budget and prepare_image take a single image,
+# since the crop and the size they produce differ from one image to the next
+
+
+def binarize(images, threshold=INK_THRESHOLD):
+    """
+    :param images: uint8 images - (..., H, W)
+    :param threshold: pixel value above which a pixel is ink
+    :return: the images with their ink set to 255 and their background to 0
+    """
+    return (images > threshold).astype(np.uint8) * np.uint8(255)
+
+
+def is_light(images):
+    """
+    :param images: uint8 images - (..., H, W)
+    :return: whether the background of every image is light, i.e. its ink is dark - (...)
+    """
+    return images.mean(axis=(-2, -1)) > 127.5
+
+
+def invert_if_light(images):
+    """
+    Bring dark ink on a light background (e.g. scans) to the bright ink on black the model is trained on
+    :param images: uint8 images - (..., H, W)
+    :return: the images, binarized and inverted where their background is light
+    """
+    light = is_light(images)
+    if not np.any(light):
+        return images
+    return np.where(light[..., None, None], binarize(255 - images, 25), images)
+
+
+def ink_bbox(image, threshold=INK_THRESHOLD):
+    """
+    :param image: uint8 image with bright ink - (H, W)
+    :param threshold: pixel value above which a pixel is ink
+    :return: (top, bottom, left, right) bounds of the ink, bottom and right exclusive. None if there is no ink
+    """
+    ink = image > threshold
+    rows = np.flatnonzero(ink.any(axis=1))
+    if len(rows) == 0:
+        return None
+    cols = np.flatnonzero(ink.any(axis=0))
+    return rows[0], rows[-1] + 1, cols[0], cols[-1] + 1
+
+
+def crop_to_ink(image, margin=8, threshold=INK_THRESHOLD):
+    """
+    :param image: uint8 image with bright ink - (H, W)
+    :param margin: number of background pixels kept around the ink
+    :param threshold: pixel value above which a pixel is ink
+    :return: the cropped image and the (top, bottom, left, right) region it was cropped from
+    """
+    bbox = ink_bbox(image, threshold)
+    if bbox is None:
+        return image, (0, image.shape[0], 0, image.shape[1])
+    top, bottom, left, right = bbox
+    top, left = max(0, top - margin), max(0, left - margin)
+    bottom, right = min(image.shape[0], bottom + margin), min(image.shape[1], right + margin)
+    return image[top:bottom, left:right], (top, bottom, left, right)
+
+
+def prepare_image(image, config):
+    """
+    Preprocessing applied to an image before translation
+    :param image: uint8 grayscale image, with either dark or bright ink - (H, W)
+    :param config: model config, its 'crop_to_ink' and 'max_pixels' keys select the steps
+    :return: the image with bright ink, and the (top, bottom, left, right) region it was cropped from or None
+    """
+    image = invert_if_light(image)
+    region = None
+    if config.get('crop_to_ink'):
+        image, region = crop_to_ink(image)
+    if config.get('max_pixels'):
+        image = resize_to_budget(image, config['max_pixels'])
+    return image, region
+
+
+def pad_to_stride(images, stride):
+    """
+    Pad images at the bottom and the right to a multiple of the encoder stride, so that every cell of the feature map
+    covers a whole stride x stride patch and the feature mask is the image mask subsampled by the stride
+    :param images: uint8 images - (..., H, W)
+    :param stride: stride of the encoder, see VanillaWAP.watch_stride
+    :return: the padded images and their masks, 1 on the image and 0 on the padding - (..., H', W')
+    """
+    height, width = images.shape[-2:]
+    padding = [(0, 0)] * (images.ndim - 2) + [(0, (-height) % stride), (0, (-width) % stride)]
+    mask = np.pad(np.ones(images.shape, dtype=np.uint8), padding)
+    return np.pad(images, padding), mask
+
+
+def to_tensor(images, scale=255.):
+    """
+    :param images: uint8 images or masks - (..., H, W)
+    :param scale: value mapped to 1, 255 for images and 1 for masks
+    :return: float tensor with a channel dimension - (..., 1, H, W)
+    """
+    return torch.from_numpy(np.ascontiguousarray(images)).unsqueeze(-3).float().div_(scale)
+
+
+def resize_to_budget(image, max_pixels):
+    """
+    Downscale an image so that it holds at most max_pixels pixels, keeping its aspect ratio
+    :param image: uint8 image - (H, W)
+    :param max_pixels: pixel budget
+    :return: the resized image, or the image itself if it is within the budget
+    """
+    height, width = image.shape[:2]
+    if height * width <= max_pixels:
+        return image
+    scale = (max_pixels / (height * width)) ** 0.5
+    size = (max(1, int(width * scale)), max(1, int(height * scale)))
+    return np.array(Image.fromarray(image).resize(size, Image.BILINEAR))
@@ -0,0 +1,192 @@
+import contextlib
+import csv
+import json
+import os
+import resource
+import time
+
+import torch
+
+NULL_STAGE = contextlib.nullcontext()
+
+
+class Profiler:
+    """
+    Opt-in instrumentation of the training and inference hot paths. Every stage records its wall time, the peak memory
+    and the number of tokens processed are tracked, and the stages can be exported to a torch.profiler trace and to a
+    JSON/CSV summary. When disabled, stage() hands back a shared null context so the instrumented code pays almost
+    nothing.
+    """
+    def __init__(self, enabled=False, device='cpu', trace_dir=None):
+        """
+        :param enabled: whether anything is recorded
+        :param device: device the timed work runs on. CUDA work is synchronized before a stage is closed
+        :param trace_dir: directory to write torch.profiler traces to. None disables the traces
+        """
+        self.enabled = enabled
+        self.sync = enabled and str(device).startswith('cuda')
+        self.trace_dir = trace_dir
+        self.timings = {}
+        self.tokens = 0
+        self.start_time = None
+        self.elapsed = 0.0
+        self.torch_profiler = None
+
+    def start(self):
+        """
+        Start the wall clock, and the torch.profiler trace if requested
+        """
+        if not self.enabled:
+            return
+        if self.trace_dir is not None:
+            os.makedirs(self.trace_dir, exist_ok=True)
+            self.torch_profiler = torch.profiler.profile(
+                schedule=torch.profiler.schedule(wait=1, warmup=1, active=3, repeat=1),
+                on_trace_ready=torch.profiler.tensorboard_trace_handler(self.trace_dir),
+                record_shapes=True, profile_memory=True)
+            self.torch_profiler.start()
+        if self.sync:
+            torch.cuda.reset_peak_memory_stats()
+        self.start_time = time.perf_counter()
+
+    def stop(self):
+        """
+        Stop the wall clock and flush the torch.profiler trace
+        """
+        if not self.enabled or self.start_time is None:
+            return
+        self.elapsed += time.perf_counter() - self.start_time
+        self.start_time = None
+        if self.torch_profiler is not None:
+            self.torch_profiler.stop()
+            self.torch_profiler = None
+
+    def step(self):
+        """
+        Mark the end of a training or inference step for the torch.profiler schedule
+        """
+        if self.torch_profiler is not None:
+            self.torch_profiler.step()
+
+    def stage(self, name):
+        """
+        :param name: name of the stage, e.g. 'watch', 'parse' or 'backward'
+        :return: context manager timing the enclosed block
+        """
+        if not self.enabled:
+            return NULL_STAGE
+        return self._timed(name)
+
+    @contextlib.contextmanager
+    def _timed(self, name):
+        with torch.profiler.record_function(name):
+            start = time.perf_counter()
+            yield
+            if self.sync:
+                torch.cuda.synchronize()
+            self.record(name, time.perf_counter() - start)
+
+    def record(self, name, seconds):
+        """
+        :param name: name of the stage
+        :param seconds: time taken by one occurrence of the stage
+        """
+        stats = self.timings.setdefault(name, {'count': 0, 'total': 0.0, 'max': 0.0})
+        stats['count'] += 1
+        stats['total'] += seconds
+        stats['max'] = max(stats['max'], seconds)
+
+    def iterate(self, name, iterable):
+        """
+        Time how long every item of an iterable (e.g. a DataLoader) takes to be produced
+        :param name: name of the stage
+        :param iterable: the iterable to time
+        :return: the iterable itself when disabled, otherwise a generator over its items
+        """
+        if not self.enabled:
+            return iterable
+        return self._timed_iter(name, iterable)
+
+    def _timed_iter(self, name, iterable):
+        iterator = iter(iterable)
+        while True:
+            start = time.perf_counter()
+            try:
+                item = next(iterator)
+            except StopIteration:
+                return
+            self.record(name, time.perf_counter() - start)
+            yield item
+
+    def wrap(self, name, fn):
+        """
+        :param name: name of the stage
+        :param fn: function to time, e.g. the collate function of a DataLoader
+        :return: fn itself when disabled, otherwise a timed wrapper around it
+        """
+        if not self.enabled:
+            return fn
+
+        def timed(*args, **kwargs):
+            with self.stage(name):
+                return fn(*args, **kwargs)
+        return timed
+
+    def add_tokens(self, count):
+        """
+        :param count: number of tokens processed, used for the tokens/sec throughput
+        """
+        if self.enabled:
+            self.tokens += int(count)
+
+    def peak_memory(self):
+        """
+        :return: peak memory in bytes. CUDA memory if the work runs on the GPU, otherwise the peak resident set size
+        """
+        if self.sync:
+            return torch.cuda.max_memory_allocated()
+        return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024
+
+    def summary(self):
+        """
+        :return: dictionary with the per stage statistics, the peak memory and the throughput
+        """
+        elapsed = self.elapsed
+        if self.start_time is not None:
+            elapsed += time.perf_counter() - self.start_time
+        stages = {}
+        for name, stats in self.timings.items():
+            stages[name] = {'count': stats['count'], 'total_s': stats['total'], 'max_s': stats['max'],
+                            'mean_s': stats['total'] / stats['count'],
+                            'share': stats['total'] / elapsed if elapsed else 0.0}
+        return {
+            'elapsed_s': elapsed,
+            'tokens': self.tokens,
+            'tokens_per_s': self.tokens / elapsed if elapsed else 0.0,
+            'peak_memory_bytes': self.peak_memory(),
+            'stages': stages,
+        }
+
+    def export(self, path):
+        """
+        Export the summary to path. The format is picked from the extension, .csv or .json
+        :param path: location of the summary file
+        """
+        if not self.enabled:
+            return
+        summary = self.summary()
+        if os.path.dirname(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        if path.endswith('.csv'):
+            with open(path, 'w', newline='') as f:
+                writer = csv.writer(f)
+                writer.writerow(['stage', 'count', 'total_s', 'mean_s', 'max_s', 'share'])
+                for name, stats in summary['stages'].items():
+                    writer.writerow([name, stats['count'], stats['total_s'], stats['mean_s'], stats['max_s'],
+                                     stats['share']])
+                writer.writerow(['elapsed', 1, summary['elapsed_s'], summary['elapsed_s'], summary['elapsed_s'], 1])
+                writer.writerow(['tokens_per_s', '', summary['tokens_per_s'], '', '', ''])
+                writer.writerow(['peak_memory_bytes', '', summary['peak_memory_bytes'], '', '', ''])
+        else:
+            with open(path, 'w') as f:
+                json.dump(summary, f, indent=2)
@@ -0,0 +1,509 @@
+# Synthetic training data composed from handwritten symbols. Run from the root of the repository:
+#   python -m train.utils.synthetic extract --inkml_dir data/CROHME/train/INKML --store data/CROHME/train/symbols.npz
+#   python -m train.utils.synthetic render --store data/CROHME/train/symbols.npz --count 100000 \
+#       --output_dir data/CROHME/synthetic --workers 8
+# The first command extracts the symbols of the traceGroups of the InkML files once into a numpy store. The second
+# lays out the labels of train_caption.txt (or random expressions of LatexGrammar) with these symbols, and renders them
+# with a process pool into shards of images listed in a manifest in the format of wap_dataset.csv.
+import argparse
+import os
+import xml.etree.ElementTree as ET
+from multiprocessing import Pool
+
+import numpy as np
+import pandas as pd
+from PIL import Image, ImageDraw
+from tqdm import tqdm
+
+from train.utils.datasets import get_vocabulary
+from train.utils.global_params import CROHME_TRAIN, VOCAB_LOC
+from train.utils.grammar import LatexGrammar
+
+INKML = '{http://www.w3.org/2003/InkML}'
+
+# Symbol classes of the InkML annotations whose token differs in the labels
+SYMBOL_ALIASES = {'\\lt': '<', '\\gt': '>', 'COMMA': ',', '\\lbrace': '\\{', '\\rbrace': '\\}', '\\ne': '\\neq',
+                  '\\ge': '\\geq', '\\le': '\\leq', '\\to': '\\rightarrow', '\\dots': '\\ldots'}
+# Tokens that structure the layout and have no ink of their own
+STRUCTURE_TOKENS = {'{', '}', '_', '^', '\\frac', '\\limits'}
+# Symbols centred on the axis of the line, the others sit on its baseline
+CENTRED = {'-', '+', '=', '\\times', '\\div', '\\pm', '\\cdot', '\\cdots', '<', '>', '\\leq', '\\geq', '\\neq', '\\in',
+           '\\rightarrow', '(', ')', '[', ']', '\\{', '\\}', '|', '\\sum', '\\int', '/'}
+DESCENDERS = {'g', 'j', 'p', 'q', 'y', ',', '\\beta', '\\gamma', '\\mu', '\\phi'}
+# Operators whose scripts are written below and above them
+LIMIT_OPERATORS = {'\\lim', '\\sum'}
+# Symbols too flat or too small to measure the size of the handwriting with
+FLAT_SYMBOLS = {'-', '.', ',', '\\cdot', '\\cdots', '\\ldots', '=', "'", '\\prime'}
+
+SCRIPT_SCALE = 0.6
+FRACTION_SCALE = 0.9
+INDEX_SCALE = 0.5
+GAP = 0.15
+
+
+# EXTRACT THE SYMBOLS
+def read_symbols(inkml_file):
+    """
+    :param inkml_file: InkML file with traces and per-symbol traceGroups
+    :return: list of (token, writer, strokes) of the symbols of the expression, the strokes being (P, 2) arrays in units
+    of the median height of the symbols of the expression, with the top left corner of the symbol at the origin
+    """
+    try:
+        root = ET.parse(inkml_file).getroot()
+    except ET.ParseError:
+        return []
+    writer = ''
+    for annotation in root.findall(INKML + 'annotation'):
+        if annotation.attrib.get('type') == 'writer':
+            writer = (annotation.text or '').strip()
+
+    traces = {}
+    for trace in root.findall(INKML + 'trace'):
+        points = [pt.split()[:2] for pt in trace.text.strip().split(',') if pt.strip()]
+        traces[trace.attrib.get('id')] = np.array(points, dtype=np.float32)
+
+    symbols = []
+    for group in root.iter(INKML + 'traceGroup'):
+        annotation = group.find(INKML + 'annotation')
+        views = group.findall(INKML + 'traceView')
+        if annotation is None or not views:
+            continue
+        token = annotation.text.strip()
+        token = SYMBOL_ALIASES.get(token, token)
+        strokes = [traces[view.attrib['traceDataRef']] for view in views if view.attrib['traceDataRef'] in traces]
+        if strokes:
+            symbols.append((token, strokes))
+    if not symbols:
+        return []
+
+    # The median height of the symbols is the unit, so that the symbols of different writers have comparable sizes
+    heights = [np.ptp(np.concatenate(strokes)[:, 1]) for token, strokes in symbols if token not in FLAT_SYMBOLS]
+    unit = np.median(heights) if heights and np.median(heights) > 0 else 1.0
+    ret = []
+    for token, strokes in symbols:
+        origin = np.concatenate(strokes).min(axis=0)
+        ret.append((token, writer, [(stroke - origin) / unit for stroke in strokes]))
+    return ret
+
+
+def extract_symbols(inkml_dir, store, workers=os.cpu_count()):
+    """
+    Read the symbols of every InkML file of inkml_dir in parallel and write them to a numpy store, see SymbolLibrary
+    :param inkml_dir: directory walked recursively for InkML files
+    :param store: location of the .npz store
+    :param workers: number of processes
+    :return: number of symbols extracted
+    """
+    vocabulary = set(get_vocabulary(VOCAB_LOC))
+    files = sorted(os.path.join(root, file) for root, _, files in os.walk(inkml_dir) for file in files
+                   if file.endswith('.inkml'))
+    tokens, writers, sizes, points, stroke_ends, symbol_ends = [], [], [], [], [], []
+    num_points = 0
+    with Pool(workers) as pool:
+        for symbols in tqdm(pool.imap(read_symbols, files, chunksize=16), total=len(files)):
+            for token, writer, strokes in symbols:
+                if token not in vocabulary:
+                    continue
+                for stroke in strokes:
+                    points.append(stroke)
+                    num_points += len(stroke)
+                    stroke_ends.append(num_points)
+                symbol_ends.append(len(stroke_ends))
+                size = np.concatenate(strokes).max(axis=0)
+                sizes.append(np.maximum(size, 0.05))
+                tokens.append(token)
+                writers.append(writer)
+
+    np.savez(store, tokens=np.array(tokens), writers=np.array(writers), sizes=np.array(sizes, dtype=np.float16),
+             points=np.concatenate(points).astype(np.float16), stroke_ends=np.array(stroke_ends, dtype=np.int64),
+             symbol_ends=np.array(symbol_ends, dtype=np.int64))
+    return len(tokens)
+
+
+class SymbolLibrary:
+    """
+    Handwritten samples of every symbol, read from the store written by extract_symbols():
+    - points (P, 2): the points of all the strokes, concatenated
+    - stroke_ends (S): end of every stroke in points
+    - symbol_ends (N): end of the strokes of every symbol in stroke_ends
+    - sizes (N, 2): width and height of every symbol
+    - tokens, writers (N): token and writer of every symbol
+    """
+    def __init__(self, store):
+        data = np.load(store)
+        self.points = data['points'].astype(np.float32)
+        self.stroke_ends = data['stroke_ends']
+        self.symbol_ends = data['symbol_ends']
+        self.sizes = data['sizes'].astype(np.float32)
+        self.tokens = data['tokens']
+        self.writers = data['writers']
+        self.samples, self.writer_samples = {}, {}
+        for i, (token, writer) in enumerate(zip(self.tokens, self.writers)):
+            self.samples.setdefault(str(token), []).append(i)
+            self.writer_samples.setdefault((str(token), str(writer)), []).append(i)
+        self.writer_names = sorted(set(str(writer) for writer in self.writers))
+
+    def __contains__(self, token):
+        return token in self.samples
+
+    def strokes(self, sample):
+        """
+        :return: the strokes of a symbol sample, list of (P, 2) arrays
+        """
+        first = self.symbol_ends[sample - 1] if sample > 0 else 0
+        ends = self.stroke_ends[first:self.symbol_ends[sample]]
+        starts = np.concatenate([[self.stroke_ends[first - 1] if first > 0 else 0], ends[:-1]])
+        return [self.points[start:end] for start, end in zip(starts, ends)]
+
+    def pick(self, token, rng, writer=None):
+        """
+        :return: a random sample of token, written by writer if the library has one
+        """
+        samples = self.writer_samples.get((token, writer)) or self.samples[token]
+        return samples[rng.integers(len(samples))]
+
+
+# LAY OUT THE EXPRESSIONS
+class Box:
+    """
+    Laid out part of an expression: glyphs (sample, x, y, width, height) placed in a frame whose origin is on the axis
+    of the line at the left edge, y pointing down. top and bottom are the extent of the ink around the axis
+    """
+    def __init__(self, glyphs=None, width=0.0, top=0.0, bottom=0.0, limits=False):
+        self.glyphs = glyphs or []
+        self.width = width
+        self.top = top
+        self.bottom = bottom
+        self.limits = limits
+
+    def moved(self, dx, dy):
+        return Box([(s, x + dx, y + dy, w, h) for s, x, y, w, h in self.glyphs], self.width, self.top + dy,
+                   self.bottom + dy)
+
+    def add(self, box, dx, dy):
+        """
+        Add box moved by (dx, dy) and grow the extent
+        """
+        self.glyphs += box.moved(dx, dy).glyphs
+        self.width = max(self.width, dx + box.width)
+        self.top = min(self.top, box.top + dy)
+        self.bottom = max(self.bottom, box.bottom + dy)
+
+
+class Layout:
+    """
+    Lays out the tokens of a label with samples of a SymbolLibrary: symbols follow each other on the axis, scripts are
+    scaled down and raised or lowered next to their base, or written below and above the operators of LIMIT_OPERATORS,
+    numerators and denominators are centred around a fraction bar stretched to their width, and the radical sign is
+    stretched over its radicand
+    """
+    def __init__(self, library, rng, jitter=0.08):
+        """
+        :param library: SymbolLibrary the glyphs are drawn from
+        :param rng: numpy Generator the samples and the jitter are drawn from
+        :param jitter: relative amount of random variation of the size and position of every symbol
+        """
+        self.library = library
+        self.rng = rng
+        self.jitter = jitter
+        self.writer = None
+
+    def __call__(self, tokens):
+        """
+        :return: the Box of the whole expression. Raises KeyError if a symbol has no sample in the library
+        """
+        # The symbols of an expression are taken from one writer when possible, so that its handwriting is consistent
+        self.writer = self.library.writer_names[self.rng.integers(len(self.library.writer_names))]
+        box, _ = self.sequence(tokens, 0, 1.0, stop=())
+        return box
+
+    def atom(self, token, scale):
+        sample = self.library.pick(token, self.rng, self.writer)
+        w, h = self.library.sizes[sample] * scale * (1 + self.jitter * self.rng.uniform(-1, 1))
+        if token in CENTRED:
+            y = -h / 2
+        else:
+            y = 0.5 * scale - h * (0.7 if token in DESCENDERS else 1.0)
+        y += self.jitter * scale * self.rng.uniform(-1, 1)
+        return Box([(sample, 0.0, y, w, h)], w, y, y + h, limits=token in LIMIT_OPERATORS)
+
+    def sequence(self, tokens, i, scale, stop):
+        """
+        :return: the Box of the tokens from i up to a token of stop, and the index of that token
+        """
+        boxes = []
+        while i < len(tokens) and tokens[i] not in stop:
+            if tokens[i] == '\\limits':
+                if boxes:
+                    boxes[-1].limits = True
+                i += 1
+            elif tokens[i] in ('_', '^'):
+                base = boxes.pop() if boxes else Box(top=-0.25 * scale, bottom=0.25 * scale)
+                scripts = {}
+                while i < len(tokens) and tokens[i] in ('_', '^'):
+                    scripts[tokens[i]], i = self.operand(tokens, i + 1, scale * SCRIPT_SCALE)
+                boxes.append(self.scripts(base, scripts.get('_'), scripts.get('^'), scale))
+            else:
+                box, i = self.operand(tokens, i, scale)
+                boxes.append(box)
+
+        line = Box()
+        for box in boxes:
+            line.add(box, line.width + (GAP * scale if line.glyphs else 0), 0)
+        return line, i
+
+    def operand(self, tokens, i, scale):
+        """
+        :return: the Box of the atom, group, fraction or radical starting at i, and the index of the next token
+        """
+        if i >= len(tokens) or tokens[i] == '}':
+            # Missing operand
+            return Box(), i
+        token = tokens[i]
+        if token == '{':
+            box, i = self.sequence(tokens, i + 1, scale, stop=('}',))
+            return box, i + 1
+        if token == '\\frac':
+            numerator, i = self.operand(tokens, i + 1, scale * FRACTION_SCALE)
+            denominator, i = self.operand(tokens, i, scale * FRACTION_SCALE)
+            return self.fraction(numerator, denominator, scale), i
+        if token == '\\sqrt':
+            index = None
+            i += 1
+            if i < len(tokens) and tokens[i] == '[':
+                index, i = self.sequence(tokens, i + 1, scale * INDEX_SCALE, stop=(']',))
+                i += 1
+            radicand, i = self.operand(tokens, i, scale)
+            return self.radical(radicand, index, scale), i
+        return self.atom(token, scale), i + 1
+
+    def scripts(self, base, sub, sup, scale):
+        box = Box(width=base.width, top=base.top, bottom=base.bottom)
+        box.add(base, 0, 0)
+        height = base.bottom - base.top
+        for script, above in ((sub, False), (sup, True)):
+            if script is None:
+                continue
+            if base.limits:
+                dx = (base.width - script.width) / 2
+                dy = base.top - GAP * scale - script.bottom if above else base.bottom + GAP * scale - script.top
+            else:
+                dx = base.width + GAP * scale * 0.5
+                dy = base.top + 0.45 * height - script.bottom if above else base.bottom - 0.45 * height - script.top
+            box.add(script, dx, dy)
+        if base.limits:
+            # Keep the operator on the left edge when a limit is wider than it
+            shift = -min(0.0, min((x for _, x, _, _, _ in box.glyphs), default=0.0))
+            box = box.moved(shift, 0)
+            box.width += shift
+        return box
+
+    def fraction(self, numerator, denominator, scale):
+        width = max(numerator.width, denominator.width) + 2 * GAP * scale
+        bar = self.library.pick('-', self.rng, self.writer)
+        thickness = 0.06 * scale
+        box = Box([(bar, 0.0, -thickness / 2, width, thickness)], width, -thickness / 2, thickness / 2)
+        box.add(numerator, (width - numerator.width) / 2, -GAP * scale - numerator.bottom)
+        box.add(denominator, (width - denominator.width) / 2, GAP * scale - denominator.top)
+        return box
+
+    def radical(self, radicand, index, scale):
+        sign = self.library.pick('\\sqrt', self.rng, self.writer)
+        hook = 0.5 * scale
+        top, bottom = radicand.top - GAP * scale, radicand.bottom + 0.05 * scale
+        box = Box([(sign, 0.0, top, hook + radicand.width + GAP * scale, bottom - top)],
+                  hook + radicand.width + GAP * scale, top, bottom)
+        box.add(radicand, hook, 0)
+        if index is not None:
+            box.add(index, 0, top + 0.4 * (bottom - top) - index.bottom)
+        return box
+
+
+# RENDER
+def render(box, library, rng, unit=32, line_width=2, margin=8):
+    """
+    :param box: laid out expression
+    :param library: SymbolLibrary of the glyphs of box
+    :param rng: numpy Generator of the random slant of the writing
+    :param unit: number of pixels of the median symbol height
+    :param line_width: width of the strokes in pixels
+    :param margin: number of black pixels around the ink
+    :return: uint8 image with white ink on black, like the CROHME images - (H, W)
+    """
+    slant = rng.uniform(-0.15, 0.15)
+    left = min(x - max(slant * y, slant * (y + h)) for _, x, y, _, h in box.glyphs)
+    right = max(x + w - min(slant * y, slant * (y + h)) for _, x, y, w, h in box.glyphs)
+    width = int(np.ceil((right - left) * unit)) + 2 * margin
+    height = int(np.ceil((box.bottom - box.top) * unit)) + 2 * margin
+    image = Image.new('L', (width, height), 0)
+    draw = ImageDraw.Draw(image)
+    for sample, x, y, w, h in box.glyphs:
+        natural = library.sizes[sample]
+        for stroke in library.strokes(sample):
+            # Fit the sample to the glyph box, then slant it around the axis
+            points = stroke * np.array([w, h]) / natural + np.array([x, y])
+            points[:, 0] -= slant * points[:, 1]
+            points = (points - np.array([left, box.top])) * unit + margin
+            if len(points) == 1 or np.ptp(points, axis=0).max() < 1:
+                cx, cy = points.mean(axis=0)
+                r = max(line_width / 2, 1)
+                draw.ellipse([cx - r, cy - r, cx + r, cy + r], fill=255)
+            else:
+                draw.line([tuple(p) for p in points], fill=255, width=line_width, joint='curve')
+    return np.array(image)
+
+
+def balanced(tokens):
+    """
+    :param tokens: tokens of a label
+    :return: whether every { and [ of the label is closed in order, which Layout relies on
+    """
+    closing = {'{': '}', '[': ']'}
+    stack = []
+    for token in tokens:
+        if token in closing:
+            stack.append(closing[token])
+        elif token in ('}', ']') and (not stack or stack.pop() != token):
+            return False
+    return not stack
+
+
+LIBRARY = None
+
+
+def load_library(store):
+    # Run once per process of the pool
+    global LIBRARY
+    LIBRARY = SymbolLibrary(store)
+
+
+def render_shard(task):
+    """
+    Lay out and render the labels of a shard, run by the processes of the pool
+    :param task: (shard directory, labels, seed, unit range, line width range)
+    :return: list of (image path, label) of the rendered images. Labels which are not balanced or have a symbol
+    missing from the library are skipped
+    """
+    shard_dir, labels, seed, units, line_widths = task
+    rng = np.random.default_rng(seed)
+    layout = Layout(LIBRARY, rng)
+    os.makedirs(shard_dir, exist_ok=True)
+    rendered = []
+    for i, label in enumerate(labels):
+        if not balanced(label.split()):
+            continue
+        try:
+            box = layout(label.split())
+        except (KeyError, IndexError):
+            continue
+        if not box.glyphs:
+            continue
+        image = render(box, LIBRARY, rng, unit=rng.uniform(*units), line_width=int(rng.integers(*line_widths)))
+        path = os.path.join(shard_dir, f'{i:06d}.png')
+        Image.fromarray(image).save(path, compress_level=1)
+        rendered.append((path, label))
+    return rendered
+
+
+def sample_expressions(count, library, rng, min_len=5, max_len=40):
+    """
+    Random expressions of LatexGrammar using only the symbols of the library
+    :param count: number of expressions
+    :param library: SymbolLibrary
+    :param rng: numpy Generator
+    :param min_len: expressions are at least this long, unless the grammar forces an earlier end
+    :param max_len: maximum number of tokens, <EOS> included
+    :return: list of labels, tokens separated by spaces
+    """
+    vocabulary = get_vocabulary(VOCAB_LOC)
+    grammar = LatexGrammar(vocabulary)
+    masks, transitions, finish_steps = grammar.masks.numpy(), grammar.transitions.numpy(), grammar.finish_steps.numpy()
+    drawable = np.array([word in library or word in STRUCTURE_TOKENS or word in ('<EOS>', '\\sqrt', '[', ']')
+                         for word in vocabulary])
+    if '\\sqrt' not in library:
+        drawable[vocabulary.index('\\sqrt')] = False
+    eos = vocabulary.index('<EOS>')
+
+    labels = []
+    while len(labels) < count:
+        state, tokens = 0, []
+        length = rng.integers(min_len, max_len)
+        for step in range(max_len):
+            allowed = masks[state] & drawable & (finish_steps[np.maximum(transitions[state], 0)] < max_len - step)
+            if allowed[eos] and len(tokens) >= length:
+                break
+            allowed[eos] = allowed[eos] and len(tokens) >= min_len
+            choices = np.flatnonzero(allowed)
+            if len(choices) == 0:
+                break
+            token = choices[rng.integers(len(choices))]
+            if token == eos:
+                break
+            tokens.append(vocabulary[token])
+            state = transitions[state, token]
+        if tokens and balanced(tokens) and grammar.is_valid([vocabulary.index(token) for token in tokens] + [eos]):
+            labels.append(' '.join(tokens))
+    return labels
+
+
+def generate(store, output_dir, labels, workers=os.cpu_count(), shard_size=1000, seed=0, units=(24, 40),
+             line_widths=(1, 4)):
+    """
+    Render labels into shards of output_dir with a process pool, and write the manifest of the images
+    :param store: symbol store written by extract_symbols()
+    :param output_dir: directory of the shards
+    :param labels: labels of the images, tokens separated by spaces
+    :param workers: number of processes
+    :param shard_size: number of images per shard
+    :param seed: seed of the random layout and rendering
+    :param units: range of the median symbol height in pixels
+    :param line_widths: range of the stroke width in pixels, upper bound excluded
+    :return: location of the manifest, a tab separated file with the image_loc and label columns like wap_dataset.csv
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    tasks = [(os.path.join(output_dir, f'shard_{i // shard_size:05d}'), labels[i:i + shard_size], seed + i, units,
+              line_widths) for i in range(0, len(labels), shard_size)]
+    rendered = []
+    with Pool(workers, initializer=load_library, initargs=(store,)) as pool:
+        for shard in tqdm(pool.imap(render_shard, tasks), total=len(tasks)):
+            rendered += shard
+    manifest = os.path.join(output_dir, 'synthetic.csv')
+    pd.DataFrame(rendered, columns=['image_loc', 'label']).to_csv(manifest, sep='\t', index=False)
+    print(f'Rendered {len(rendered)} of {len(labels)} expressions into {len(tasks)} shards, listed in {manifest}')
+    return manifest
+
+
+def main(args):
+    if args.command == 'extract':
+        count = extract_symbols(args.inkml_dir, args.store, args.workers)
+        print(f'Extracted {count} symbols into {args.store}')
+        return
+
+    rng = np.random.default_rng(args.seed)
+    if args.source == 'captions':
+        captions = pd.read_csv(args.captions, sep='\t', names=['image_loc', 'label'])
+        labels = list(captions['label'].astype(str))
+        labels = [labels[i] for i in rng.integers(len(labels), size=args.count)]
+    else:
+        labels = sample_expressions(args.count, SymbolLibrary(args.store), rng)
+    generate(args.store, args.output_dir, labels, args.workers, args.shard_size, args.seed)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Synthetic expressions composed from handwritten symbols')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    extract = subparsers.add_parser('extract', help='extract the symbols of the InkML files into a numpy store')
+    extract.add_argument('--inkml_dir', required=True)
+    extract.add_argument('--store', default=CROHME_TRAIN + '/symbols.npz')
+    extract.add_argument('--workers', type=int, default=os.cpu_count())
+    generate_parser = subparsers.add_parser('render', help='render synthetic expressions into shards')
+    generate_parser.add_argument('--store', default=CROHME_TRAIN + '/symbols.npz')
+    generate_parser.add_argument('--source', choices=['captions', 'grammar'], default='captions',
+                                 help='labels of train_caption.txt with new handwriting, or random expressions')
+    generate_parser.add_argument('--captions', default=CROHME_TRAIN + '/train_caption.txt')
+    generate_parser.add_argument('--count', type=int, default=100000)
+    generate_parser.add_argument('--output_dir', default='data/CROHME/synthetic')
+    generate_parser.add_argument('--shard_size', type=int, default=1000)
+    generate_parser.add_argument('--workers', type=int, default=os.cpu_count())
+    generate_parser.add_argument('--seed', type=int, default=0)
+    main(parser.parse_args())
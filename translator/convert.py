@@ -0,0 +1,206 @@
+# Bulk offline conversion of handwritten expression images to latex. Run from the root of the repository:
+#   python -m translator.convert --input_dir scans/ --output scans.jsonl --threads 8 --replicas 2
+#   python -m translator.convert --manifest data/CROHME/train/wap_dataset.csv --output train.jsonl
+# Interrupted runs are resumed by running the same command again: images already in the output are skipped.
+import argparse
+import collections
+import json
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+from PIL import Image
+
+from train.models import VanillaWAP
+from train.utils.datasets import get_vocabulary
+from train.utils.global_params import INFERENCE_CONFIG, VOCAB_LOC
+from train.utils.grammar import LatexGrammar
+from train.utils.preprocessing import prepare_image
+from translator.page import translate_images
+
+IMAGE_EXTENSIONS = ('.bmp', '.png', '.jpg', '.jpeg', '.tif', '.tiff')
+
+
+def list_images(input_dir=None, manifest=None):
+    """
+    :param input_dir: directory walked recursively for images
+    :param manifest: text file with one image path per line, or a csv/tsv file with an 'image_loc' column
+    :return: sorted list of image paths
+    """
+    if manifest is not None:
+        if manifest.endswith('.csv') or manifest.endswith('.tsv'):
+            with open(manifest, 'r') as f:
+                sep = '\t' if '\t' in f.readline() else ','
+            return list(pd.read_csv(manifest, sep=sep)['image_loc'])
+        with open(manifest, 'r') as f:
+            return [line.strip() for line in f if line.strip()]
+
+    paths = []
+    for root, _, files in os.walk(input_dir):
+        paths += [os.path.join(root, file) for file in files if file.lower().endswith(IMAGE_EXTENSIONS)]
+    return sorted(paths)
+
+
+def completed_paths(output):
+    """
+    :param output: JSONL file of a previous run
+    :return: set of the paths that were converted without error. A line cut short by an interruption is ignored
+    """
+    done = set()
+    if not os.path.exists(output):
+        return done
+    with open(output, 'r') as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            if 'latex' in record:
+                done.add(record['path'])
+    return done
+
+
+def load(path, config):
+    """
+    Decode and preprocess an image, run by the prefetch threads
+    :return: (path, image, error)
+    """
+    try:
+        image, _ = prepare_image(np.array(Image.open(path).convert('L')), config)
+        return path, image, None
+    except Exception as e:
+        return path, None, str(e)
+
+
+class JsonlWriter:
+    """
+    Thread-safe JSONL writer. Every record is flushed so that an interrupted run loses at most the batches in flight
+    """
+    def __init__(self, output):
+        # Terminate a line cut short by an interruption before appending
+        if os.path.exists(output) and os.path.getsize(output) > 0:
+            with open(output, 'rb') as f:
+                f.seek(-1, os.SEEK_END)
+                truncated = f.read(1) != b'\n'
+            if truncated:
+                with open(output, 'a') as f:
+                    f.write('\n')
+        self.f = open(output, 'a')
+        self.lock = threading.Lock()
+
+    def write(self, records):
+        with self.lock:
+            for record in records:
+                self.f.write(json.dumps(record) + '\n')
+            self.f.flush()
+
+    def close(self):
+        self.f.close()
+
+
+def convert(model, paths, index_to_word, writer, batch_size=16, prefetch=4, replicas=1, window=8):
+    """
+    :param model: VanillaWAP in eval mode
+    :param paths: image paths to convert
+    :param index_to_word: vocabulary of the model
+    :param writer: JsonlWriter the results are streamed to
+    :param batch_size: number of images decoded at once
+    :param prefetch: number of threads decoding images ahead of the model
+    :param replicas: number of batches translated concurrently. The replicas share the weights of model
+    :param window: number of batches read ahead and sorted by image size to limit the padding
+    :return: number of images converted, the images of failed batches excluded
+    """
+    converted = [0]
+    lock = threading.Lock()
+    in_flight = threading.BoundedSemaphore(2 * replicas)
+
+    def run(batch):
+        try:
+            start = time.perf_counter()
+            latex = translate_images(model, [image for _, image in batch], index_to_word, batch_size)
+            latency = (time.perf_counter() - start) * 1e3 / len(batch)
+            writer.write([{'path': path, 'latex': text, 'latency_ms': latency}
+                          for (path, _), text in zip(batch, latex)])
+            with lock:
+                converted[0] += len(batch)
+        except Exception as e:
+            writer.write([{'path': path, 'error': str(e)} for path, _ in batch])
+        finally:
+            in_flight.release()
+
+    def submit(pending):
+        # Sort the read ahead window by size so that each batch holds images of similar shapes
+        pending.sort(key=lambda item: item[1].shape)
+        for start in range(0, len(pending), batch_size):
+            in_flight.acquire()
+            decoders.submit(run, pending[start:start + batch_size])
+
+    with ThreadPoolExecutor(prefetch) as loaders, ThreadPoolExecutor(replicas) as decoders:
+        # At most one window of images is loaded ahead of the window being filled, so that the loaders do not decode
+        # the whole input into memory while the batches wait for the model
+        paths = iter(paths)
+        loading = collections.deque()
+        pending = []
+        while True:
+            while len(loading) < batch_size * window:
+                path = next(paths, None)
+                if path is None:
+                    break
+                loading.append(loaders.submit(load, path, model.config))
+            if not loading:
+                break
+            path, image, error = loading.popleft().result()
+            if error is not None:
+                writer.write([{'path': path, 'error': error}])
+                continue
+            pending.append((path, image))
+            if len(pending) == batch_size * window:
+                submit(pending)
+                pending = []
+        if pending:
+            submit(pending)
+    return converted[0]
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    device = args.device or INFERENCE_CONFIG['DEVICE']
+    model = VanillaWAP.from_checkpoint(args.checkpoint, INFERENCE_CONFIG, device)
+    vocabulary = get_vocabulary(VOCAB_LOC)
+    index_to_word = {i: word for i, word in enumerate(vocabulary)}
+    if INFERENCE_CONFIG['constrained_decoding']:
+        model.grammar = LatexGrammar(vocabulary)
+
+    paths = list_images(args.input_dir, args.manifest)
+    done = completed_paths(args.output)
+    todo = [path for path in paths if path not in done]
+    print(f'{len(paths)} images, {len(paths) - len(todo)} already converted, {len(todo)} to go')
+
+    writer = JsonlWriter(args.output)
+    start = time.perf_counter()
+    try:
+        count = convert(model, todo, index_to_word, writer, args.batch_size, args.prefetch, args.replicas)
+    finally:
+        writer.close()
+    elapsed = time.perf_counter() - start
+    print(f'Converted {count} images in {elapsed:.1f}s ({count / max(elapsed, 1e-9):.1f} images/s)')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Convert a directory or a manifest of images to latex')
+    source = parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('--input_dir', help='directory walked recursively for images')
+    source.add_argument('--manifest', help='file listing the images, one path per line or a csv with image_loc')
+    parser.add_argument('--output', required=True, help='JSONL file the results are appended to')
+    parser.add_argument('--checkpoint', default='checkpoints/model_best.pth')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--prefetch', type=int, default=4, help='number of image decoding threads')
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    parser.add_argument('--replicas', type=int, default=1, help='number of batches translated concurrently')
+    main(parser.parse_args())
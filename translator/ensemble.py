@@ -0,0 +1,290 @@
+# Ensembles of checkpoints of the same architecture, e.g. the snapshots VanillaWAP.save() keeps every save_every
+# epochs and model_best.pth. Run from the root of the repository:
+#   python -m translator.ensemble translate --checkpoints checkpoints/model_30.pth checkpoints/model_best.pth \
+#       --images page1.png page2.png --beam_width 5
+#   python -m translator.ensemble average --checkpoints checkpoints/model_30.pth checkpoints/model_40.pth \
+#       checkpoints/model_best.pth --output checkpoints/model_avg.pth
+# An Ensemble decodes with the mean of the log-probabilities of its members at every step. The parser weights of the
+# members are stacked, so a decoder step of the N members is one batched computation rather than N. Averaging the
+# checkpoints instead gives a single model, as fast as any other, which is worth comparing against the ensemble on a
+# validation split (see translator/evaluate.py) since it only works for snapshots of one run.
+import argparse
+import time
+
+import torch
+from torch import nn
+
+from train.models import EOS_INDEX, SOS_INDEX, PackedContext, VanillaWAP
+from train.utils.datasets import get_vocabulary
+from train.utils.global_params import BASE_CONFIG, INFERENCE_CONFIG, STUDENT_CONFIG, VOCAB_LOC
+from train.utils.grammar import LatexGrammar
+from translator.convert import load
+from translator.page import translate_images
+
+CONFIGS = {'base': BASE_CONFIG, 'inference': INFERENCE_CONFIG, 'student': STUDENT_CONFIG}
+
+
+def average_checkpoints(paths, output=None):
+    """
+    Average the weights of checkpoints of the same architecture, ideally snapshots of the end of one run. Integer
+    buffers, such as the number of batches seen by batch norm layers, are taken from the last checkpoint
+    :param paths: locations of the state dicts saved by VanillaWAP.save()
+    :param output: location the averaged state dict is saved to, if given
+    :return: the averaged state dict
+    """
+    average = None
+    for path in paths:
+        state_dict = torch.load(path, map_location='cpu')
+        if average is None:
+            average = {name: tensor.double() if tensor.is_floating_point() else tensor
+                       for name, tensor in state_dict.items()}
+            continue
+        if state_dict.keys() != average.keys():
+            raise ValueError(f'{path} does not have the weights of {paths[0]}')
+        for name, tensor in state_dict.items():
+            average[name] = average[name] + tensor if tensor.is_floating_point() else tensor
+    average = {name: tensor.div(len(paths)).float() if tensor.is_floating_point() else tensor
+               for name, tensor in average.items()}
+    if output is not None:
+        torch.save(average, output)
+    return average
+
+
+def stack_linear(layers):
+    """
+    :param layers: nn.Linear of every member
+    :return: the transposed weights (N, In, Out) and the biases (N, 1, Out), or None without bias
+    """
+    weight = torch.stack([layer.weight.t() for layer in layers])
+    bias = torch.stack([layer.bias for layer in layers]).unsqueeze(1) if layers[0].bias is not None else None
+    return weight, bias
+
+
+class Ensemble(nn.Module):
+    """
+    Members of the same architecture decoding together. The encoders run one after another, once per image, since
+    they are bound by the convolutions, while every step of the decoder runs the N members at once with batched
+    matrix products over the stacked parser weights. It has the translate() of VanillaWAP, so it can replace a
+    model in translator/page.py, convert.py and evaluate.py.
+    """
+    def __init__(self, members, beam_width=1):
+        """
+        :param members: VanillaWAP models in eval mode, built from the same config
+        :param beam_width: number of hypotheses kept per image, 1 decodes greedily
+        """
+        super().__init__()
+        self.members = nn.ModuleList(members)
+        self.config = members[0].config
+        self.beam_width = beam_width
+        # Optional LatexGrammar (see utils/grammar.py) constraining the tokens translate() can emit
+        self.grammar = None
+
+        # Members sharing the weights of their encoder, e.g. decoders fine-tuned on a frozen watcher, are watched once
+        self.watcher_of = []
+        for i, member in enumerate(members):
+            self.watcher_of.append(next(j for j in range(i + 1) if self.same_watcher(members[j], member)))
+
+        # Stacked weights of the decoder, kept out of the state dict which holds the weights of every member
+        with torch.no_grad():
+            parsers = [member.parser for member in members]
+            self.linear_weights = {name: stack_linear([parser[name] for parser in parsers])
+                                   for name, layer in members[0].parser.items() if isinstance(layer, nn.Linear)}
+            self.embedding = torch.stack([member.embedder.weight for member in members])  # (N, V, E)
+            # The coverage convolution as a product with the patches of the attention history, (N, K, Q) and (N, 1, Q)
+            self.conv_q_weight = torch.stack([parser['conv_q'].weight.flatten(1).t() for parser in parsers])
+            self.conv_q_bias = torch.stack([parser['conv_q'].bias for parser in parsers]).unsqueeze(1)
+        self.kernel = members[0].parser['conv_q'].kernel_size
+        self.hidden_dim = self.config['hidden_dim']
+
+    @classmethod
+    def from_checkpoints(cls, paths, config, device=None, beam_width=1):
+        """
+        :param paths: locations of the state dicts saved by VanillaWAP.save(), trained with config
+        :return: the Ensemble of the checkpoints in eval mode
+        """
+        return cls([VanillaWAP.from_checkpoint(path, config, device) for path in paths], beam_width).eval()
+
+    @staticmethod
+    def same_watcher(a, b):
+        return a is b or all(torch.equal(p, q) for p, q in zip(a.watcher.state_dict().values(),
+                                                               b.watcher.state_dict().values()))
+
+    def watch_stride(self):
+        return self.members[0].watch_stride()
+
+    def linear(self, name, x):
+        """
+        :param name: name of an nn.Linear of the parser
+        :param x: inputs of every member - (N, B, In)
+        :return: the outputs of the layer of every member - (N, B, Out)
+        """
+        weight, bias = self.linear_weights[name]
+        return torch.bmm(x, weight) if bias is None else torch.baddbmm(bias, x, weight)
+
+    def contexts(self, x, mask):
+        """
+        Watch the images with every member and gather the attended cells, see VanillaWAP.pack_context. Dense attention
+        is computed over the packed cells as well, which gives the same weights as VanillaWAP.attend
+        :param x: images - (B, 1, H, W)
+        :param mask: image masks - (B, 1, H, W)
+        :return: the PackedContext of the members, stacked - (N, ...) but for the index and the validity of the cells
+        which they share, and the initial hidden states - (N, B, H)
+        """
+        features = {}
+        packs, hidden = [], []
+        for member, source in zip(self.members, self.watcher_of):
+            if source not in features:
+                features[source] = member.encode(x, mask)
+            feature, feature_mask = features[source]
+            attention_mask, pctx = member.attention_context(feature, feature_mask, x)
+            if not isinstance(pctx, PackedContext):
+                pctx = member.pack_context(feature, attention_mask)
+            packs.append(pctx)
+            hidden.append(member.init_hidden(feature, feature_mask))
+        packed = PackedContext(packs[0].index, packs[0].valid, torch.stack([p.x for p in packs]),
+                               torch.stack([p.pctx for p in packs]), packs[0].shape)
+        return packed, torch.stack(hidden)
+
+    def step(self, y, h_t_1, alpha_past, packed):
+        """
+        One decoder step of every member, VanillaWAP.parse with the attention of VanillaWAP.attend_packed
+        :param y: previous tokens - (B)
+        :param h_t_1: hidden states - (N, B, H)
+        :param alpha_past: attention histories - (N, B, 1, Height, Width)
+        :param packed: stacked PackedContext, see contexts()
+        :return: the logits (N, B, V), the hidden states and the attention histories
+        """
+        num_members, batch_size = h_t_1.shape[:2]
+        state_below = self.embedding[:, y]  # (N, B, E)
+
+        # First GRU
+        preact = torch.sigmoid(self.linear('U', h_t_1) + self.linear('W', state_below))  # (N, B, 2H)
+        r, u = preact[..., :self.hidden_dim], preact[..., self.hidden_dim:]  # (N, B, H)
+        h_tilde = torch.tanh(r * self.linear('Ux', h_t_1) + self.linear('Wx', state_below))
+        h1 = u * h_t_1 + (1. - u) * h_tilde  # (N, B, H)
+
+        # Coverage at the attended cells
+        num_cells = packed.index.shape[1]
+        patches = nn.functional.unfold(alpha_past.flatten(0, 1), self.kernel,
+                                       padding=(self.kernel[0] // 2, self.kernel[1] // 2))  # (N * B, K, HW)
+        index = packed.index.repeat(num_members, 1).unsqueeze(1).expand(-1, patches.shape[1], -1)
+        patches = torch.gather(patches, 2, index).view(num_members, batch_size, -1, num_cells)  # (N, B, K, C)
+        cover_F = patches.transpose(2, 3).flatten(1, 2) @ self.conv_q_weight + self.conv_q_bias
+        cover_vector = self.linear('conv_uf', cover_F)  # (N, B * C, A)
+
+        # Softmax over the attended cells
+        pstate_ = self.linear('W_comb_att', h1).unsqueeze(2)  # (N, B, 1, A)
+        pctx__ = torch.tanh(packed.pctx + pstate_ + cover_vector.view(num_members, batch_size, num_cells, -1))
+        energy = self.linear('U_att', pctx__.flatten(1, 2)).view(num_members, batch_size, num_cells)  # (N, B, C)
+        alpha = torch.softmax(energy.masked_fill(~packed.valid, -torch.inf), dim=-1)
+        ct = torch.einsum('nbc, nbcd -> nbd', alpha, packed.x)  # (N, B, D)
+        alpha_t = alpha.new_zeros((num_members, batch_size, packed.shape[0] * packed.shape[1]))
+        alpha_t = alpha_t.scatter(2, packed.index.expand(num_members, -1, -1), alpha)
+        alpha_past = alpha_past + alpha_t.view(num_members, batch_size, 1, *packed.shape)
+
+        # Second GRU
+        preact2 = torch.sigmoid(self.linear('U_nl', h1) + self.linear('Wc', ct))  # (N, B, 2H)
+        r2, u2 = preact2[..., :self.hidden_dim], preact2[..., self.hidden_dim:]
+        h_tilde = torch.tanh(r2 * self.linear('Ux_nl', h1) + self.linear('Wcx', ct))
+        ht = u2 * h1 + (1. - u2) * h_tilde  # (N, B, H)
+
+        # Deep output layer with maxout
+        logit = self.linear('W_c', ct) + self.linear('W_h', ht) + self.linear('W_yo', state_below)  # (N, B, E)
+        logit = logit.view(num_members, batch_size, -1, 2).max(dim=-1)[0]
+        return self.linear('W_o', logit), ht, alpha_past
+
+    def translate(self, x, beam_width=None, mask=None, return_alphas=None, grammar=None):
+        """
+        Translate the input images with the mean of the log-probabilities of the members at every step
+        :param beam_width: number of hypotheses kept per image, defaults to self.beam_width
+        :param return_alphas: unused, the ensemble has no single attention map
+        :param grammar: LatexGrammar the output has to follow, defaults to self.grammar. None leaves it unconstrained
+        :return: the predicted tokens, ending with EOS, and None in place of the attention maps
+        """
+        beam_width = beam_width or self.beam_width
+        max_len = self.config['max_len']
+        grammar = grammar if grammar is not None else self.grammar
+        mask = torch.ones_like(x) if mask is None else mask
+        batch_size = x.shape[0]
+        packed, h_t = self.contexts(x, mask)
+
+        # The K hypotheses of an image are consecutive rows, and start from one live hypothesis
+        rows = batch_size * beam_width
+        packed = PackedContext(packed.index.repeat_interleave(beam_width, 0),
+                               packed.valid.repeat_interleave(beam_width, 0),
+                               packed.x.repeat_interleave(beam_width, 1), packed.pctx.repeat_interleave(beam_width, 1),
+                               packed.shape)
+        h_t = h_t.repeat_interleave(beam_width, 1)
+        alpha_past = h_t.new_zeros((len(self.members), rows, 1, *packed.shape))
+        scores = torch.full((batch_size, beam_width), -torch.inf, device=x.device)
+        scores[:, 0] = 0
+        scores = scores.view(rows)
+        y = torch.full((rows,), SOS_INDEX, dtype=torch.long, device=x.device)
+        state = grammar.start(rows, x.device) if grammar is not None else None
+        finished = torch.zeros(rows, dtype=torch.bool, device=x.device)
+        lengths = torch.zeros(rows, device=x.device)
+        tokens = y.new_zeros((rows, 0))
+        offsets = torch.arange(batch_size, device=x.device).unsqueeze(1) * beam_width  # (B, 1)
+        for i in range(max_len):
+            logit, h_t, alpha_past = self.step(y, h_t, alpha_past, packed)
+            log_probs = torch.log_softmax(logit, dim=-1).mean(dim=0)  # (B * K, V)
+            if state is not None:
+                log_probs = grammar.constrain(log_probs, state, max_len - i)
+            # Finished hypotheses, and those the grammar left without a token, only extend with EOS at no cost
+            finished = finished | torch.isinf(scores)
+            log_probs = torch.where(finished.unsqueeze(1), -torch.inf, log_probs)
+            log_probs[:, EOS_INDEX] = torch.where(finished, 0., log_probs[:, EOS_INDEX])
+
+            candidates = (scores.unsqueeze(1) + log_probs).view(batch_size, -1)  # (B, K * V)
+            top_scores, top = candidates.topk(beam_width, dim=1)  # (B, K)
+            parents = (offsets + torch.div(top, log_probs.shape[1], rounding_mode='floor')).view(rows)
+            y = (top % log_probs.shape[1]).view(rows)
+            scores = top_scores.view(rows)
+            h_t, alpha_past = h_t[:, parents], alpha_past[:, parents]
+            finished, lengths = finished[parents], lengths[parents] + ~finished[parents]
+            tokens = torch.cat([tokens[parents], y.unsqueeze(1)], dim=1)
+            if state is not None:
+                state = torch.where(finished, state[parents], grammar.advance(state[parents], y))
+            finished = finished | (y == EOS_INDEX)
+            if torch.all(finished):
+                break
+
+        # Best hypothesis of every image, by its mean log-probability per token
+        best = (scores / lengths.clamp(min=1)).view(batch_size, beam_width).argmax(dim=1)
+        ret = tokens[offsets.squeeze(1) + best]  # (B, L)
+        # A single image keeps its 1-D token sequence
+        return (ret.squeeze(0) if batch_size == 1 else ret), None
+
+
+def main(args):
+    config = CONFIGS[args.config]
+    if args.command == 'average':
+        average_checkpoints(args.checkpoints, args.output)
+        print(f'Averaged {len(args.checkpoints)} checkpoints to {args.output}')
+        return
+
+    vocabulary = get_vocabulary(VOCAB_LOC)
+    index_to_word = {i: word for i, word in enumerate(vocabulary)}
+    ensemble = Ensemble.from_checkpoints(args.checkpoints, config, args.device, args.beam_width)
+    if config['constrained_decoding']:
+        ensemble.grammar = LatexGrammar(vocabulary)
+    for path, image, error in [load(path, ensemble.config) for path in args.images]:
+        if error is not None:
+            print(f'{path}: {error}')
+            continue
+        start = time.perf_counter()
+        latex, = translate_images(ensemble, [image], index_to_word)
+        print(f'{path} ({(time.perf_counter() - start) * 1000:.0f} ms): {latex}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translate images with an ensemble of checkpoints, or average them')
+    parser.add_argument('command', choices=['translate', 'average'])
+    parser.add_argument('--checkpoints', nargs='+', required=True, help='checkpoints trained with --config')
+    parser.add_argument('--config', choices=CONFIGS.keys(), default='inference',
+                        help='config the checkpoints are built and decoded with')
+    parser.add_argument('--images', nargs='+', default=[], help='images to translate')
+    parser.add_argument('--output', default='model_avg.pth', help='location of the averaged checkpoint')
+    parser.add_argument('--beam_width', type=int, default=1, help='hypotheses kept per image, 1 decodes greedily')
+    parser.add_argument('--device', default=None)
+    main(parser.parse_args())
@@ -0,0 +1,309 @@
+# Standalone evaluation of checkpoints on a split of a labelled manifest. Run from the root of the repository:
+#   python -m translator.evaluate --checkpoints checkpoints/model_best.pth --split val --output val.json
+#   python -m translator.evaluate --checkpoints a.pth student=b.pth --manifest val.csv --split all
+#   python -m translator.evaluate --checkpoints checkpoints/model_best.pth --manifest data/CROHME/train/index.npz
+#   python -m translator.evaluate --checkpoints checkpoints/model_30.pth+checkpoints/model_best.pth --beam_width 5
+# The predictions are cached per checkpoint and image, so scoring again, or comparing a new checkpoint against ones
+# already evaluated, only decodes the images that were never decoded with these weights.
+import argparse
+import hashlib
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+import torch
+from torch.utils.data import random_split
+
+from train.models import VanillaWAP
+from train.utils.datasets import get_vocabulary
+from train.utils.distillation import hash_model
+from train.utils.global_params import BASE_CONFIG, CROHME_TRAIN, INFERENCE_CONFIG, STUDENT_CONFIG, VOCAB_LOC
+from train.utils.grammar import LatexGrammar
+from train.utils.manifest import ManifestIndex
+from translator.convert import JsonlWriter, convert
+from translator.ensemble import Ensemble
+
+CONFIGS = {'base': BASE_CONFIG, 'inference': INFERENCE_CONFIG, 'student': STUDENT_CONFIG}
+# Config keys the predictions depend on besides the weights
+DECODING_KEYS = ('max_len', 'crop_to_ink', 'max_pixels', 'encoder_mode', 'tile_size', 'tile_overlap',
+                 'attention_mode', 'attention_ink_only', 'ink_dilation', 'constrained_decoding')
+LENGTH_BUCKETS = [(1, 5), (6, 10), (11, 20), (21, 40), (41, None)]
+PREDICTIONS_FILE = 'predictions.jsonl'
+
+
+def load_split(manifest, split, seed, image_dir=None):
+    """
+    :param manifest: tab separated file with the image_loc and label columns, or an npz index of train/utils/manifest.py
+    :param split: 'train' or 'val' for the split of the training loop (see train.py), or 'all'
+    :param seed: seed of the split, train_params['random_seed'] of the training run
+    :param image_dir: directory the images are looked up in by file name, for manifests written on another machine
+    :return: list of the image paths and list of their labels
+    """
+    if manifest.endswith('.npz'):
+        # The index resolves its paths itself, and train.py splits it with ManifestIndex.split
+        index = ManifestIndex(manifest)
+        paths, labels = index.image_paths, [str(label) for label in index.labels]
+        if split != 'all':
+            valid = index.valid()
+            indices = [i for i in index.split([0.8, 0.2], seed)[0 if split == 'train' else 1] if valid[i]]
+            paths, labels = [paths[i] for i in indices], [labels[i] for i in indices]
+        return paths, labels
+
+    data = pd.read_csv(manifest, sep='\t')
+    paths, labels = list(data['image_loc']), [str(label) for label in data['label']]
+    if image_dir is not None:
+        paths = [os.path.join(image_dir, os.path.basename(path)) for path in paths]
+    if split != 'all':
+        # random_split only depends on the number of samples and the generator, so this is the split of train.py
+        train, val = random_split(range(len(paths)), [0.8, 0.2], generator=torch.Generator().manual_seed(seed))
+        indices = sorted((train if split == 'train' else val).indices)
+        paths, labels = [paths[i] for i in indices], [labels[i] for i in indices]
+    return paths, labels
+
+
+def hash_file(path):
+    """
+    :return: sha1 hex digest of the content of a file, None if it cannot be read
+    """
+    try:
+        with open(path, 'rb') as f:
+            return hashlib.sha1(f.read()).hexdigest()
+    except OSError:
+        return None
+
+
+def model_key(model):
+    """
+    :return: key of the predictions of model: the hash of its weights and of the config keys decoding depends on
+    """
+    h = hashlib.sha1(hash_model(model).encode())
+    keys = {key: model.config.get(key) for key in DECODING_KEYS}
+    if isinstance(model, Ensemble):
+        keys['beam_width'] = model.beam_width
+    h.update(json.dumps(keys, sort_keys=True).encode())
+    return h.hexdigest()
+
+
+class PredictionCache:
+    """
+    Append-only JSONL file of the predictions of one model, keyed by the hash of the image file. It is a JsonlWriter
+    for convert(): records arrive keyed by path and are stored keyed by image hash. Failed images are not stored, so
+    they are decoded again by the next evaluation.
+    """
+    def __init__(self, cache_dir, key):
+        self.loc = os.path.join(cache_dir, key)
+        os.makedirs(self.loc, exist_ok=True)
+        self.file = os.path.join(self.loc, PREDICTIONS_FILE)
+        self.predictions = {}
+        if os.path.exists(self.file):
+            with open(self.file, 'r') as f:
+                for line in f:
+                    try:
+                        record = json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+                    self.predictions[record['image_hash']] = record
+        self.path_to_hash = {}
+        self.errors = {}
+        self.writer = None
+
+    def __contains__(self, image_hash):
+        return image_hash in self.predictions
+
+    def open(self, path_to_hash):
+        self.path_to_hash = path_to_hash
+        self.writer = JsonlWriter(self.file)
+
+    def write(self, records):
+        stored = []
+        for record in records:
+            if 'latex' not in record:
+                self.errors[record['path']] = record['error']
+                continue
+            record = {'image_hash': self.path_to_hash[record['path']], 'latex': record['latex'],
+                      'latency_ms': record['latency_ms']}
+            self.predictions[record['image_hash']] = record
+            stored.append(record)
+        self.writer.write(stored)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+def edit_distance(a, b):
+    """
+    :return: Levenshtein distance between the token lists a and b
+    """
+    previous = list(range(len(b) + 1))
+    for i, token in enumerate(a, 1):
+        current = [i]
+        for j, other in enumerate(b, 1):
+            current.append(min(previous[j] + 1, current[j - 1] + 1, previous[j - 1] + (token != other)))
+        previous = current
+    return previous[-1]
+
+
+def summarize(distances, lengths):
+    """
+    :param distances: token edit distance of every prediction to its label
+    :param lengths: number of tokens of every label
+    :return: dictionary of the number of samples, the expression rate, the WER and the <=1 and <=2 error rates
+    """
+    distances, lengths = np.array(distances), np.array(lengths)
+    if len(distances) == 0:
+        return {'samples': 0, 'expression_rate': None, 'wer': None, 'le1_rate': None, 'le2_rate': None}
+    return {
+        'samples': len(distances),
+        'expression_rate': float(np.mean(distances == 0)),
+        'wer': float(distances.sum() / max(lengths.sum(), 1)),
+        'le1_rate': float(np.mean(distances <= 1)),
+        'le2_rate': float(np.mean(distances <= 2)),
+    }
+
+
+def score(predictions, labels, min_symbol_count=10):
+    """
+    :param predictions: predicted latex of every sample, None for the images that could not be decoded
+    :param labels: latex labels
+    :param min_symbol_count: symbols found in fewer labels than this are left out of the per-symbol breakdown
+    :return: the overall metrics and their breakdown by label length and by symbol
+    """
+    predictions = [(prediction or '').split() for prediction in predictions]
+    labels = [label.split() for label in labels]
+    distances = [edit_distance(prediction, label) for prediction, label in zip(predictions, labels)]
+    lengths = [len(label) for label in labels]
+
+    by_length = {}
+    for low, high in LENGTH_BUCKETS:
+        selected = [i for i, n in enumerate(lengths) if n >= low and (high is None or n <= high)]
+        name = f'{low}-{high}' if high is not None else f'{low}+'
+        by_length[name] = summarize([distances[i] for i in selected], [lengths[i] for i in selected])
+
+    # A sample counts towards every symbol of its label
+    symbol_samples = {}
+    for i, label in enumerate(labels):
+        for symbol in set(label):
+            symbol_samples.setdefault(symbol, []).append(i)
+    by_symbol = {symbol: summarize([distances[i] for i in selected], [lengths[i] for i in selected])
+                 for symbol, selected in sorted(symbol_samples.items()) if len(selected) >= min_symbol_count}
+    return {'overall': summarize(distances, lengths), 'by_length': by_length, 'by_symbol': by_symbol}
+
+
+def evaluate(checkpoint, config, paths, labels, args):
+    """
+    Decode the images of paths missing from the prediction cache of checkpoint, then score all of them. Checkpoints
+    joined by + are decoded as an Ensemble
+    :return: the metrics of score(), with the throughput of the decoding and the percentiles of the latencies
+    """
+    device = args.device or config['DEVICE']
+    if '+' in checkpoint:
+        model = Ensemble.from_checkpoints(checkpoint.split('+'), config, device, args.beam_width)
+    else:
+        model = VanillaWAP.from_checkpoint(checkpoint, config, device)
+    vocabulary = get_vocabulary(VOCAB_LOC)
+    index_to_word = {i: word for i, word in enumerate(vocabulary)}
+    if config['constrained_decoding']:
+        model.grammar = LatexGrammar(vocabulary)
+
+    cache = PredictionCache(args.cache_dir, model_key(model))
+    with ThreadPoolExecutor(args.prefetch) as pool:
+        hashes = list(pool.map(hash_file, paths))
+    path_to_hash = {path: image_hash for path, image_hash in zip(paths, hashes) if image_hash is not None}
+    # Identical images are decoded once
+    todo = list({image_hash: path for path, image_hash in path_to_hash.items() if image_hash not in cache}.values())
+    print(f'{checkpoint}: {len(paths)} images, {len(paths) - len(todo)} cached, {len(todo)} to decode')
+
+    cache.open(path_to_hash)
+    start = time.perf_counter()
+    try:
+        decoded = convert(model, todo, index_to_word, cache, args.batch_size, args.prefetch, args.replicas)
+    finally:
+        cache.close()
+    elapsed = time.perf_counter() - start
+
+    records = [cache.predictions.get(image_hash) for image_hash in hashes]
+    report = score([record['latex'] if record else None for record in records], labels, args.min_symbol_count)
+    latencies = np.array([record['latency_ms'] for record in records if record])
+    report['failed'] = len(paths) - len(latencies)
+    report['decoded'] = decoded
+    report['throughput'] = decoded / elapsed if decoded else None
+    report['latency_ms'] = {f'p{q}': float(np.percentile(latencies, q)) if len(latencies) else None
+                            for q in (50, 90, 99)}
+    return report
+
+
+def format_metrics(metrics):
+    if not metrics['samples']:
+        return f'{0:>8}' + f'{"-":>11}' * 4
+    return (f'{metrics["samples"]:>8}{metrics["expression_rate"]:>11.3f}{metrics["wer"]:>11.3f}'
+            f'{metrics["le1_rate"]:>11.3f}{metrics["le2_rate"]:>11.3f}')
+
+
+def print_report(name, report, worst_symbols):
+    header = f'{"samples":>8}{"expr rate":>11}{"WER":>11}{"<=1 err":>11}{"<=2 err":>11}'
+    print(f'\n{name}')
+    print(f'{"":<16}{header}')
+    print(f'{"overall":<16}{format_metrics(report["overall"])}')
+    for bucket, metrics in report['by_length'].items():
+        print(f'{"length " + bucket:<16}{format_metrics(metrics)}')
+    symbols = sorted(report['by_symbol'].items(), key=lambda item: item[1]['expression_rate'])[:worst_symbols]
+    if symbols:
+        print(f'{worst_symbols} symbols with the lowest expression rate:')
+        for symbol, metrics in symbols:
+            print(f'{symbol:<16}{format_metrics(metrics)}')
+    latency = report['latency_ms']
+    throughput = '-' if report['throughput'] is None else f'{report["throughput"]:.1f} images/s'
+    p50 = '-' if latency['p50'] is None else f'{latency["p50"]:.1f}/{latency["p90"]:.1f}/{latency["p99"]:.1f} ms'
+    print(f'failed {report["failed"]}, decoded {report["decoded"]}, throughput {throughput}, latency p50/p90/p99 {p50}')
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    paths, labels = load_split(args.manifest, args.split, args.seed, args.image_dir)
+
+    reports = {}
+    for item in args.checkpoints:
+        # config=path evaluates path with another config than --config, e.g. a student next to its teacher
+        name, checkpoint = item.split('=', 1) if item.split('=', 1)[0] in CONFIGS else (args.config, item)
+        reports[checkpoint] = evaluate(checkpoint, CONFIGS[name], paths, labels, args)
+        print_report(checkpoint, reports[checkpoint], args.worst_symbols)
+
+    if len(reports) > 1:
+        print(f'\n{"checkpoint":<40}{"samples":>8}{"expr rate":>11}{"WER":>11}{"<=1 err":>11}{"<=2 err":>11}')
+        for checkpoint, report in reports.items():
+            print(f'{checkpoint[-40:]:<40}{format_metrics(report["overall"])}')
+
+    if args.output:
+        with open(args.output, 'w') as f:
+            json.dump({'manifest': args.manifest, 'split': args.split, 'config': args.config, 'results': reports}, f,
+                      indent=2)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Evaluate checkpoints on a labelled split with cached predictions')
+    parser.add_argument('--checkpoints', nargs='+', default=['checkpoints/model_best.pth'],
+                        help='weights to evaluate, prefixed by config= to override --config, e.g. student=path. '
+                             'Paths joined by + are evaluated as an ensemble')
+    parser.add_argument('--config', choices=CONFIGS.keys(), default='inference',
+                        help='config the checkpoints are built and decoded with')
+    parser.add_argument('--manifest', default=CROHME_TRAIN + '/wap_dataset.csv')
+    parser.add_argument('--split', choices=['train', 'val', 'all'], default='val')
+    parser.add_argument('--seed', type=int, default=BASE_CONFIG['train_params']['random_seed'])
+    parser.add_argument('--image_dir', default=None, help='directory the images are looked up in by file name')
+    parser.add_argument('--cache_dir', default='eval_cache')
+    parser.add_argument('--device', default=None)
+    parser.add_argument('--batch_size', type=int, default=16)
+    parser.add_argument('--beam_width', type=int, default=1, help='hypotheses kept per image by the ensembles')
+    parser.add_argument('--prefetch', type=int, default=4, help='number of image decoding threads')
+    parser.add_argument('--replicas', type=int, default=1, help='number of batches translated concurrently')
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    parser.add_argument('--min_symbol_count', type=int, default=10)
+    parser.add_argument('--worst_symbols', type=int, default=10,
+                        help='number of symbols printed, the output has all of them')
+    parser.add_argument('--output', help='JSON file to write the reports to')
+    main(parser.parse_args())
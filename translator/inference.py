@@ -1,49 +1,140 @@
 # style.py
 import torch, os
+import base64
+import io
+import threading
+import numpy as np
 import streamlit as st
-import torchvision.transforms as transforms
+from matplotlib import colormaps
 from PIL import Image
 import sys
 
 sys.path.append("..")
 
 from train.models import VanillaWAP
-from train.utils.global_params import BASE_CONFIG, VOCAB_LOC
+from train.utils.global_params import BASE_CONFIG, INFERENCE_CONFIG, VOCAB_LOC
 from train.utils.datasets import convert_to_string, get_vocabulary
+from train.utils.grammar import LatexGrammar
+from train.utils.preprocessing import pad_to_stride, prepare_image, to_tensor
 
 device = torch.device('cuda' if torch.cuda.is_available() else 'cpu')
+# Width of the main column of the app, images are shown at most this wide
+DISPLAY_WIDTH = 704
 
 
 @st.cache_resource
 def load_model():
     with torch.no_grad():
-        model = VanillaWAP(BASE_CONFIG)
+        model = VanillaWAP(INFERENCE_CONFIG)
         model_loc = os.path.join(BASE_CONFIG['root_loc'], BASE_CONFIG['train_params']['save_loc'])
         state_dict = torch.load('checkpoints/model_best.pth', map_location=device)
 
         model.load_state_dict(state_dict)
         model.eval().to(device)
+        if INFERENCE_CONFIG['constrained_decoding']:
+            model.grammar = LatexGrammar(get_vocabulary(VOCAB_LOC))
         return model
 
-def pass_attention(alpha, size):
-    ret = torch.nn.functional.interpolate(alpha.unsqueeze(0).unsqueeze(0), size=size)
-    ret = ret.squeeze().detach().cpu().numpy()
-    return ret
+
+def warm_up():
+    """
+    Load the model and run a dummy translation, so that the first click pays neither for the loading nor for the
+    allocations of the first forward pass
+    """
+    model = load_model()
+    x = torch.zeros(1, 1, 128, 512, device=device)
+    x[..., 56:72, 64:448] = 1
+    with torch.no_grad():
+        model.translate(x, mask=torch.ones_like(x), return_alphas=True)
+
+
+@st.cache_resource
+def start_warm_up():
+    """
+    Warm the model up in a background thread, once per server process
+    :return: the thread
+    """
+    thread = threading.Thread(target=warm_up, daemon=True)
+    thread.start()
+    return thread
+
+
+@st.cache_data
+def thumbnail(path, width=180):
+    """
+    :param path: path to an image
+    :param width: width of the thumbnail in pixels
+    :return: the image downscaled to width as a base64 encoded PNG
+    """
+    image = Image.open(path).convert('L')
+    if image.width > width:
+        image = image.resize((width, max(1, round(image.height * width / image.width))), Image.BILINEAR)
+    buffer = io.BytesIO()
+    image.save(buffer, format='PNG')
+    return base64.b64encode(buffer.getvalue()).decode('utf-8')
+
+
+@st.cache_data
+def load_image(content_image):
+    """
+    :param content_image: path or uploaded file of an image
+    :return: the grayscale image - (H, W) uint8
+    """
+    return np.array(Image.open(content_image).convert('L'))
+
+
+def colorize(images, cmap='viridis'):
+    """
+    :param images: values in [0, 1] - (..., H, W)
+    :return: the images mapped through cmap - (..., H, W, 3) float32
+    """
+    return colormaps[cmap](images)[..., :3].astype(np.float32)
+
+
+@st.cache_data
+def preview(content_image):
+    """
+    :param content_image: path or uploaded file of an image
+    :return: the image as displayed by the app - (H, W, 3) uint8
+    """
+    return (colorize(load_image(content_image) / 255.) * 255).astype(np.uint8)
+
+
+def attention_overlays(alphas, image, steps=None, opacity=0.4, width=DISPLAY_WIDTH):
+    """
+    Render the attention map of every decoded token over the image at once, so that showing the map of a token is
+    only a lookup
+    :param alphas: AttentionMaps of the translation of image
+    :param image: the translated image - (H, W) uint8
+    :param steps: number of decoding steps rendered, e.g. the number of tokens of the label. None renders them all
+    :param opacity: opacity of the maps, each map is shown in grayscale stretched to its own range
+    :param width: width the overlays are rendered at, larger images are downscaled as st.image would display them
+    :return: one RGB image per rendered step - (L, H', W', 3) uint8
+    """
+    scale = min(1., width / image.shape[1])
+    maps = alphas.upsample_all(image.shape, steps=steps, scale=scale)
+    if scale < 1:
+        image = np.array(Image.fromarray(image).resize((maps.shape[2], maps.shape[1]), Image.BILINEAR))
+    low, high = maps.min(axis=(1, 2), keepdims=True), maps.max(axis=(1, 2), keepdims=True)
+    maps = (maps - low) * (opacity * 255 / np.maximum(high - low, 1e-12))
+    base = colorize(image / 255.) * ((1 - opacity) * 255)
+    return (base[None] + maps[..., None]).astype(np.uint8)
 
 
 @st.cache_resource
 def translate(_model, content_image):
-    img = Image.open(content_image).convert('L')
-    transform = transforms.Compose([transforms.ToTensor()])
+    img = np.array(Image.open(content_image).convert('L'))
     vocab = get_vocabulary(VOCAB_LOC)
     index_to_word = {i: word for i, word in enumerate(vocab)}
-    img = transform(img).unsqueeze(0).to(device)
-    if torch.mean(img) > 0.5:
-        img = torch.where(1 - img > 0.1, 1.0, 0.0)  # invert the image
-    mask = torch.ones_like(img).to(device)
+    img, region = prepare_image(img, _model.config)
+    padded, mask = pad_to_stride(img, _model.watch_stride())
+    x = to_tensor(padded).unsqueeze(0).to(device)
+    mask = to_tensor(mask, scale=1).unsqueeze(0).to(device)
 
     with torch.no_grad():
-        tokenized_label, alphas = _model.translate(img, mask=mask)
+        tokenized_label, alphas = _model.translate(x, mask=mask, return_alphas=True)
+    alphas.region = region
+    alphas.image_shape, alphas.padded_shape = img.shape, padded.shape
 
     label = convert_to_string(tokenized_label, index_to_word)
     return label, alphas
@@ -0,0 +1,349 @@
+# Incremental recognition of online ink. Run from the root of the repository to replay the traces of an InkML file one
+# stroke at a time and report the latency of every update:
+#   python -m translator.online sample.inkml --checkpoint checkpoints/model_best.pth
+# Every stroke is drawn onto a canvas kept for the whole session, and only the cells of the cached feature map whose
+# receptive field meets the new ink are encoded again. A background thread re-decodes after every stroke, and a decode
+# still running when the next stroke arrives is cancelled since its result would already be stale.
+import argparse
+import itertools
+import threading
+import time
+import xml.etree.ElementTree as ET
+
+import numpy as np
+import torch
+from PIL import Image, ImageDraw
+
+from train.models import VanillaWAP
+from train.utils.datasets import convert_to_string, get_vocabulary
+from train.utils.global_params import INFERENCE_CONFIG, VOCAB_LOC
+from train.utils.grammar import LatexGrammar
+from train.utils.synthetic import INKML
+
+
+def parse_trace(trace):
+    """
+    :param trace: InkML trace text 'x y, x y, ...', extra channels such as the time are ignored
+    :return: the points of the trace - (N, 2)
+    """
+    points = [pt.split()[:2] for pt in trace.strip().split(',') if pt.strip()]
+    return np.array(points, dtype=np.float32).reshape(-1, 2)
+
+
+def read_traces(inkml_file):
+    """
+    :param inkml_file: InkML file
+    :return: the points of its traces in the order they were written - list of (N, 2)
+    """
+    root = ET.parse(inkml_file).getroot()
+    return [parse_trace(trace.text) for trace in root.findall(INKML + 'trace') if trace.text]
+
+
+class OnlineSession:
+    """
+    Recognition of an expression while it is being written. Traces are fed with add_trace(), either whole or a few
+    points at a time, and the latex of the ink written so far is published to on_update and returned by wait().
+
+    The canvas and the feature map of the encoder persist across strokes. A stroke only invalidates the cells whose
+    receptive field (VanillaWAP.receptive_field) meets its bounding box; they are recomputed from a crop of the canvas
+    aligned to the stride and wide enough for the field of every recomputed cell to lie inside it, so the cached map
+    stays equal to watching the whole canvas. Canvas growth is the only event that encodes everything again.
+    """
+    def __init__(self, model, index_to_word, scale=None, unit=32, line_width=3, margin=8, canvas_size=(256, 512),
+                 grow=256, on_update=None):
+        """
+        :param model: VanillaWAP in eval mode
+        :param index_to_word: vocabulary of the model
+        :param scale: number of pixels per unit of the ink coordinates, None fits the first points added to unit pixels
+        :param unit: size in pixels of the first points when scale is None, about the height of a symbol
+        :param line_width: width of the strokes in pixels
+        :param margin: number of pixels around the ink the decoder attends to
+        :param canvas_size: initial (height, width) of the canvas, rounded up to a multiple of the stride
+        :param grow: number of pixels the canvas grows by when the ink reaches one of its sides
+        :param on_update: optional callable(latex, version) called from the decoding thread with every new result
+        """
+        self.model = model
+        self.index_to_word = index_to_word
+        self.scale = scale
+        self.unit = unit
+        self.line_width = line_width
+        self.margin = margin
+        self.on_update = on_update
+        self.stride = model.watch_stride()
+        self.before, self.after = model.receptive_field()
+        self.grow = grow + (-grow) % self.stride
+        self.canvas_size = tuple(size + (-size) % self.stride for size in canvas_size)
+        self.ids = itertools.count()
+        self.timings = []
+        self.features = None
+
+        self.lock = threading.Lock()
+        self.updated = threading.Condition(self.lock)
+        self.wake = threading.Event()
+        self.cancel = threading.Event()
+        self.closed = False
+        self.reset()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+        self.thread.start()
+
+    def reset(self):
+        # Blank canvas, its whole feature map is computed again at the next update
+        self.canvas = Image.new('L', self.canvas_size[::-1], 0)
+        self.draw = ImageDraw.Draw(self.canvas)
+        self.origin, self.offset = None, None
+        self.traces = {}
+        self.bbox = None
+        self.dirty, self.resized = None, True
+        self.version, self.decoded, self.latex = 0, 0, ''
+        self.stamps = {0: time.perf_counter()}
+
+    def clear(self):
+        """
+        Erase the ink and start a new expression
+        """
+        with self.lock:
+            version = self.version
+            self.reset()
+            self.version = self.decoded = version + 1
+            self.cancel.set()
+
+    def add_trace(self, points, trace_id=None):
+        """
+        Draw the new segments of a trace and schedule a new decoding
+        :param points: new points of the trace, as InkML trace text or an array - (N, 2)
+        :param trace_id: id returned for the previous points of the same trace, None starts a new trace
+        :return: the id of the trace, to pass with its next points
+        """
+        points = parse_trace(points) if isinstance(points, str) else np.asarray(points, dtype=np.float32)[:, :2]
+        if len(points) == 0:
+            return trace_id
+        with self.lock:
+            if self.origin is None:
+                self.start(points)
+            pixels = (points - self.origin) * self.scale + self.offset
+            pixels = self.fit(pixels)
+            if trace_id is None:
+                trace_id = next(self.ids)
+            elif trace_id in self.traces:
+                # Connect the new points to the end of the trace
+                pixels = np.concatenate([self.traces[trace_id][None], pixels])
+            self.traces[trace_id] = pixels[-1]
+
+            r = self.line_width / 2
+            if len(pixels) == 1:
+                (cx, cy), r = pixels[0], max(r, 1)
+                self.draw.ellipse([cx - r, cy - r, cx + r, cy + r], fill=255)
+            else:
+                self.draw.line([tuple(p) for p in pixels], fill=255, width=self.line_width, joint='curve')
+
+            # Pixel bounds (top, bottom, left, right) of the new ink, bottom and right exclusive
+            low, high = np.floor(pixels.min(axis=0) - r - 1), np.ceil(pixels.max(axis=0) + r + 2)
+            rect = (int(low[1]), int(high[1]), int(low[0]), int(high[0]))
+            self.dirty = union(self.dirty, rect)
+            self.bbox = union(self.bbox, rect)
+            self.version += 1
+            self.stamps[self.version] = time.perf_counter()
+            self.cancel.set()
+            self.wake.set()
+        return trace_id
+
+    def start(self, points):
+        # The first trace sets the mapping from ink coordinates to pixels, it starts on the middle line of the canvas
+        if self.scale is None:
+            extent = float(np.ptp(points, axis=0).max()) if len(points) > 1 else 0.
+            self.scale = self.unit / extent if extent > 0 else 1.
+        self.origin = points.min(axis=0)
+        self.offset = np.array([self.margin + self.line_width, self.canvas_size[0] / 2], dtype=np.float32)
+
+    def fit(self, pixels):
+        """
+        Grow the canvas, by multiples of the stride, until pixels and the margin around them fit in it
+        :return: pixels in the coordinates of the new canvas
+        """
+        pad = self.margin + self.line_width
+        width, height = self.canvas.size
+        low, high = pixels.min(axis=0) - pad, pixels.max(axis=0) + pad
+        left = int(np.ceil(-low[0] / self.grow)) * self.grow if low[0] < 0 else 0
+        top = int(np.ceil(-low[1] / self.grow)) * self.grow if low[1] < 0 else 0
+        right = int(np.ceil((high[0] - width) / self.grow)) * self.grow if high[0] > width else 0
+        bottom = int(np.ceil((high[1] - height) / self.grow)) * self.grow if high[1] > height else 0
+        if not any((left, top, right, bottom)):
+            return pixels
+
+        canvas = Image.new('L', (width + left + right, height + top + bottom), 0)
+        canvas.paste(self.canvas, (left, top))
+        self.canvas, self.draw = canvas, ImageDraw.Draw(canvas)
+        shift = np.array([left, top], dtype=np.float32)
+        self.offset = self.offset + shift
+        self.traces = {trace_id: point + shift for trace_id, point in self.traces.items()}
+        if self.bbox is not None:
+            self.bbox = (self.bbox[0] + top, self.bbox[1] + top, self.bbox[2] + left, self.bbox[3] + left)
+        self.dirty, self.resized = None, True
+        return pixels + shift
+
+    def cells(self, rect):
+        """
+        :param rect: (top, bottom, left, right) pixel bounds of new ink
+        :return: (top, bottom, left, right) bounds of the feature cells whose receptive field meets rect, and the
+        bounds of the smallest crop of the canvas, aligned to the stride, these cells can be computed from exactly
+        """
+        height, width = self.canvas.size[1] // self.stride, self.canvas.size[0] // self.stride
+        stride, before, after = self.stride, self.before, self.after
+        # Cell c sees the pixels [c * stride - before, c * stride + after]
+        cells, crop = [], []
+        for low, high, size in ((rect[0], rect[1], height), (rect[2], rect[3], width)):
+            c0 = max(0, -((after - low) // stride))
+            c1 = min(size, (high - 1 + before) // stride + 1)
+            p0 = max(0, c0 - -(-before // stride))
+            p1 = min(size, c1 + -(-(after + 1 - stride) // stride))
+            cells += [c0, c1]
+            crop += [p0 * stride, p1 * stride]
+        return tuple(cells), tuple(crop)
+
+    def encode(self, canvas, cells=None, crop=None):
+        """
+        Bring the cached feature map up to date with the canvas, run by the decoding thread
+        :param canvas: uint8 canvas, or the crop of the canvas the cells are computed from
+        :param cells: (top, bottom, left, right) bounds of the cells to recompute, None encodes the whole canvas
+        :param crop: (top, bottom, left, right) pixel bounds of the crop, see cells()
+        :return: the number of cells computed
+        """
+        x = torch.from_numpy(canvas).float().div(255.)[None, None].to(self.model.config['DEVICE'])
+        features, _ = self.model.watch(x)
+        if cells is None:
+            self.features = features
+            return features.shape[-2] * features.shape[-1]
+        t, b, l, r = cells
+        top, left = crop[0] // self.stride, crop[2] // self.stride
+        self.features[:, :, t:b, l:r] = features[:, :, t - top:b - top, l - left:r - left]
+        return (b - t) * (r - l)
+
+    def run(self):
+        # Loop of the decoding thread
+        while True:
+            self.wake.wait()
+            with self.lock:
+                if self.closed:
+                    break
+                self.wake.clear()
+                self.cancel.clear()
+                version, bbox, size = self.version, self.bbox, self.canvas.size
+                canvas, cells, crop = None, None, None
+                if self.resized:
+                    canvas = np.array(self.canvas)
+                elif self.dirty is not None:
+                    cells, crop = self.cells(self.dirty)
+                    canvas = np.array(self.canvas.crop((crop[2], crop[0], crop[3], crop[1])))
+                self.dirty, self.resized = None, False
+
+            with torch.no_grad():
+                start = time.perf_counter()
+                computed = self.encode(canvas, cells, crop) if canvas is not None else 0
+                encoded = time.perf_counter()
+                latex = self.decode(bbox, size) if bbox is not None else ''
+                decoded = time.perf_counter()
+
+            with self.lock:
+                if self.cancel.is_set() or version != self.version:
+                    # A newer stroke arrived, its update supersedes this one
+                    continue
+                self.latex, self.decoded = latex, version
+                total = (size[0] // self.stride) * (size[1] // self.stride)
+                self.timings.append({'version': version, 'cells': computed, 'fraction': computed / total,
+                                     'encode_ms': (encoded - start) * 1e3, 'decode_ms': (decoded - encoded) * 1e3,
+                                     'latency_ms': (decoded - self.stamps.pop(version, start)) * 1e3})
+                self.stamps = {v: stamp for v, stamp in self.stamps.items() if v > version}
+                self.updated.notify_all()
+            if self.on_update is not None:
+                self.on_update(latex, version)
+
+    def decode(self, bbox, size):
+        """
+        :param bbox: pixel bounds of the ink
+        :param size: (width, height) of the canvas
+        :return: the latex of the ink, or None if the decoding was cancelled
+        """
+        # Attend to the cells of the ink and its margin only, like the images cropped to their ink
+        top = max(0, (bbox[0] - self.margin) // self.stride)
+        bottom = min(size[1] // self.stride, -(-(bbox[1] + self.margin) // self.stride))
+        left = max(0, (bbox[2] - self.margin) // self.stride)
+        right = min(size[0] // self.stride, -(-(bbox[3] + self.margin) // self.stride))
+        x = self.features[:, :, top:bottom, left:right]
+        mask = x.new_ones((1, 1, bottom - top, right - left))
+        tokens, _ = self.model.translate(x, mask=mask, return_alphas=False, encoded=True, cancel=self.cancel)
+        return None if self.cancel.is_set() else convert_to_string(tokens.reshape(-1), self.index_to_word)
+
+    def wait(self, timeout=None):
+        """
+        :param timeout: maximum number of seconds to wait, None waits until the decoding is done
+        :return: the latex of all the ink added so far, or of an older version if the timeout expires first
+        """
+        with self.updated:
+            self.updated.wait_for(lambda: self.decoded == self.version or self.closed, timeout)
+            return self.latex
+
+    def close(self):
+        with self.lock:
+            self.closed = True
+            self.cancel.set()
+            self.wake.set()
+            self.updated.notify_all()
+        self.thread.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def union(a, b):
+    """
+    :return: the (top, bottom, left, right) bounds of the union of the rectangles a and b, either of which can be None
+    """
+    if a is None or b is None:
+        return b if a is None else a
+    return min(a[0], b[0]), max(a[1], b[1]), min(a[2], b[2]), max(a[3], b[3])
+
+
+def main(args):
+    if args.threads:
+        torch.set_num_threads(args.threads)
+    model = VanillaWAP.from_checkpoint(args.checkpoint, INFERENCE_CONFIG, 'cpu')
+    vocabulary = get_vocabulary(VOCAB_LOC)
+    if INFERENCE_CONFIG['constrained_decoding']:
+        model.grammar = LatexGrammar(vocabulary)
+    index_to_word = {i: word for i, word in enumerate(vocabulary)}
+
+    traces = read_traces(args.inkml)
+    with OnlineSession(model, index_to_word, scale=args.scale, unit=args.unit) as session:
+        for i, trace in enumerate(traces):
+            # Stream the points of the trace in chunks, like a pen digitizer
+            trace_id = None
+            for start in range(0, len(trace), args.chunk):
+                trace_id = session.add_trace(trace[start:start + args.chunk], trace_id)
+            latex = session.wait()
+            timing = session.timings[-1]
+            print(f'stroke {i + 1:>3}  {timing["latency_ms"]:7.1f} ms  encode {timing["encode_ms"]:6.1f} ms  '
+                  f'cells {timing["fraction"]:5.1%}  {latex}')
+
+        latency = np.array([timing['latency_ms'] for timing in session.timings])
+        canvas = torch.from_numpy(np.array(session.canvas)).float().div(255.)[None, None]
+        with torch.no_grad():
+            start = time.perf_counter()
+            model.watch(canvas)
+            full = (time.perf_counter() - start) * 1e3
+    print(f'latency p50 {np.percentile(latency, 50):.1f} ms  p90 {np.percentile(latency, 90):.1f} ms, '
+          f'{np.mean([timing["fraction"] for timing in session.timings]):.1%} of the cells encoded per update, '
+          f'{full:.1f} ms to encode the final canvas at once')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Replay the traces of an InkML file through an online session')
+    parser.add_argument('inkml', help='InkML file')
+    parser.add_argument('--checkpoint', default='checkpoints/model_best.pth')
+    parser.add_argument('--scale', type=float, default=None, help='pixels per unit of the ink coordinates')
+    parser.add_argument('--unit', type=int, default=32, help='size in pixels of the first trace when --scale is unset')
+    parser.add_argument('--chunk', type=int, default=8, help='number of points fed at once')
+    parser.add_argument('--threads', type=int, default=0, help='number of intra-op threads, 0 keeps the default')
+    main(parser.parse_args())
@@ -0,0 +1,128 @@
+# Page pipeline: find the expressions written on a page, then translate all of them in shared batches
+#   python -m translator.page page.png --checkpoint checkpoints/model_best.pth
+import argparse
+import json
+
+import numpy as np
+import torch
+from PIL import Image
+from scipy import ndimage
+
+from train.models import VanillaWAP
+from train.utils.datasets import convert_to_string, get_vocabulary, pad_images
+from train.utils.global_params import INFERENCE_CONFIG, VOCAB_LOC
+from train.utils.grammar import LatexGrammar
+from train.utils.preprocessing import INK_THRESHOLD, invert_if_light, pad_to_stride, prepare_image, to_tensor
+
+
+def segment_expressions(image, gap=(15, 40), min_area=64, margin=4, threshold=INK_THRESHOLD):
+    """
+    Find the expression regions of a page. The ink is dilated so that the symbols of an expression, which are closer
+    to each other than gap, merge into one connected component.
+    :param image: uint8 page with bright ink - (H, W)
+    :param gap: (vertical, horizontal) distance in pixels below which two strokes belong to the same expression
+    :param min_area: regions with less ink pixels than this are dropped as noise
+    :param margin: number of pixels kept around the ink of a region
+    :param threshold: pixel value above which a pixel is ink
+    :return: list of (top, bottom, left, right) regions in reading order, bottom and right exclusive
+    """
+    ink = image > threshold
+    structure = np.ones((2 * gap[0] + 1, 2 * gap[1] + 1), dtype=bool)
+    labels, _ = ndimage.label(ndimage.binary_dilation(ink, structure=structure))
+    areas = ndimage.sum(ink, labels, index=np.arange(1, labels.max() + 1))
+
+    regions = []
+    for i, region in enumerate(ndimage.find_objects(labels)):
+        if region is None or areas[i] < min_area:
+            continue
+        # Shrink the dilated region back to its ink
+        rows = np.flatnonzero(ink[region].any(axis=1)) + region[0].start
+        cols = np.flatnonzero(ink[region].any(axis=0)) + region[1].start
+        regions.append((max(0, rows[0] - margin), min(image.shape[0], rows[-1] + 1 + margin),
+                        max(0, cols[0] - margin), min(image.shape[1], cols[-1] + 1 + margin)))
+
+    # Reading order: a region whose vertical centre falls within the current line joins it, lines are read from top to
+    # bottom and left to right within a line
+    lines = []
+    for region in sorted(regions):
+        centre = (region[0] + region[1]) / 2
+        if lines and lines[-1][0] <= centre < lines[-1][1]:
+            lines[-1][1] = max(lines[-1][1], region[1])
+            lines[-1][2].append(region)
+        else:
+            lines.append([region[0], region[1], [region]])
+    return [region for _, _, line in lines for region in sorted(line, key=lambda r: r[2])]
+
+
+def translate_images(model, images, index_to_word, batch_size=16):
+    """
+    Translate a list of images, batching images of similar size together to limit the padding
+    :param model: VanillaWAP in eval mode
+    :param images: uint8 images with bright ink - (H, W)
+    :param index_to_word: vocabulary of the model
+    :param batch_size: number of images decoded at once
+    :return: list of the latex of every image, in the order of images
+    """
+    device = model.config['DEVICE']
+    padded = [pad_to_stride(image, model.watch_stride()) for image in images]
+    images = [to_tensor(image) for image, _ in padded]
+    masks = [to_tensor(mask, scale=1) for _, mask in padded]
+    order = sorted(range(len(images)), key=lambda i: (images[i].shape[1], images[i].shape[2]))
+    latex = [None] * len(images)
+    for start in range(0, len(order), batch_size):
+        group = order[start:start + batch_size]
+        x, mask = pad_images([images[i] for i in group], [masks[i] for i in group])
+        with torch.no_grad():
+            tokens, _ = model.translate(x.to(device), mask=mask.to(device))
+        tokens = tokens.reshape(len(group), -1)
+        for j, i in enumerate(group):
+            latex[i] = convert_to_string(tokens[j], index_to_word)
+    return latex
+
+
+def translate_regions(model, image, regions, index_to_word, batch_size=16, config=None):
+    """
+    Translate the regions of a page
+    :param model: VanillaWAP in eval mode
+    :param image: uint8 page with bright ink - (H, W)
+    :param regions: (top, bottom, left, right) regions to translate
+    :param index_to_word: vocabulary of the model
+    :param batch_size: number of crops decoded at once
+    :param config: config whose preprocessing (see utils/preprocessing.prepare_image) is applied to every crop, None
+    keeps the crops as they are
+    :return: list of the latex of every region, in the order of regions
+    """
+    crops = [image[top:bottom, left:right] for top, bottom, left, right in regions]
+    if config is not None:
+        crops = [prepare_image(crop, config)[0] for crop in crops]
+    return translate_images(model, crops, index_to_word, batch_size)
+
+
+def translate_page(model, image, index_to_word, batch_size=16, **segment_kwargs):
+    """
+    :param model: VanillaWAP in eval mode
+    :param image: uint8 grayscale page, with either dark or bright ink - (H, W)
+    :param index_to_word: vocabulary of the model
+    :param batch_size: number of expressions decoded at once
+    :param segment_kwargs: arguments of segment_expressions
+    :return: list of {'bbox': (top, bottom, left, right), 'latex': str} in reading order
+    """
+    image = invert_if_light(image)
+    regions = segment_expressions(image, **segment_kwargs)
+    latex = translate_regions(model, image, regions, index_to_word, batch_size, model.config)
+    return [{'bbox': [int(v) for v in region], 'latex': text} for region, text in zip(regions, latex)]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translate every expression of a handwritten page')
+    parser.add_argument('image', help='page image')
+    parser.add_argument('--checkpoint', default='checkpoints/model_best.pth')
+    parser.add_argument('--batch_size', type=int, default=16)
+    args = parser.parse_args()
+
+    wap = VanillaWAP.from_checkpoint(args.checkpoint, INFERENCE_CONFIG)
+    vocab = {i: word for i, word in enumerate(get_vocabulary(VOCAB_LOC))}
+    if INFERENCE_CONFIG['constrained_decoding']:
+        wap.grammar = LatexGrammar(get_vocabulary(VOCAB_LOC))
+    page = np.array(Image.open(args.image).convert('L'))
+    print(json.dumps(translate_page(wap, page, vocab, args.batch_size), indent=2))
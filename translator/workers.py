@@ -0,0 +1,247 @@
+# Pool of inference processes sharing one copy of the weights. Run from the root of the repository:
+#   python -m translator.workers --checkpoint checkpoints/model_best.pth --workers 4 images/*.png
+# The parent loads the model once and moves its parameters into shared memory before forking the workers, so neither
+# the resident memory nor the start up time grows with the number of workers: a worker only maps the shared weights.
+import argparse
+import itertools
+import multiprocessing
+import threading
+import time
+from concurrent.futures import Future
+from queue import Empty
+
+import numpy as np
+import torch
+from PIL import Image
+
+from train.models import VanillaWAP
+from train.utils.datasets import get_vocabulary
+from train.utils.global_params import INFERENCE_CONFIG, VOCAB_LOC
+from train.utils.grammar import LatexGrammar
+from train.utils.preprocessing import prepare_image
+from translator.page import translate_images
+
+
+def load_shared(checkpoint, config):
+    """
+    :param checkpoint: location of a state dict saved by VanillaWAP.save()
+    :param config: inference config
+    :return: the model in eval mode on the cpu, its parameters and buffers in shared memory
+    """
+    model = VanillaWAP.from_checkpoint(checkpoint, config, 'cpu')
+    if config['constrained_decoding']:
+        model.grammar = LatexGrammar(get_vocabulary(VOCAB_LOC))
+    for p in model.parameters():
+        p.requires_grad_(False)
+    return model.share_memory()
+
+
+def serve(model, index_to_word, requests, results, batch_size):
+    """
+    Loop of a worker: translate the requests until None is received. Runs single-threaded, the pool gets its
+    parallelism from the number of workers
+    :param model: shared model inherited from the parent
+    :param index_to_word: vocabulary of the model
+    :param requests: queue of (request id, list of uint8 images with bright ink) of this worker
+    :param results: queue of (request id, list of latex, error) shared by all the workers
+    :param batch_size: number of images decoded at once
+    """
+    torch.set_num_threads(1)
+    while True:
+        request = requests.get()
+        if request is None:
+            break
+        request_id, images = request
+        try:
+            images = [prepare_image(image, model.config)[0] for image in images]
+            results.put((request_id, translate_images(model, images, index_to_word, batch_size), None))
+        except Exception as e:
+            results.put((request_id, None, f'{type(e).__name__}: {e}'))
+
+
+class WorkerPool:
+    """
+    Inference processes forked from a parent holding the only copy of the weights. Requests are dispatched to the
+    workers round-robin, and the results are collected by a thread of the parent that resolves the futures returned by
+    submit(). The collector also checks the workers every poll seconds: the requests of a worker that died, e.g. killed
+    by the OOM killer, fail instead of waiting forever, and the worker is restarted.
+
+    swap() replaces the checkpoint without downtime: a new generation of workers is forked from the new shared weights
+    and receives all the new requests, while the old generation finishes the requests already queued and exits. The
+    weights of the old checkpoint are released once its last worker is gone.
+    """
+    def __init__(self, checkpoint, workers=4, config=INFERENCE_CONFIG, batch_size=16, poll=1.0):
+        """
+        :param checkpoint: location of a state dict saved by VanillaWAP.save()
+        :param workers: number of worker processes
+        :param config: inference config
+        :param batch_size: number of images a worker decodes at once
+        :param poll: seconds between two checks of the workers
+        """
+        self.workers = workers
+        self.config = config
+        self.batch_size = batch_size
+        self.poll = poll
+        self.index_to_word = {i: word for i, word in enumerate(get_vocabulary(VOCAB_LOC))}
+        # fork keeps the start up of a worker to mapping the memory of the parent. The parent never runs the model,
+        # so no intra-op thread pool is running when it forks
+        self.context = multiprocessing.get_context('fork')
+        self.results = self.context.Queue()
+        self.pending = {}
+        self.ids = itertools.count()
+        self.lock = threading.Lock()
+        self.closed = False
+
+        self.generation = self.spawn(checkpoint)
+        # Generations whose workers may still hold requests: the current one and those retiring
+        self.generations = [self.generation]
+        self.collector = threading.Thread(target=self.collect, daemon=True)
+        self.collector.start()
+
+    def spawn(self, checkpoint):
+        """
+        :return: a new generation of workers serving checkpoint, as a dict with the shared model, the processes, their
+        request queues and a round-robin counter over the workers
+        """
+        generation = {'checkpoint': checkpoint, 'model': load_shared(checkpoint, self.config), 'processes': [],
+                      'queues': [], 'next': itertools.count()}
+        for _ in range(self.workers):
+            generation['processes'].append(None)
+            generation['queues'].append(None)
+            self.start_worker(generation, len(generation['processes']) - 1)
+        return generation
+
+    def start_worker(self, generation, slot):
+        """
+        Start the worker of a slot of generation, with a new request queue
+        """
+        queue = self.context.Queue()
+        process = self.context.Process(target=serve, daemon=True, args=(generation['model'], self.index_to_word, queue,
+                                                                         self.results, self.batch_size))
+        process.start()
+        generation['processes'][slot], generation['queues'][slot] = process, queue
+
+    def check_workers(self):
+        """
+        Fail the requests of the workers that died and restart the dead workers of the current generation. Retiring
+        workers exit with code 0 once their queue is drained
+        """
+        failed = []
+        with self.lock:
+            for generation in self.generations:
+                for slot, process in enumerate(generation['processes']):
+                    if process.exitcode in (None, 0):
+                        continue
+                    error = RuntimeError(f'worker {process.pid} exited with code {process.exitcode}')
+                    for request_id in [i for i, (_, worker) in self.pending.items() if worker is process]:
+                        failed.append((self.pending.pop(request_id)[0], error))
+                    # Nobody reads the queue of a dead worker anymore, its unsent requests must not block the exit
+                    generation['queues'][slot].cancel_join_thread()
+                    if generation is self.generation and not self.closed:
+                        self.start_worker(generation, slot)
+        for future, error in failed:
+            future.set_exception(error)
+
+    def collect(self):
+        checked = time.monotonic()
+        while True:
+            try:
+                result = self.results.get(timeout=self.poll)
+            except Empty:
+                result = ()
+            if time.monotonic() - checked >= self.poll:
+                self.check_workers()
+                checked = time.monotonic()
+            if result is None:
+                break
+            if not result:
+                continue
+            request_id, latex, error = result
+            with self.lock:
+                entry = self.pending.pop(request_id, None)
+            if entry is None:
+                # Request of a worker found dead, already failed
+                continue
+            if error is None:
+                entry[0].set_result(latex)
+            else:
+                entry[0].set_exception(RuntimeError(error))
+
+    def submit(self, images):
+        """
+        :param images: uint8 images with bright ink - (H, W), preprocessed by the worker with prepare_image()
+        :return: Future of the list of the latex of every image
+        """
+        future = Future()
+        with self.lock:
+            request_id = next(self.ids)
+            slot = next(self.generation['next']) % len(self.generation['queues'])
+            self.pending[request_id] = (future, self.generation['processes'][slot])
+            self.generation['queues'][slot].put((request_id, list(images)))
+        return future
+
+    def translate(self, images, timeout=None):
+        """
+        :param timeout: seconds to wait for the result, None waits until the request completes or its worker dies
+        :return: the list of the latex of every image, raises concurrent.futures.TimeoutError after timeout
+        """
+        return self.submit(images).result(timeout)
+
+    def swap(self, checkpoint):
+        """
+        Serve checkpoint from now on. Returns once the new workers have started, the old workers exit in the background
+        after draining their queues
+        """
+        generation = self.spawn(checkpoint)
+        with self.lock:
+            old, self.generation = self.generation, generation
+            self.generations.append(generation)
+        threading.Thread(target=self.retire, args=(old,), daemon=True).start()
+
+    def retire(self, generation):
+        for queue in generation['queues']:
+            queue.put(None)
+        for process in generation['processes']:
+            process.join()
+        # Let the collector fail the requests of a worker that died while draining its queue
+        self.check_workers()
+        with self.lock:
+            self.generations.remove(generation)
+
+    def pids(self):
+        return [process.pid for process in self.generation['processes']]
+
+    def close(self):
+        self.closed = True
+        self.retire(self.generation)
+        self.results.put(None)
+        self.collector.join()
+        with self.lock:
+            for future, _ in self.pending.values():
+                future.set_exception(RuntimeError('the worker pool was closed'))
+            self.pending.clear()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+
+def main(args):
+    images = [np.array(Image.open(path).convert('L')) for path in args.images]
+    start = time.perf_counter()
+    with WorkerPool(args.checkpoint, args.workers, batch_size=args.batch_size) as pool:
+        print(f'Started {args.workers} workers in {time.perf_counter() - start:.2f}s')
+        futures = [pool.submit([image]) for image in images]
+        for path, future in zip(args.images, futures):
+            print(f'{path}\t{future.result()[0]}')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Translate images with a pool of workers sharing the weights')
+    parser.add_argument('images', nargs='+')
+    parser.add_argument('--checkpoint', default='checkpoints/model_best.pth')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--batch_size', type=int, default=16)
+    main(parser.parse_args())